@@ -0,0 +1,134 @@
+import collections
+import threading
+import time
+import typing
+from scraper import logger
+from scraper import metrics
+from scraper import queues
+
+LOG = logger.LOG
+
+REMEMBERED_MESSAGES = 100000
+
+
+class AckManager:  # pylint: disable=too-many-instance-attributes
+    # Coalesces acknowledgements into bulk RPCs, flushed when `max_batch` ack ids are pending or the oldest has
+    # waited `max_latency` seconds. While the background thread runs it also renews the deadline of every message
+    # still being processed, so slow pages are not redelivered to another worker halfway through. `before_flush`
+    # runs ahead of every acknowledge RPC, for work that must be durable before its source messages are acked.
+
+    def __init__(self, queue: queues.Queue,  # pylint: disable=too-many-arguments
+                 max_batch: int = 100,
+                 max_latency: float = 1.0,
+                 lease_seconds: int = 60,
+                 lease_interval: float = 5.0,
+                 before_flush: typing.Optional[typing.Callable[[], None]] = None) -> None:
+        self.__queue = queue
+        self.__before_flush = before_flush
+        self.__max_batch = max_batch
+        self.__max_latency = max_latency
+        self.__lease_seconds = lease_seconds
+        self.__lease_interval = lease_interval
+
+        self.__lock = threading.RLock()
+        self.__pending = []  # type: typing.List[str]
+        self.__pending_since = 0.0
+        self.__leased = {}  # type: typing.Dict[str, str]
+        self.__seen = collections.OrderedDict()  # type: typing.MutableMapping[str, None]
+        self.__stop = threading.Event()
+        self.__thread = None  # type: typing.Optional[threading.Thread]
+        self.counters = collections.Counter()  # type: typing.Counter[str]
+
+    def track(self, ack_id: str, message_id: str) -> None:
+        with self.__lock:
+            if message_id in self.__seen:
+                self.counters['redeliveries'] += 1
+            else:
+                self.__seen[message_id] = None
+                while len(self.__seen) > REMEMBERED_MESSAGES:
+                    self.__seen.popitem(last=False)  # type: ignore
+            self.__leased[ack_id] = message_id
+
+    def ack(self, ack_id: str) -> None:
+        with self.__lock:
+            self.__leased.pop(ack_id, None)
+            if not self.__pending:
+                self.__pending_since = time.monotonic()
+            self.__pending.append(ack_id)
+            if len(self.__pending) >= self.__max_batch:
+                self.flush()
+
+    def discard(self, ack_id: str) -> None:
+        # Withdraws a pending acknowledgement, for a message whose output was lost before it was flushed.
+        with self.__lock:
+            if ack_id in self.__pending:
+                self.__pending.remove(ack_id)
+
+    def nack(self, ack_id: str, delay: int) -> None:
+        # Stops renewing the lease and lets the message be redelivered after `delay` seconds.
+        with self.__lock:
+            self.__leased.pop(ack_id, None)
+            self.counters['nacked'] += 1
+        self.__queue.modify_ack_deadline([ack_id], delay)
+
+    def flush(self) -> None:
+        with self.__lock:
+            if not self.__pending:
+                return
+            if self.__before_flush is not None:
+                self.__before_flush()
+                if not self.__pending:
+                    return
+            ack_ids, self.__pending = self.__pending, []
+            with metrics.timer(metrics.STAGE_SECONDS, stage='ack', type=''):
+                self.__queue.acknowledge(ack_ids)
+            self.counters['ack_rpcs'] += 1
+            self.counters['acked'] += len(ack_ids)
+
+    def flush_if_due(self) -> None:
+        with self.__lock:
+            if self.__pending and time.monotonic() - self.__pending_since >= self.__max_latency:
+                self.flush()
+
+    def extend_leases(self) -> None:
+        with self.__lock:
+            ack_ids = list(self.__leased)
+        if ack_ids:
+            self.__queue.modify_ack_deadline(ack_ids, self.__lease_seconds)
+            with self.__lock:
+                self.counters['lease_rpcs'] += 1
+
+    def __run(self) -> None:
+        next_lease = time.monotonic() + self.__lease_interval
+        while not self.__stop.wait(min(self.__max_latency, self.__lease_interval) / 2):
+            try:
+                self.flush_if_due()
+                if time.monotonic() >= next_lease:
+                    self.extend_leases()
+                    next_lease = time.monotonic() + self.__lease_interval
+            except Exception:  # pylint: disable=broad-except
+                LOG.exception('Ack manager failed to flush or extend leases')
+
+    @property
+    def running(self) -> bool:
+        return self.__thread is not None
+
+    def start(self) -> None:
+        if self.__thread is None:
+            self.__stop.clear()
+            self.__thread = threading.Thread(target=self.__run, name='ack-manager', daemon=True)
+            self.__thread.start()
+
+    def stop(self) -> None:
+        if self.__thread is not None:
+            self.__stop.set()
+            self.__thread.join()
+            self.__thread = None
+        self.flush()
+
+    def stats(self) -> typing.Dict[str, int]:
+        with self.__lock:
+            stats = dict(self.counters)
+            stats['pending'] = len(self.__pending)
+            stats['leased'] = len(self.__leased)
+            return stats
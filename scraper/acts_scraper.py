@@ -1,12 +1,23 @@
 import abc
+import asyncio
 import datetime
 import re
+import tempfile
 import typing
+from concurrent import futures
 from urllib import parse
-import dateutil.parser
+from lxml import etree  # type: ignore
 from lxml import html  # type: ignore
 import requests
-from requests_file import FileAdapter
+from scraper import admission
+from scraper import fetcher
+from scraper import http_cache
+from scraper import metrics
+from scraper import profiling
+from scraper import streaming
+
+STREAM_CHUNK_SIZE = 64 * 1024
+SPOOL_MAX_SIZE = 1024 * 1024
 
 
 class Breadcrumb(typing.NamedTuple):
@@ -19,7 +30,13 @@ class ActItem(typing.NamedTuple):
     title: str
     start: str
     end: str
-    body: str
+    body: typing.Union[str, typing.IO[bytes]]
+
+
+def close_item(item: ActItem) -> None:
+    # Streamed bodies are temporary files, which nothing else closes once the item is stored or dropped.
+    if not isinstance(item.body, str):
+        item.body.close()
 
 
 ScraperInput = typing.Tuple[html.HtmlElement, str, typing.Dict[str, str]]  # pylint: disable=invalid-name
@@ -33,122 +50,57 @@ class Scraper(metaclass=abc.ABCMeta):
         pass
 
 
-class ActsScraper(Scraper):
-
-    def __init__(self):
-        self.__functions = {
-            'main_page': self.parse_main_page,
-            'letter_page': self.parse_letter_page,
-            'act_main': self.parse_act_main,
-            'act_versions': self.parse_act_versions,
-            'act_item': self.parse_act_item
-        }
-
-    @staticmethod
-    def follow_breadcrumb(input_breadcrumb: Breadcrumb) -> ScraperInput:
-        sess = requests.Session()
-        sess.mount('file://', FileAdapter())
-
-        response = sess.get(input_breadcrumb.url)
-        tree = html.fromstring(response.content)
-
-        attrs = input_breadcrumb.attrs.copy()
-        if 'timestamp' not in attrs:
-            attrs['timestamp'] = datetime.datetime.now().isoformat()
-
-        return tree, response.url, attrs
+class AsyncScraper(metaclass=abc.ABCMeta):
 
-    @classmethod
-    def parse_main_page(cls, scraper_input: ScraperInput) -> ScraperResult:
-        tree, response_uri, attrs = scraper_input
+    @abc.abstractmethod
+    async def scrape(self, input_breadcrumb: Breadcrumb) -> typing.Optional[ScraperResult]:
+        pass
 
-        if datetime.datetime.now() - dateutil.parser.parse(attrs['timestamp']) >= datetime.timedelta(days=1):
-            return [], []
+    # A scrape that raises is returned as its exception, so one bad page does not lose the rest of the batch.
+    async def scrape_many(self, input_breadcrumbs: typing.Sequence[Breadcrumb]) \
+            -> typing.List[typing.Union[ScraperResult, None, Exception]]:
+        return list(await asyncio.gather(*[self.scrape(breadcrumb) for breadcrumb in input_breadcrumbs],
+                                         return_exceptions=True))
 
-        results = []  # type: typing.List[Breadcrumb]
 
-        for link in tree.xpath('//div[@id="alphaList"]//a[@class="btn btn-default"]'):
-            assert isinstance(response_uri, str)
-            next_uri = parse.urljoin(response_uri, link.attrib['href'])
-            attrs = attrs.copy()
-            attrs['type'] = 'letter_page'
-            result = Breadcrumb(url=next_uri, attrs=attrs)
-            results.append(result)
-        return results, []
+LinkAttrs = typing.Callable[[html.HtmlElement, int], typing.Dict[str, str]]  # pylint: disable=invalid-name
 
-    @classmethod
-    def parse_letter_page(cls, scraper_input: ScraperInput) -> ScraperResult:
-        tree, response_uri, attrs = scraper_input
 
-        if datetime.datetime.now() - dateutil.parser.parse(attrs['timestamp']) >= datetime.timedelta(days=1):
-            return [], []
+def no_link_attrs(_: html.HtmlElement, __: int) -> typing.Dict[str, str]:
+    return {}
 
-        results = []  # type: typing.List[Breadcrumb]
-
-        for link in tree.xpath('//div[@class="contentBlock"]/ul/li/span[@class="objTitle"]/a'):
-            url = link.attrib['href']
-            next_uri = parse.urljoin(response_uri, url)
-            attrs = attrs.copy()
-            attrs.update({
-                'title': link.text.strip(),
-                'code': url.split('/')[0].split('.html')[0],
-                'type': 'act_main',
-            })
-            result = Breadcrumb(url=next_uri, attrs=attrs)
-            results.append(result)
-        return results, []
 
-    @classmethod
-    def parse_act_main(cls, scraper_input: ScraperInput) -> ScraperResult:
-        tree, response_uri, attrs = scraper_input
+class PageType(typing.NamedTuple):
+    name: str
+    links: typing.Optional[etree.XPath] = None
+    child_type: str = ''
+    link_attrs: LinkAttrs = no_link_attrs
+    content: typing.Optional[etree.XPath] = None
 
-        if datetime.datetime.now() - dateutil.parser.parse(attrs['timestamp']) >= datetime.timedelta(days=1):
-            return [], []
 
-        results = []  # type: typing.List[Breadcrumb]
+PAGE_TYPES = {}  # type: typing.Dict[str, PageType]
 
-        for link in tree.xpath('//p[@id="assentedDate"]/a'):
-            next_url = parse.urljoin(response_uri, link.attrib['href'])
-            attrs = attrs.copy()
-            attrs['type'] = 'act_versions'
-            result = Breadcrumb(url=next_url, attrs=attrs)
-            results.append(result)
-        return results, []
 
-    @classmethod
-    def parse_act_versions(cls, scraper_input: ScraperInput) -> ScraperResult:
-        tree, response_uri, attrs = scraper_input
+def register_page_type(page_type: PageType) -> PageType:
+    PAGE_TYPES[page_type.name] = page_type
+    return page_type
 
-        if datetime.datetime.now() - dateutil.parser.parse(attrs['timestamp']) >= datetime.timedelta(days=1):
-            return [], []
 
-        results = []  # type: typing.List[Breadcrumb]
-        pattern = re.compile('From (\\d{4}-\\d{2}-\\d{2}) to (\\d{4}-\\d{2}-\\d{2})')
-
-        for i, link in enumerate(tree.xpath('//main[@property="mainContentOfPage"]/ul//a')):
-            next_url = parse.urljoin(response_uri, link.attrib['href'])
-            text = link.text
-            parsed_text = re.match(pattern, text)
+def parse_page(page_type: PageType, scraper_input: ScraperInput) -> ScraperResult:
+    tree, response_uri, attrs = scraper_input
 
+    results = []  # type: typing.List[Breadcrumb]
+    if page_type.links is not None:
+        for i, link in enumerate(page_type.links(tree)):
             link_attrs = attrs.copy()
-            link_attrs.update({
-                'start': parsed_text.group(1),
-                'end': parsed_text.group(2) if i > 0 else '',
-                'type': 'act_item'
-            })
-            result = Breadcrumb(url=next_url, attrs=link_attrs)
+            link_attrs.update(page_type.link_attrs(link, i))
+            link_attrs['type'] = page_type.child_type
+            result = Breadcrumb(url=parse.urljoin(response_uri, link.attrib['href']), attrs=link_attrs)
             results.append(result)
-        return results, []
-
-    @classmethod
-    def parse_act_item(cls, scraper_input: ScraperInput) -> ScraperResult:
-        tree, _, attrs = scraper_input
 
-        if datetime.datetime.now() - dateutil.parser.parse(attrs['timestamp']) >= datetime.timedelta(days=1):
-            return [], []
-
-        items = []  # type: typing.List[ActItem]
-        for content_node in tree.xpath('//div[@id="wb-cont"]'):
+    items = []  # type: typing.List[ActItem]
+    if page_type.content is not None:
+        for content_node in page_type.content(tree):
             item = ActItem(
                 code=attrs['code'],
                 title=attrs['title'],
@@ -157,13 +109,168 @@ class ActsScraper(Scraper):
                 body=html.tostring(content_node).decode('utf-8')
             )
             items.append(item)
-        return [], items
+    return results, items
+
+
+def letter_link_attrs(link: html.HtmlElement, _: int) -> typing.Dict[str, str]:
+    url = link.attrib['href']
+    return {
+        'title': link.text.strip(),
+        'code': url.split('/')[0].split('.html')[0],
+    }
+
+
+VERSION_DATES = re.compile('From (\\d{4}-\\d{2}-\\d{2}) to (\\d{4}-\\d{2}-\\d{2})')
+
+
+def version_link_attrs(link: html.HtmlElement, i: int) -> typing.Dict[str, str]:
+    parsed_text = VERSION_DATES.match(link.text)
+    return {
+        'start': parsed_text.group(1),
+        'end': parsed_text.group(2) if i > 0 else '',
+    }
+
+
+register_page_type(PageType(
+    name='main_page',
+    links=etree.XPath('//div[@id="alphaList"]//a[@class="btn btn-default"]'),
+    child_type='letter_page',
+))
+register_page_type(PageType(
+    name='letter_page',
+    links=etree.XPath('//div[@class="contentBlock"]/ul/li/span[@class="objTitle"]/a'),
+    child_type='act_main',
+    link_attrs=letter_link_attrs,
+))
+register_page_type(PageType(
+    name='act_main',
+    links=etree.XPath('//p[@id="assentedDate"]/a'),
+    child_type='act_versions',
+))
+register_page_type(PageType(
+    name='act_versions',
+    links=etree.XPath('//main[@property="mainContentOfPage"]/ul//a'),
+    child_type='act_item',
+    link_attrs=version_link_attrs,
+))
+register_page_type(PageType(
+    name='act_item',
+    content=etree.XPath('//div[@id="wb-cont"]'),
+))
+
+
+class ActsScraper(Scraper):
+
+    def __init__(self, http_fetcher: typing.Optional[fetcher.Fetcher] = None,  # pylint: disable=too-many-arguments
+                 prune_unchanged: typing.Iterable[str] = (),
+                 gate: typing.Optional[admission.Admission] = None,
+                 stream_items: bool = False,
+                 parse_processes: int = 0) -> None:
+        self.__fetcher = http_fetcher or fetcher.HttpFetcher()
+        self.__stream_items = stream_items
+        self.__prune_unchanged = frozenset(prune_unchanged)
+        self.__admission = gate or admission.Admission()
+        self.__parse_processes = parse_processes
+        self.__parse_pool = None  # type: typing.Optional[futures.ProcessPoolExecutor]
+        if parse_processes:
+            self.__parse_pool = futures.ProcessPoolExecutor(max_workers=parse_processes)
+
+    def follow_breadcrumb(self, input_breadcrumb: Breadcrumb) -> ScraperInput:
+        response = self.fetch(input_breadcrumb)
+        return self.scraper_input(input_breadcrumb, response.url, response.content)
+
+    @staticmethod
+    def scraper_input(input_breadcrumb: Breadcrumb, response_url: str, content: bytes) -> ScraperInput:
+        tree = html.fromstring(content)
+
+        attrs = input_breadcrumb.attrs.copy()
+        if 'timestamp' not in attrs:
+            attrs['timestamp'] = datetime.datetime.now().isoformat()
+
+        return tree, response_url, attrs
+
+    @classmethod
+    def parse_content(cls, input_breadcrumb: Breadcrumb, response_url: str, content: bytes) -> ScraperResult:
+        page_type = PAGE_TYPES[input_breadcrumb.attrs['type']]
+        return parse_page(page_type, cls.scraper_input(input_breadcrumb, response_url, content))
+
+    @classmethod
+    def parse_act_item_stream(cls, input_breadcrumb: Breadcrumb, response: requests.Response) -> ScraperResult:
+        # The response holds a connection from a blocking pool until it is closed, whatever happens here.
+        attrs = input_breadcrumb.attrs
+        body = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+        try:
+            chunks = metrics.counted(response.iter_content(chunk_size=STREAM_CHUNK_SIZE), metrics.FETCHED_BYTES,
+                                     type=attrs['type'])
+            found = streaming.extract_element(chunks, body, 'div', 'wb-cont')
+        except Exception:
+            body.close()
+            raise
+        finally:
+            response.close()
+        if not found:
+            body.close()
+            return [], []
+
+        body.seek(0)
+        item = ActItem(
+            code=attrs['code'],
+            title=attrs['title'],
+            start=attrs['start'],
+            end=attrs['end'],
+            body=body
+        )
+        return [], [item]
+
+    @property
+    def page_types(self) -> typing.FrozenSet[str]:
+        return frozenset(PAGE_TYPES)
+
+    @property
+    def parse_workers(self) -> int:
+        return self.__parse_processes or 1
+
+    def admit(self, input_breadcrumb: Breadcrumb) -> bool:
+        return self.__admission.admit(input_breadcrumb.url, input_breadcrumb.attrs) is None
+
+    def __streams(self, input_breadcrumb: Breadcrumb) -> bool:
+        return self.__stream_items and input_breadcrumb.attrs['type'] == 'act_item'
+
+    def fetch(self, input_breadcrumb: Breadcrumb) -> requests.Response:
+        input_type = input_breadcrumb.attrs['type']
+        stream = self.__streams(input_breadcrumb)
+        with metrics.timer(metrics.STAGE_SECONDS, stage='fetch', type=input_type), profiling.tagged(input_type):
+            response = self.__fetcher.get(input_breadcrumb.url, stream=stream)
+            if not stream:
+                metrics.inc(metrics.FETCHED_BYTES, len(response.content), type=input_type)
+        return response
+
+    def parse(self, input_breadcrumb: Breadcrumb, response: requests.Response) -> ScraperResult:
+        input_type = input_breadcrumb.attrs['type']
+        result = [], []  # type: ScraperResult
+        if input_type not in self.__prune_unchanged or not http_cache.is_cached(response):
+            with metrics.timer(metrics.STAGE_SECONDS, stage='parse', type=input_type), profiling.tagged(input_type):
+                if self.__streams(input_breadcrumb):
+                    result = self.parse_act_item_stream(input_breadcrumb, response)
+                elif self.__parse_pool is not None:
+                    result = self.__parse_pool.submit(self.parse_content, input_breadcrumb,
+                                                      response.url, response.content).result()
+                else:
+                    result = self.parse_content(input_breadcrumb, response.url, response.content)
+        self.__admission.mark_done(input_breadcrumb.url, input_breadcrumb.attrs)
+        return result
 
     def scrape(self, input_breadcrumb: Breadcrumb) -> typing.Optional[ScraperResult]:
         input_type = input_breadcrumb.attrs.get('type')
         result: typing.Optional[ScraperResult] = None
         if input_type:
-            tree, response_url, attrs = self.follow_breadcrumb(input_breadcrumb)
-
-            result = self.__functions[input_type]((tree, response_url, attrs))
+            if not self.admit(input_breadcrumb):
+                return [], []
+            response = self.fetch(input_breadcrumb)
+            result = self.parse(input_breadcrumb, response)
         return result
+
+    def close(self) -> None:
+        self.__fetcher.close()
+        if self.__parse_pool is not None:
+            self.__parse_pool.shutdown()
@@ -1,51 +1,236 @@
+import collections
+import hashlib
+import threading
+import time
+import typing
 from google.cloud import datastore
 
 from scraper import acts_scraper
+from scraper import metrics
 from scraper import storage
 
+MAX_LOOKUP_KEYS = 1000
+MAX_COMMIT_ENTITIES = 500
+HASH_CHUNK_SIZE = 1 << 16
+
+VersionId = typing.Tuple[str, str]  # pylint: disable=invalid-name
+WriteFailed = typing.Callable[[Exception], None]  # pylint: disable=invalid-name
+CacheEntry = typing.Tuple[bool, float]  # pylint: disable=invalid-name
+
+
+def raw_hash(body: typing.Union[str, typing.IO[bytes]]) -> str:
+    # SHA-256 of the UTF-8 body. File bodies are read to the end and rewound to where they were.
+    digest = hashlib.sha256()
+    if isinstance(body, str):
+        digest.update(body.encode('utf-8'))
+    else:
+        position = body.tell()
+        for chunk in iter(lambda: body.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+        body.seek(position)
+    return digest.hexdigest()
+
+
+def raw_path(digest: str) -> str:
+    return 'acts/raw/sha256/{}'.format(digest)
+
+
+class KeyCache:
+    # Bounded LRU of datastore keys known to exist, by flat path, each with whether the entity's raw blob is stored.
+    # Entries expire after `ttl` seconds so entities changed by another process are eventually looked up again.
+    # Not thread safe; ActsStorage only uses it under its own lock.
+
+    def __init__(self, size: int = 100000, ttl: float = 3600.0) -> None:
+        self.__size = size
+        self.__ttl = ttl
+        self.__entries = collections.OrderedDict()  # type: typing.MutableMapping[typing.Tuple, CacheEntry]
+
+    def __len__(self) -> int:
+        return len(self.__entries)
+
+    def get(self, key: datastore.Key) -> typing.Optional[bool]:
+        # None if the key is not known to exist, otherwise whether its raw blob is stored.
+        entry = self.__entries.get(key.flat_path)
+        if entry is None:
+            return None
+        has_raw, expires = entry
+        if time.monotonic() >= expires:
+            del self.__entries[key.flat_path]
+            return None
+        self.__entries.move_to_end(key.flat_path)  # type: ignore
+        return has_raw
+
+    def set(self, key: datastore.Key, has_raw: bool = False) -> None:
+        if not self.__size:
+            return
+        self.__entries.pop(key.flat_path, None)
+        self.__entries[key.flat_path] = (has_raw, time.monotonic() + self.__ttl)
+        while len(self.__entries) > self.__size:
+            self.__entries.popitem(last=False)  # type: ignore
+
+    def invalidate(self, key: datastore.Key) -> None:
+        self.__entries.pop(key.flat_path, None)
+
+    @property
+    def full(self) -> bool:
+        return len(self.__entries) >= self.__size
+
 
 class ActsStorage:
+    # Items are written in batches: one lookup for the Acts and ActVersions of every item, the raw blob uploads, then
+    # one commit of the new Acts and of each version with its raw_blob already set. With batch_size > 1 items are
+    # buffered until batch_size are pending or the oldest has waited max_latency seconds; callers must flush before
+    # acknowledging the messages that produced buffered items. A batch that fails to write is dropped rather than
+    # retried: the error is raised and passed to the `failed` callback of every item in it, so the messages that
+    # produced them can be redelivered and write them again. Keys already seen are remembered in `cache`, so
+    # versions whose raw blob is known to be stored are skipped without any RPC.
+    #
+    # Raw bodies are stored once per content hash. Each ActVersion records the blob path and `raw_hash`, and a
+    # RawBlob entity named by the hash is committed after its upload, so a body already in the index is never
+    # uploaded again and unchanged versions can be recognised by comparing hashes.
 
-    def __init__(self, ds: datastore.Client, st: storage.Storage) -> None:
+    def __init__(self, ds: datastore.Client, st: storage.Storage,  # pylint: disable=too-many-arguments
+                 batch_size: int = 1,
+                 max_latency: float = 1.0,
+                 cache: typing.Optional[KeyCache] = None) -> None:
         self.__datastore = ds
         self.__bucket = st
+        self.__batch_size = batch_size
+        self.__max_latency = max_latency
+        self.__cache = cache if cache is not None else KeyCache()
+
+        self.__lock = threading.RLock()
+        self.__pending = []  # type: typing.List[typing.Tuple[acts_scraper.ActItem, typing.Optional[WriteFailed]]]
+        self.__pending_since = 0.0
+
+    def __lookup(self, keys: typing.Sequence[datastore.Key]) -> typing.Dict[typing.Tuple, datastore.Entity]:
+        found = {}
+        for start in range(0, len(keys), MAX_LOOKUP_KEYS):
+            for entity in self.__datastore.get_multi(keys[start:start + MAX_LOOKUP_KEYS]):
+                found[entity.key.flat_path] = entity
+                self.__cache.set(entity.key, bool(entity.get('raw_blob')))
+        return found
+
+    def warm(self) -> int:
+        # Fills the cache with keys-only queries of Acts and RawBlobs and a projection query of the ActVersions with
+        # a raw blob, stopping when the cache is full. Returns the number of keys cached.
+        with self.__lock:
+            cached = len(self.__cache)
+            act_query = self.__datastore.query(kind='Act')
+            act_query.keys_only()
+            blob_query = self.__datastore.query(kind='RawBlob')
+            blob_query.keys_only()
+            version_query = self.__datastore.query(kind='ActVersion', projection=['raw_blob'])
+            for query in (act_query, blob_query, version_query):
+                for entity in query.fetch():
+                    if self.__cache.full:
+                        break
+                    self.__cache.set(entity.key, bool(entity.get('raw_blob')))
+            return len(self.__cache) - cached
+
+    def __store_raw_in_storage(self, uploads: typing.Sequence[typing.Tuple[str, storage.UploadData]]) -> None:
+        # Raises the first failure only after every upload has finished; nothing is committed for the batch.
+        with metrics.timer(metrics.STAGE_SECONDS, stage='storage', type=''):
+            results = self.__bucket.upload_many(uploads)
+        for result in results:
+            if result.error is not None:
+                raise result.error
+
+    def __write(self, items: typing.Sequence[acts_scraper.ActItem]) -> None:
+        acts = collections.OrderedDict()  # type: typing.MutableMapping[str, acts_scraper.ActItem]
+        versions = collections.OrderedDict()  # type: typing.MutableMapping[VersionId, acts_scraper.ActItem]
+        for item in items:
+            acts.setdefault(item.code, item)
+            versions.setdefault((item.code, item.start), item)
+        act_keys = {code: self.__datastore.key('Act', code) for code in acts}
+        version_keys = {version: self.__datastore.key('ActVersion', version[1], parent=act_keys[version[0]])
+                        for version in versions}
+
+        # Versions with a stored raw blob are done, and their Act exists; only unknown keys need a lookup.
+        for version in [version for version, key in version_keys.items() if self.__cache.get(key)]:
+            del versions[version]
+        acts = collections.OrderedDict((code, item) for code, item in acts.items()
+                                       if self.__cache.get(act_keys[code]) is None and
+                                       any(version[0] == code for version in versions))
+        digests = {version: raw_hash(item.body) for version, item in versions.items()}
+        blob_keys = {digest: self.__datastore.key('RawBlob', digest) for digest in set(digests.values())}
+        unknown = list(act_keys[code] for code in acts) + [version_keys[version] for version in versions]
+        unknown.extend(key for key in blob_keys.values() if self.__cache.get(key) is None)
+        found = {}  # type: typing.Dict[typing.Tuple, datastore.Entity]
+        if unknown:
+            with metrics.timer(metrics.STAGE_SECONDS, stage='datastore', type=''):
+                found = self.__lookup(unknown)
+
+        changed = []  # type: typing.List[datastore.Entity]
+        for code, item in acts.items():
+            if act_keys[code].flat_path not in found:
+                act = datastore.Entity(act_keys[code])
+                act.update({
+                    'code': item.code,
+                    'title': item.title,
+                })
+                changed.append(act)
+
+        stored = {digest for digest, key in blob_keys.items()
+                  if key.flat_path in found or self.__cache.get(key) is not None}
+        uploads = []  # type: typing.List[typing.Tuple[str, storage.UploadData]]
+        for version, item in versions.items():
+            version_key = version_keys[version]
+            act_version = found.get(version_key.flat_path)
+            if act_version is None:
+                act_version = datastore.Entity(version_key)
+                act_version.update({
+                    'start': item.start,
+                    'end': item.end,
+                })
+            elif act_version.get('raw_blob'):
+                continue
+            digest = digests[version]
+            path = raw_path(digest)
+            if digest in stored:
+                metrics.inc(metrics.DEDUPLICATED_BLOBS)
+            else:
+                uploads.append((path, item.body))
+                raw_blob = datastore.Entity(blob_keys[digest])
+                raw_blob['raw_blob'] = path
+                changed.append(raw_blob)
+                stored.add(digest)
+            act_version['raw_blob'] = path
+            act_version['raw_hash'] = digest
+            changed.append(act_version)
+
+        if uploads:
+            self.__store_raw_in_storage(uploads)
+        for entity in changed:
+            self.__cache.invalidate(entity.key)
+        with metrics.timer(metrics.STAGE_SECONDS, stage='datastore', type=''):
+            for start in range(0, len(changed), MAX_COMMIT_ENTITIES):
+                self.__datastore.put_multi(changed[start:start + MAX_COMMIT_ENTITIES])
+        for entity in changed:
+            self.__cache.set(entity.key, bool(entity.get('raw_blob')))
+        metrics.inc(metrics.ITEMS_STORED, len(items))
+
+    def store(self, item: acts_scraper.ActItem, failed: typing.Optional[WriteFailed] = None) -> None:
+        with self.__lock:
+            if not self.__pending:
+                self.__pending_since = time.monotonic()
+            self.__pending.append((item, failed))
+            if len(self.__pending) >= self.__batch_size or \
+                    time.monotonic() - self.__pending_since >= self.__max_latency:
+                self.flush()
 
-    def __act_in_datastore(self, item: acts_scraper.ActItem) -> datastore.Entity:
-        act_key = self.__datastore.key('Act', item.code)
-        act = self.__datastore.get(act_key)
-
-        if not act:
-            act = datastore.Entity(act_key)
-            act.update({
-                'code': item.code,
-                'title': item.title,
-            })
-            self.__datastore.put(act)
-        return act
-
-    def __act_version_in_datastore(self, item: acts_scraper.ActItem, act_key: datastore.Key):
-        version_key = self.__datastore.key('ActVersion', item.start, parent=act_key)
-        version = self.__datastore.get(version_key)
-
-        if not version:
-            version = datastore.Entity(version_key)
-            version.update({
-                'start': item.start,
-                'end': item.end,
-            })
-            self.__datastore.put(version)
-        return version
-
-    def __store_raw_in_storage(self, item: acts_scraper.ActItem) -> str:
-        path = 'acts/raw/{}/{}'.format(item.code, item.start)
-        blob = self.__bucket.get_blob(path)
-        blob.upload_from_string(item.body)
-        return path
-
-    def store(self, item: acts_scraper.ActItem) -> None:
-        act = self.__act_in_datastore(item)
-        act_version = self.__act_version_in_datastore(item, act.key)
-
-        if not act_version.get('raw_blob'):
-            act_version['raw_blob'] = self.__store_raw_in_storage(item)
-            self.__datastore.put(act_version)
+    def flush(self) -> None:
+        with self.__lock:
+            batch, self.__pending = self.__pending, []
+            if not batch:
+                return
+            try:
+                self.__write([item for item, _ in batch])
+            except Exception as error:
+                for _, failed in batch:
+                    if failed is not None:
+                        failed(error)
+                raise
+            finally:
+                for item, _ in batch:
+                    acts_scraper.close_item(item)
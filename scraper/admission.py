@@ -0,0 +1,67 @@
+import collections
+import datetime
+import threading
+import typing
+from urllib import parse
+
+STALE = 'stale'
+DUPLICATE = 'duplicate'
+DISALLOWED = 'disallowed'
+
+
+class Admission:
+    # Decides from the message alone whether a breadcrumb is worth fetching. Timestamps are the ISO strings
+    # written by `gitlawca trigger` and copied onto every child, so they double as a crawl generation id and
+    # staleness is a plain string comparison against a cutoff instead of a full date parse.
+
+    def __init__(self, max_age: datetime.timedelta = datetime.timedelta(days=1),
+                 allowed_types: typing.Optional[typing.Iterable[str]] = None,
+                 allowed_hosts: typing.Optional[typing.Iterable[str]] = None,
+                 dedup_size: int = 0,
+                 allowed_schemes: typing.Optional[typing.Iterable[str]] = None) -> None:
+        self.__max_age = max_age
+        self.__allowed_types = frozenset(allowed_types) if allowed_types is not None else None
+        self.__allowed_hosts = frozenset(allowed_hosts) if allowed_hosts is not None else None
+        self.__allowed_schemes = frozenset(allowed_schemes) if allowed_schemes is not None else None
+        self.__dedup_size = dedup_size
+        self.__seen = collections.OrderedDict()  # type: typing.MutableMapping[typing.Tuple[str, str], None]
+        self.__lock = threading.Lock()
+        self.drops = collections.Counter()  # type: typing.Counter[str]
+
+    def __cutoff(self) -> str:
+        return (datetime.datetime.now() - self.__max_age).isoformat()
+
+    def __is_allowed(self, url: str, attrs: typing.Mapping[str, str]) -> bool:
+        if self.__allowed_types is not None and attrs.get('type') not in self.__allowed_types:
+            return False
+        split_url = parse.urlsplit(url)
+        if self.__allowed_schemes is not None and split_url.scheme not in self.__allowed_schemes:
+            return False
+        if self.__allowed_hosts is not None and split_url.hostname not in self.__allowed_hosts:
+            return False
+        return True
+
+    def admit(self, url: str, attrs: typing.Mapping[str, str]) -> typing.Optional[str]:
+        reason = None
+        timestamp = attrs.get('timestamp', '')
+        if not self.__is_allowed(url, attrs):
+            reason = DISALLOWED
+        elif timestamp and timestamp <= self.__cutoff():
+            reason = STALE
+        elif self.__dedup_size:
+            with self.__lock:
+                if (timestamp, url) in self.__seen:
+                    reason = DUPLICATE
+
+        if reason:
+            with self.__lock:
+                self.drops[reason] += 1
+        return reason
+
+    def mark_done(self, url: str, attrs: typing.Mapping[str, str]) -> None:
+        if not self.__dedup_size:
+            return
+        with self.__lock:
+            self.__seen[(attrs.get('timestamp', ''), url)] = None
+            while len(self.__seen) > self.__dedup_size:
+                self.__seen.popitem(last=False)  # type: ignore
@@ -0,0 +1,29 @@
+import asyncio
+import typing
+from concurrent import futures
+from scraper import acts_scraper
+
+
+class AsyncActsScraper(acts_scraper.AsyncScraper):
+    # Fetches run on a thread pool sized to the number of requests allowed in flight, so the pooled fetcher's
+    # keep-alive connections are shared. Parsing gets one thread per parse worker: a single thread in-process,
+    # since lxml holds the GIL while building trees, or one per process when the scraper offloads parsing.
+
+    def __init__(self, scraper: typing.Optional[acts_scraper.ActsScraper] = None, concurrency: int = 10) -> None:
+        self.__scraper = scraper or acts_scraper.ActsScraper()
+        self.__fetch_pool = futures.ThreadPoolExecutor(max_workers=concurrency)
+        self.__parse_pool = futures.ThreadPoolExecutor(max_workers=self.__scraper.parse_workers)
+
+    async def scrape(self, input_breadcrumb: acts_scraper.Breadcrumb) -> typing.Optional[acts_scraper.ScraperResult]:
+        if not input_breadcrumb.attrs.get('type'):
+            return None
+        if not self.__scraper.admit(input_breadcrumb):
+            return [], []
+
+        loop = asyncio.get_event_loop()
+        response = await loop.run_in_executor(self.__fetch_pool, self.__scraper.fetch, input_breadcrumb)
+        return await loop.run_in_executor(self.__parse_pool, self.__scraper.parse, input_breadcrumb, response)
+
+    def close(self) -> None:
+        self.__fetch_pool.shutdown()
+        self.__parse_pool.shutdown()
@@ -1,11 +1,29 @@
 import datetime
+import functools
+import os
+import tempfile
+import typing
 import click
 from google.cloud import datastore
 from google.cloud import pubsub
 from scraper import acts_scraper
 from scraper import acts_storage
+from scraper import admission
+from scraper import async_scraper
+from scraper import fetcher
+from scraper import http_cache
+from scraper import metrics
+from scraper import profiling
+from scraper import publisher
+from scraper import queues
+from scraper import ratelimit
+from scraper import retries
 from scraper import spider
 from scraper import storage
+from scraper import supervisor
+from scraper import wire
+
+ACTS_HOST = 'laws-lois.justice.gc.ca'
 
 
 @click.group()
@@ -13,33 +31,283 @@ def main() -> None:
     pass
 
 
+QUEUE_BACKENDS = ('pubsub', 'sqlite', 'memory')
+
+
+class QueueOptions(typing.NamedTuple):
+    backend: str
+    path: str
+    lanes: typing.Sequence[typing.Tuple[str, int]]
+
+
+def _parse_lanes(_: click.Context, __: click.Parameter,
+                 values: typing.Sequence[str]) -> typing.Sequence[typing.Tuple[str, int]]:
+    lanes = []
+    for value in values:
+        page_type, _sep, weight = value.partition('=')
+        if page_type not in acts_scraper.PAGE_TYPES or not weight.isdigit():
+            raise click.BadParameter('expected TYPE=WEIGHT with a known page type, got {}'.format(value))
+        lanes.append((page_type, int(weight)))
+    return tuple(lanes)
+
+
+def queue_options(command: typing.Callable) -> typing.Callable:
+    command = click.option('--lane', 'lanes', multiple=True, callback=_parse_lanes,
+                           help='TYPE=WEIGHT: queue this page type separately and give it WEIGHT shares of pulls. '
+                                'Other types share one lane of weight 1. Repeatable.')(command)
+    command = click.option('--queue-path', type=click.Path(dir_okay=False), default='gitlawca-queue.db',
+                           help='Database file for the sqlite queue.')(command)
+    return click.option('--queue', 'queue_backend', type=click.Choice(QUEUE_BACKENDS), default='pubsub',
+                        help='Where breadcrumbs are queued. The memory queue only lives as long as one run.')(command)
+
+
+def _get_lane_queue(options: QueueOptions, lane: str, pubsub_client: typing.Optional[pubsub.Client]) -> queues.Queue:
+    suffix = '_{}'.format(lane) if lane else ''
+    if options.backend == 'sqlite':
+        return queues.SqliteQueue(options.path, table='messages' + suffix)
+    elif options.backend == 'memory':
+        return queues.MemoryQueue()
+    return queues.PubSubQueue(pubsub_client, 'acts_requests' + suffix, 'acts_scraper' + suffix)
+
+
+def _get_queue(options: QueueOptions) -> queues.Queue:
+    pubsub_client = pubsub.Client() if options.backend == 'pubsub' else None
+    if not options.lanes:
+        return _get_lane_queue(options, queues.DEFAULT_LANE, pubsub_client)
+    weights = dict(options.lanes)
+    lanes = {lane: _get_lane_queue(options, lane, pubsub_client) for lane in weights}
+    lanes[queues.DEFAULT_LANE] = _get_lane_queue(options, queues.DEFAULT_LANE, pubsub_client)
+    return queues.LanedQueue(lanes, weights)
+
+
+def _get_dead_letters(options: QueueOptions) -> queues.Queue:
+    if options.backend == 'sqlite':
+        return queues.SqliteQueue(options.path, table='dead_letters')
+    elif options.backend == 'memory':
+        return queues.MemoryQueue()
+    return queues.PubSubQueue(pubsub.Client(), 'acts_dead_letters', 'acts_dead_letters')
+
+
+def _publish_trigger(queue: queues.Queue) -> None:
+    attrs = {'type': 'main_page', 'timestamp': datetime.datetime.now().isoformat()}
+    queue.publish(*wire.encode(acts_scraper.Breadcrumb(url='http://{}/eng/acts/'.format(ACTS_HOST), attrs=attrs)))
+
+
 @main.command()
-def trigger() -> None:
-    pubsub_client = pubsub.Client()
-    topic = pubsub_client.topic('acts_requests')
-    topic.publish('http://laws-lois.justice.gc.ca/eng/acts/'.encode('UTF-8'),
-                  type='main_page', timestamp=datetime.datetime.now().isoformat())
+@queue_options
+def trigger(queue_backend: str, queue_path: str, lanes: typing.Sequence[typing.Tuple[str, int]]) -> None:
+    _publish_trigger(_get_queue(QueueOptions(queue_backend, queue_path, lanes)))
+
+
+class SpiderOptions(typing.NamedTuple):
+    pool_size: int
+    timeout: float
+    cache_path: typing.Optional[str]
+    cache_size: int
+    prune_unchanged: typing.Sequence[str]
+    async_fetches: int
+    stream_items: bool
+    process_pool: bool
+    concurrency: int
+    rate: float
+    max_rate: float
+    rate_state: typing.Optional[str]
+    max_attempts: int
+    retry_delay: float
+    metrics_port: int
+    metrics_interval: float
+    profile: bool
+    profile_dir: str
+    store_batch: int
+    store_cache: int
+    warm_cache: bool
+    compress: bool
+
 
+def _get_fetcher(options: SpiderOptions) -> fetcher.Fetcher:
+    limiter = None
+    if options.rate > 0:
+        policy = ratelimit.RatePolicy(initial_rate=options.rate, max_rate=max(options.rate, options.max_rate))
+        limiter = ratelimit.RateLimiter(policy, state_path=options.rate_state)
+    http_fetcher = fetcher.HttpFetcher(pool_maxsize=options.pool_size,
+                                       timeout=options.timeout,
+                                       limiter=limiter)  # type: fetcher.Fetcher
+    if options.cache_path:
+        cache = http_cache.HttpCache(options.cache_path, max_bytes=options.cache_size * 1024 * 1024)
+        http_fetcher = http_cache.CachingFetcher(http_fetcher, cache)
+    return http_fetcher
 
-def _get_spider() -> spider.ActsSpider:
-    pubsub_client = pubsub.Client()
-    scraper = acts_scraper.ActsScraper()
+
+def _get_spider(options: SpiderOptions, queue: queues.Queue, dead_letters: queues.Queue) -> spider.ActsSpider:
+    sync_scraper = acts_scraper.ActsScraper(_get_fetcher(options),
+                                            prune_unchanged=options.prune_unchanged,
+                                            stream_items=options.stream_items,
+                                            parse_processes=os.cpu_count() if options.process_pool else 0)
+    scraper = sync_scraper  # type: typing.Union[acts_scraper.Scraper, acts_scraper.AsyncScraper]
+    if options.async_fetches:
+        scraper = async_scraper.AsyncActsScraper(sync_scraper, concurrency=options.async_fetches)
 
     datastore_client = datastore.Client()
-    stor = storage.get_storage()
-    acts_stor = acts_storage.ActsStorage(datastore_client, stor)
+    stor = storage.get_storage(storage.GZIP if options.compress else None)
+    acts_stor = acts_storage.ActsStorage(datastore_client, stor, batch_size=options.store_batch,
+                                         cache=acts_storage.KeyCache(size=options.store_cache))
+    if options.warm_cache:
+        click.echo('Cached {} existing act keys'.format(acts_stor.warm()))
+
+    gate = admission.Admission(allowed_types=sync_scraper.page_types, allowed_hosts=[ACTS_HOST], dedup_size=100000,
+                               allowed_schemes=['http', 'https'])
+    retry = retries.RetryPolicy(max_attempts=options.max_attempts, base_delay=options.retry_delay)
+    profiler = profiling.SamplingProfiler(options.profile_dir) if options.profile else None
+    return spider.ActsSpider(queue, scraper, acts_stor, gate, concurrency=options.concurrency, retry=retry,
+                             dead_letters=dead_letters, profiler=profiler)
+
+
+def _start_metrics(options: SpiderOptions) -> None:
+    if options.metrics_port:
+        metrics.serve(options.metrics_port + supervisor.worker_slot())
+    if options.metrics_interval > 0:
+        metrics.log_periodically(options.metrics_interval)
 
-    return spider.ActsSpider(pubsub_client, scraper, acts_stor)
+
+def _build_worker_spider(options: SpiderOptions, queue_options_: QueueOptions) -> spider.ActsSpider:
+    if options.cache_path:
+        # HttpCache keeps its LRU index in memory, so workers sharing a directory would evict each other's files.
+        options = options._replace(
+            cache_path=os.path.join(options.cache_path, 'worker-{}'.format(supervisor.worker_slot())))
+    _start_metrics(options)
+    return _get_spider(options, _get_queue(queue_options_), _get_dead_letters(queue_options_))
 
 
 @main.command()
+@queue_options
+@click.option('--seed', is_flag=True, help='Queue the acts main page before listening, as trigger does.')
 @click.option('--wait', type=bool, default=True)
 @click.option('--continuous', type=bool, default=True)
-def run(wait: bool, continuous: bool) -> bool:
-    spider_ = _get_spider()
+@click.option('--max-messages', type=int, default=1,
+              help='Most messages pulled from the queue at once. Continuous runs ramp up to this under backlog.')
+@click.option('--max-idle', type=float, default=30.0, help='Longest back-off between empty pulls, in seconds.')
+@click.option('--pool-size', type=int, default=10, help='Maximum open connections per host.')
+@click.option('--timeout', type=float, default=30.0, help='HTTP timeout in seconds.')
+@click.option('--http-cache', 'cache_path', type=click.Path(file_okay=False), default=None,
+              help='Directory for the conditional-GET page cache.')
+@click.option('--http-cache-size', 'cache_size', type=int, default=512, help='Maximum page cache size in MB.')
+@click.option('--prune-unchanged', multiple=True,
+              help='Page type whose children are not expanded when the page is unchanged. Repeatable.')
+@click.option('--async-fetches', type=int, default=0,
+              help='Scrape each pulled batch asynchronously with this many requests in flight.')
+@click.option('--stream-items', is_flag=True, help='Stream act bodies to storage instead of parsing whole pages.')
+@click.option('--process-pool', is_flag=True,
+              help='Parse pages in one process per CPU core. Needs --concurrency or --async-fetches.')
+@click.option('--concurrency', type=int, default=1,
+              help='Messages processed in parallel. Raises --max-messages to at least this, so that pulls can grow '
+                   'large enough to keep every thread busy.')
+@click.option('--rate', type=float, default=0.0,
+              help='Starting requests per second per host, adjusted to latency and throttling. 0 disables limiting.')
+@click.option('--max-rate', type=float, default=20.0, help='Highest requests per second per host.')
+@click.option('--rate-state', type=click.Path(dir_okay=False), default=None,
+              help='File that shares the rate limit between processes. '
+                   'With --workers, defaults to a file removed after the run.')
+@click.option('--max-attempts', type=int, default=5,
+              help='Attempts at a failing message before it is moved to the dead-letter queue.')
+@click.option('--retry-delay', type=float, default=10.0,
+              help='Seconds before the first retry of a failed message, doubling with each attempt.')
+@click.option('--metrics-port', type=int, default=0,
+              help='Serve Prometheus metrics on this local port, plus the worker index with --workers. 0 disables.')
+@click.option('--metrics-interval', type=float, default=60.0,
+              help='Seconds between metrics summary log lines. 0 disables.')
+@click.option('--profile', is_flag=True,
+              help='Sample stacks of pages being processed and write profiles by page type every minute and on exit. '
+                   'With --process-pool, parse samples only show the wait for the pool.')
+@click.option('--profile-dir', type=click.Path(file_okay=False), default='profiles',
+              help='Directory for collapsed-stack and pstats profiles.')
+@click.option('--store-batch', type=int, default=1,
+              help='Act versions written per datastore lookup and commit. Batches are flushed before acking.')
+@click.option('--store-cache', type=int, default=100000,
+              help='Act and version keys remembered to skip datastore lookups. 0 disables the cache.')
+@click.option('--warm-cache/--no-warm-cache', default=False,
+              help='Load existing act keys into the cache at startup, for re-crawls.')
+@click.option('--compress/--no-compress', default=True,
+              help='Store raw act bodies gzip-compressed. Downloads decompress either way.')
+@click.option('--workers', type=int, default=1,
+              help='Spider processes sharing the queue, restarted if they crash. Implies continuous.')
+def run(queue_backend: str, queue_path: str,  # pylint: disable=too-many-arguments,too-many-locals
+        lanes: typing.Sequence[typing.Tuple[str, int]], seed: bool, wait: bool, continuous: bool,
+        max_messages: int, max_idle: float, workers: int,
+        pool_size: int, timeout: float, cache_path: typing.Optional[str], cache_size: int,
+        prune_unchanged: typing.Sequence[str], async_fetches: int, stream_items: bool, process_pool: bool,
+        concurrency: int, rate: float, max_rate: float, rate_state: typing.Optional[str], max_attempts: int,
+        retry_delay: float, metrics_port: int, metrics_interval: float, profile: bool, profile_dir: str,
+        store_batch: int, store_cache: int, warm_cache: bool, compress: bool) -> bool:
+    options = SpiderOptions(pool_size=pool_size, timeout=timeout, cache_path=cache_path, cache_size=cache_size,
+                            prune_unchanged=prune_unchanged, async_fetches=async_fetches, stream_items=stream_items,
+                            process_pool=process_pool, concurrency=concurrency, rate=rate, max_rate=max_rate,
+                            rate_state=rate_state, max_attempts=max_attempts, retry_delay=retry_delay,
+                            metrics_port=metrics_port, metrics_interval=metrics_interval, profile=profile,
+                            profile_dir=profile_dir, store_batch=store_batch, store_cache=store_cache,
+                            warm_cache=warm_cache, compress=compress)
+    queue_options_ = QueueOptions(queue_backend, queue_path, lanes)
+    if workers > 1 and queue_backend == 'memory':
+        raise click.BadParameter('the memory queue cannot be shared between processes', param_hint='--workers')
+    if options.process_pool and options.concurrency <= 1 and not options.async_fetches:
+        # Each page waits for its own parse, so with one page in flight the pool only adds pickling overhead.
+        raise click.BadParameter('parses only overlap with --concurrency or --async-fetches',
+                                 param_hint='--process-pool')
+    if workers > 1:
+        options = options._replace(cache_size=max(1, options.cache_size // workers))
+
+    queue = _get_queue(queue_options_)
+    if seed:
+        _publish_trigger(queue)
+    max_messages = max(max_messages, options.concurrency)
+    if workers > 1:
+        rate_state = None
+        if not options.rate_state:
+            # Unique to this run, so concurrent runs and stale state from earlier ones do not share buckets.
+            handle, rate_state = tempfile.mkstemp(prefix='gitlawca-rate-', suffix='.json')
+            os.close(handle)
+            options = options._replace(rate_state=rate_state)
+        try:
+            make_spider = functools.partial(_build_worker_spider, options, queue_options_)
+            supervisor.Supervisor(make_spider, (wait, max_messages, max_idle), workers=workers).run()
+        finally:
+            if rate_state is not None:
+                os.remove(rate_state)
+        return True
+
+    _start_metrics(options)
+    spider_ = _get_spider(options, queue, _get_dead_letters(queue_options_))
     if continuous:
-        spider_.keep_listening(wait)
+        spider_.keep_listening(wait, max_messages, max_idle)
         result = True
     else:
-        result = spider_.listen(wait)
+        result = spider_.listen(wait, max_messages)
     return result
+
+
+@main.command()
+@queue_options
+@click.option('--refresh-timestamp', is_flag=True,
+              help='Give replayed breadcrumbs the current time so messages from an old crawl are not dropped as stale.')
+def replay(queue_backend: str, queue_path: str, lanes: typing.Sequence[typing.Tuple[str, int]],
+           refresh_timestamp: bool) -> None:
+    queue_options_ = QueueOptions(queue_backend, queue_path, lanes)
+    dead_letters = _get_dead_letters(queue_options_)
+    queue = _get_queue(queue_options_)
+    timestamp = datetime.datetime.now().isoformat()
+
+    replayed = 0
+    pulled = dead_letters.pull(max_messages=publisher.MAX_REQUEST_MESSAGES, wait=False)
+    while pulled:
+        messages = []  # type: typing.List[queues.OutgoingMessage]
+        for msg in pulled:
+            data, attrs = msg.data, retries.replay_attrs(msg.attributes)
+            if refresh_timestamp:
+                breadcrumb = wire.decode(data, attrs)
+                breadcrumb.attrs['timestamp'] = timestamp
+                data, attrs = wire.encode(breadcrumb)
+            messages.append((data, attrs))
+        queue.publish_batch(messages)
+        dead_letters.acknowledge([msg.ack_id for msg in pulled])
+        replayed += len(pulled)
+        pulled = dead_letters.pull(max_messages=publisher.MAX_REQUEST_MESSAGES, wait=False)
+    click.echo('Replayed {} dead letters'.format(replayed))
@@ -0,0 +1,73 @@
+import abc
+import time
+import typing
+from urllib import parse
+import requests
+from requests import adapters
+from requests_file import FileAdapter
+from scraper import ratelimit
+
+
+class Fetcher(metaclass=abc.ABCMeta):
+
+    @abc.abstractmethod
+    def get(self, url: str, headers: typing.Optional[typing.Dict[str, str]] = None,
+            stream: bool = False) -> requests.Response:
+        pass
+
+    def close(self) -> None:
+        pass
+
+
+def _checked(response: requests.Response) -> requests.Response:
+    # Streamed responses hold a pooled connection until closed, so an error response is closed before raising.
+    if response.status_code >= 400:
+        response.close()
+        response.raise_for_status()
+    return response
+
+
+class HttpFetcher(Fetcher):
+    # pool_connections is the number of per-host pools kept alive, pool_maxsize the connection limit per host.
+    # The pool blocks instead of opening overflow connections, so pool_maxsize is a hard limit across threads.
+    # With a limiter, every request to a remote host waits for a token and reports its latency and status back,
+    # and the adapter does not retry on its own, since its retries would bypass both. Error statuses are raised as
+    # HTTPError once reported, so the spider retries the message rather than parsing an error page.
+
+    def __init__(self, pool_connections: int = 4,  # pylint: disable=too-many-arguments
+                 pool_maxsize: int = 10,
+                 timeout: float = 30.0,
+                 max_retries: int = 3,
+                 limiter: typing.Optional[ratelimit.RateLimiter] = None) -> None:
+        if limiter is not None:
+            max_retries = 0
+        adapter = adapters.HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize,
+                                       max_retries=max_retries, pool_block=True)
+        sess = requests.Session()
+        sess.mount('http://', adapter)
+        sess.mount('https://', adapter)
+        sess.mount('file://', FileAdapter())
+
+        self.__session = sess
+        self.__timeout = timeout
+        self.__limiter = limiter
+
+    def get(self, url: str, headers: typing.Optional[typing.Dict[str, str]] = None,
+            stream: bool = False) -> requests.Response:
+        host = parse.urlsplit(url).netloc
+        if self.__limiter is None or not host:
+            return _checked(self.__session.get(url, headers=headers, stream=stream, timeout=self.__timeout))
+
+        self.__limiter.acquire(host)
+        started = time.monotonic()
+        try:
+            response = self.__session.get(url, headers=headers, stream=stream, timeout=self.__timeout)
+        except requests.RequestException:
+            self.__limiter.record(host, time.monotonic() - started, 0)
+            raise
+        self.__limiter.record(host, time.monotonic() - started, response.status_code,
+                              response.headers.get('Retry-After'))
+        return _checked(response)
+
+    def close(self) -> None:
+        self.__session.close()
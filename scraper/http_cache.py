@@ -0,0 +1,213 @@
+import collections
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import typing
+import requests
+from scraper import fetcher
+
+CACHE_HEADER = 'X-Gitlawca-Cache'
+PART_SUFFIX = '.part'
+
+
+class CacheEntry(typing.NamedTuple):
+    url: str
+    etag: str
+    last_modified: str
+    size: int
+
+
+def is_cached(response: requests.Response) -> bool:
+    return response.headers.get(CACHE_HEADER) == 'HIT'
+
+
+class HttpCache:
+    # Bodies and validators live on disk, one pair of files per URL. Recency is kept in memory and mirrored to
+    # the metadata file's mtime, so LRU order survives restarts. The index is private to one process, so each
+    # process needs its own directory; files that disappear anyway are treated as misses.
+
+    def __init__(self, path: str, max_bytes: int = 512 * 1024 * 1024) -> None:
+        self.__path = path
+        self.__max_bytes = max_bytes
+        self.__lock = threading.Lock()
+        self.__entries = collections.OrderedDict()  # type: typing.MutableMapping[str, CacheEntry]
+        self.__size = 0
+        self.hits = 0
+        self.misses = 0
+
+        if not os.path.exists(path):
+            os.makedirs(path)
+        self.__load()
+
+    @staticmethod
+    def __key(url: str) -> str:
+        return hashlib.sha1(url.encode('utf-8')).hexdigest()
+
+    def __meta_path(self, key: str) -> str:
+        return os.path.join(self.__path, key + '.json')
+
+    def __body_path(self, key: str) -> str:
+        return os.path.join(self.__path, key + '.body')
+
+    def __load(self) -> None:
+        found = []
+        for filename in os.listdir(self.__path):
+            if filename.endswith(PART_SUFFIX):
+                # A streamed body that was not read to the end before the process exited.
+                os.remove(os.path.join(self.__path, filename))
+                continue
+            if not filename.endswith('.json'):
+                continue
+            key = filename[:-len('.json')]
+            meta_path = self.__meta_path(key)
+            if not os.path.exists(self.__body_path(key)):
+                os.remove(meta_path)
+                continue
+            with open(meta_path) as f:
+                entry = CacheEntry(**json.load(f))
+            found.append((os.path.getmtime(meta_path), key, entry))
+
+        for _, key, entry in sorted(found):
+            self.__entries[key] = entry
+            self.__size += entry.size
+        self.__evict()
+
+    def __remove(self, key: str) -> None:
+        entry = self.__entries.pop(key)
+        self.__size -= entry.size
+        for path in (self.__meta_path(key), self.__body_path(key)):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def __evict(self) -> None:
+        while self.__size > self.__max_bytes and self.__entries:
+            oldest = next(iter(self.__entries))
+            self.__remove(oldest)
+
+    def lookup(self, url: str) -> typing.Optional[CacheEntry]:
+        key = self.__key(url)
+        with self.__lock:
+            return self.__entries.get(key)
+
+    def validators(self, url: str) -> typing.Dict[str, str]:
+        entry = self.lookup(url)
+        headers = {}  # type: typing.Dict[str, str]
+        if entry:
+            if entry.etag:
+                headers['If-None-Match'] = entry.etag
+            if entry.last_modified:
+                headers['If-Modified-Since'] = entry.last_modified
+        return headers
+
+    def read(self, url: str) -> typing.Optional[bytes]:
+        key = self.__key(url)
+        with self.__lock:
+            if key not in self.__entries:
+                return None
+            try:
+                os.utime(self.__meta_path(key))
+                with open(self.__body_path(key), 'rb') as f:
+                    content = f.read()
+            except FileNotFoundError:
+                self.__remove(key)
+                return None
+            self.__entries.move_to_end(key)  # type: ignore
+            self.hits += 1
+            return content
+
+    def record_miss(self) -> None:
+        with self.__lock:
+            self.misses += 1
+
+    def store(self, url: str, response: requests.Response, stream: bool = False) -> None:
+        etag = response.headers.get('ETag', '')
+        last_modified = response.headers.get('Last-Modified', '')
+        if not etag and not last_modified:
+            return
+
+        if stream:
+            # Reading a streamed body here would buffer all of it, so it is cached as the caller reads it.
+            self.__tee(url, etag, last_modified, response)
+            return
+
+        with tempfile.NamedTemporaryFile(dir=self.__path, suffix=PART_SUFFIX, delete=False) as f:
+            f.write(response.content)
+        self.__add(CacheEntry(url=url, etag=etag, last_modified=last_modified, size=len(response.content)), f.name)
+
+    def __tee(self, url: str, etag: str, last_modified: str, response: requests.Response) -> None:
+        iter_content = response.iter_content
+
+        def teed(chunk_size: int = 1, decode_unicode: bool = False) -> typing.Iterator[bytes]:
+            chunks = iter_content(chunk_size, decode_unicode)
+            if decode_unicode:
+                return chunks
+            return self.__copy_chunks(url, etag, last_modified, chunks)
+
+        response.iter_content = teed  # type: ignore
+
+    def __copy_chunks(self, url: str, etag: str, last_modified: str,
+                      chunks: typing.Iterator[bytes]) -> typing.Iterator[bytes]:
+        # The body is only cached once it has been read to the end.
+        size = 0
+        complete = False
+        part = tempfile.NamedTemporaryFile(dir=self.__path, suffix=PART_SUFFIX, delete=False)
+        try:
+            with part:
+                for chunk in chunks:
+                    part.write(chunk)
+                    size += len(chunk)
+                    yield chunk
+            complete = True
+        finally:
+            if not complete:
+                os.remove(part.name)
+        self.__add(CacheEntry(url=url, etag=etag, last_modified=last_modified, size=size), part.name)
+
+    def __add(self, entry: CacheEntry, body_path: str) -> None:
+        key = self.__key(entry.url)
+        with self.__lock:
+            if key in self.__entries:
+                self.__remove(key)
+            os.replace(body_path, self.__body_path(key))
+            with open(self.__meta_path(key), 'w') as f:
+                json.dump(entry._asdict(), f)
+            self.__entries[key] = entry
+            self.__size += entry.size
+            self.__evict()
+
+    def stats(self) -> typing.Dict[str, int]:
+        with self.__lock:
+            return {'hits': self.hits, 'misses': self.misses, 'entries': len(self.__entries), 'bytes': self.__size}
+
+
+class CachingFetcher(fetcher.Fetcher):
+
+    def __init__(self, http_fetcher: fetcher.Fetcher, cache: HttpCache) -> None:
+        self.__fetcher = http_fetcher
+        self.__cache = cache
+
+    def get(self, url: str, headers: typing.Optional[typing.Dict[str, str]] = None,
+            stream: bool = False) -> requests.Response:
+        request_headers = self.__cache.validators(url)
+        request_headers.update(headers or {})
+        response = self.__fetcher.get(url, headers=request_headers, stream=stream)
+
+        if response.status_code == 304:
+            content = self.__cache.read(url)
+            if content is not None:
+                response.status_code = 200
+                response._content = content  # pylint: disable=protected-access
+                response._content_consumed = True  # pylint: disable=protected-access
+                response.headers[CACHE_HEADER] = 'HIT'
+                return response
+            response = self.__fetcher.get(url, headers=headers, stream=stream)
+
+        self.__cache.record_miss()
+        if response.status_code == 200:
+            self.__cache.store(url, response, stream=stream)
+        return response
+
+    def close(self) -> None:
+        self.__fetcher.close()
@@ -0,0 +1,181 @@
+import bisect
+import contextlib
+import http.server
+import socketserver
+import threading
+import time
+import typing
+from scraper import logger
+
+LOG = logger.LOG
+
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0, 1800.0, 3600.0)
+BYTES_BUCKETS = tuple(float(2 ** power) for power in range(10, 28, 2))
+
+# Metric names. Stage timings are labelled by stage and page type, the per-message counters by page type.
+STAGE_SECONDS = 'gitlawca_stage_seconds'
+QUEUE_LAG_SECONDS = 'gitlawca_queue_lag_seconds'
+FETCHED_BYTES = 'gitlawca_fetched_bytes_total'
+ITEMS_STORED = 'gitlawca_items_stored_total'
+RETRIES = 'gitlawca_retries_total'
+DEAD_LETTERS = 'gitlawca_dead_letters_total'
+DEDUPLICATED_BLOBS = 'gitlawca_deduplicated_blobs_total'
+
+Labels = typing.Tuple[typing.Tuple[str, str], ...]  # pylint: disable=invalid-name
+Key = typing.Tuple[str, Labels]  # pylint: disable=invalid-name
+
+
+class Histogram:
+
+    def __init__(self, buckets: typing.Sequence[float]) -> None:
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+
+def _labels(labels: typing.Mapping[str, str]) -> Labels:
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def _format_labels(labels: Labels, extra: Labels = ()) -> str:
+    pairs = labels + extra
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(key, value.replace('\\', '\\\\').replace('"', '\\"'))
+                          for key, value in pairs) + '}'
+
+
+class Registry:
+    # Counters and histograms keyed by name and labels. Updates take one lock and touch a few integers, so they
+    # are cheap enough for every message. Histograms named *_bytes use byte buckets, all others seconds.
+
+    def __init__(self) -> None:
+        self.__lock = threading.Lock()
+        self.__counters = {}  # type: typing.Dict[Key, float]
+        self.__histograms = {}  # type: typing.Dict[Key, Histogram]
+
+    def inc(self, name: str, value: float = 1.0, **labels: str) -> None:
+        key = (name, _labels(labels))
+        with self.__lock:
+            self.__counters[key] = self.__counters.get(key, 0.0) + value
+
+    def observe(self, name: str, value: float, **labels: str) -> None:
+        key = (name, _labels(labels))
+        with self.__lock:
+            histogram = self.__histograms.get(key)
+            if histogram is None:
+                histogram = Histogram(BYTES_BUCKETS if name.endswith('_bytes') else SECONDS_BUCKETS)
+                self.__histograms[key] = histogram
+            histogram.observe(value)
+
+    @contextlib.contextmanager
+    def timer(self, name: str, **labels: str) -> typing.Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def counter(self, name: str, **labels: str) -> float:
+        with self.__lock:
+            return self.__counters.get((name, _labels(labels)), 0.0)
+
+    def histogram(self, name: str, **labels: str) -> typing.Tuple[int, float]:
+        with self.__lock:
+            histogram = self.__histograms.get((name, _labels(labels)))
+            return (histogram.count, histogram.sum) if histogram else (0, 0.0)
+
+    def render(self) -> str:
+        # Prometheus text exposition format.
+        lines = []  # type: typing.List[str]
+        with self.__lock:
+            counter_names = set()
+            for (name, labels), value in sorted(self.__counters.items()):
+                if name not in counter_names:
+                    counter_names.add(name)
+                    lines.append('# TYPE {} counter'.format(name))
+                lines.append('{}{} {}'.format(name, _format_labels(labels), value))
+
+            histogram_names = set()
+            for (name, labels), histogram in sorted(self.__histograms.items(), key=lambda item: item[0]):
+                if name not in histogram_names:
+                    histogram_names.add(name)
+                    lines.append('# TYPE {} histogram'.format(name))
+                cumulative = 0
+                for bound, count in zip(histogram.buckets + (float('inf'),), histogram.counts):
+                    cumulative += count
+                    bound_label = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append('{}_bucket{} {}'.format(name, _format_labels(labels, (('le', bound_label),)),
+                                                         cumulative))
+                lines.append('{}_sum{} {}'.format(name, _format_labels(labels), histogram.sum))
+                lines.append('{}_count{} {}'.format(name, _format_labels(labels), histogram.count))
+        return '\n'.join(lines) + '\n'
+
+    def summary(self) -> str:
+        parts = []  # type: typing.List[str]
+        with self.__lock:
+            for (name, labels), histogram in sorted(self.__histograms.items(), key=lambda item: item[0]):
+                parts.append('{}{} n={} avg={:.3f}'.format(name, _format_labels(labels), histogram.count,
+                                                           histogram.sum / histogram.count))
+            for (name, labels), value in sorted(self.__counters.items()):
+                parts.append('{}{}={:g}'.format(name, _format_labels(labels), value))
+        return '; '.join(parts)
+
+
+REGISTRY = Registry()
+inc = REGISTRY.inc  # pylint: disable=invalid-name
+observe = REGISTRY.observe  # pylint: disable=invalid-name
+timer = REGISTRY.timer  # pylint: disable=invalid-name
+
+
+def counted(chunks: typing.Iterable[bytes], name: str, **labels: str) -> typing.Iterator[bytes]:
+    for chunk in chunks:
+        REGISTRY.inc(name, len(chunk), **labels)
+        yield chunk
+
+
+class _MetricsHandler(http.server.BaseHTTPRequestHandler):
+    registry = REGISTRY
+
+    def do_GET(self) -> None:  # pylint: disable=invalid-name
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = self.registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *_: typing.Any) -> None:
+        pass
+
+
+class _ThreadingHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+def serve(port: int, host: str = '127.0.0.1') -> http.server.HTTPServer:
+    server = _ThreadingHTTPServer((host, port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, name='metrics-server', daemon=True).start()
+    LOG.info('Serving metrics on http://%s:%s/metrics', host, server.server_address[1])
+    return server
+
+
+def log_periodically(interval: float) -> threading.Event:
+    # Logs the summary line every `interval` seconds until the returned event is set.
+    stop = threading.Event()
+
+    def run() -> None:
+        while not stop.wait(interval):
+            LOG.info('Metrics: %s', REGISTRY.summary())
+
+    threading.Thread(target=run, name='metrics-log', daemon=True).start()
+    return stop
@@ -0,0 +1,24 @@
+class AdaptivePoller:
+    # Picks the size of the next pull and how long to sleep before it. A full pull means there is a backlog, so
+    # the batch doubles up to `max_messages`; a mostly empty one halves it. Consecutive empty pulls back off
+    # exponentially from `min_idle` to `max_idle` seconds, and any message resets the delay to zero.
+
+    def __init__(self, max_messages: int = 100, min_idle: float = 0.1, max_idle: float = 30.0) -> None:
+        self.__max_messages = max(1, max_messages)
+        self.__min_idle = min_idle
+        self.__max_idle = max_idle
+        self.batch_size = 1
+        self.idle_delay = 0.0
+
+    def record(self, received: int) -> float:
+        if not received:
+            self.batch_size = 1
+            self.idle_delay = min(self.__max_idle, max(self.__min_idle, self.idle_delay * 2))
+            return self.idle_delay
+
+        self.idle_delay = 0.0
+        if received >= self.batch_size:
+            self.batch_size = min(self.__max_messages, self.batch_size * 2)
+        elif received * 2 < self.batch_size:
+            self.batch_size = max(1, self.batch_size // 2)
+        return 0.0
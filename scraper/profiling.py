@@ -0,0 +1,145 @@
+import collections
+import marshal
+import os
+import sys
+import threading
+import typing
+from scraper import logger
+
+LOG = logger.LOG
+
+CodeKey = typing.Tuple[str, int, str]  # pylint: disable=invalid-name
+Stack = typing.Tuple[CodeKey, ...]  # pylint: disable=invalid-name
+
+# Breadcrumb type each thread is working on, by thread ident. Only tagged threads are sampled, so idle pools and
+# the queue pull loop do not drown out the pages being processed.
+_ACTIVE = {}  # type: typing.Dict[int, str]
+
+
+class tagged:  # pylint: disable=invalid-name
+    # Marks the current thread as working on `page_type` for the duration of the block. Costs two dict operations,
+    # so it stays in the hot path whether or not a profiler is running.
+
+    def __init__(self, page_type: str) -> None:
+        self.__page_type = page_type
+        self.__previous = None  # type: typing.Optional[str]
+
+    def __enter__(self) -> None:
+        ident = threading.get_ident()
+        self.__previous = _ACTIVE.get(ident)
+        _ACTIVE[ident] = self.__page_type
+
+    def __exit__(self, *_: typing.Any) -> None:
+        ident = threading.get_ident()
+        if self.__previous is None:
+            _ACTIVE.pop(ident, None)
+        else:
+            _ACTIVE[ident] = self.__previous
+
+
+def _code_key(frame: typing.Any) -> CodeKey:
+    code = frame.f_code
+    return code.co_filename, code.co_firstlineno, code.co_name
+
+
+class SamplingProfiler:
+    # Statistical profiler: a background thread records the stack of every tagged thread each `interval` seconds,
+    # which keeps the overhead to a small fraction of one core regardless of how busy the spider is. Every
+    # `dump_interval` seconds and on stop it writes the samples so far to `output_dir`, as collapsed stacks rooted
+    # at the breadcrumb type (for flamegraph.pl or speedscope) and as one pstats file per type.
+
+    def __init__(self, output_dir: str, interval: float = 0.01, dump_interval: float = 60.0) -> None:
+        self.__output_dir = output_dir
+        self.__interval = interval
+        self.__dump_interval = dump_interval
+        self.__lock = threading.Lock()
+        self.__samples = collections.Counter()  # type: typing.Counter[typing.Tuple[str, Stack]]
+        self.__stop = threading.Event()
+        self.__thread = None  # type: typing.Optional[threading.Thread]
+
+    def sample(self) -> None:
+        own_ident = threading.get_ident()
+        frames = sys._current_frames()  # pylint: disable=protected-access
+        for ident, page_type in list(_ACTIVE.items()):
+            frame = frames.get(ident)
+            if frame is None or ident == own_ident:
+                continue
+            stack = []  # type: typing.List[CodeKey]
+            while frame is not None:
+                stack.append(_code_key(frame))
+                frame = frame.f_back
+            stack.reverse()
+            with self.__lock:
+                self.__samples[(page_type, tuple(stack))] += 1
+
+    def __run(self) -> None:
+        next_dump = self.__dump_interval
+        elapsed = 0.0
+        while not self.__stop.wait(self.__interval):
+            self.sample()
+            elapsed += self.__interval
+            if elapsed >= next_dump:
+                self.dump()
+                next_dump += self.__dump_interval
+
+    def start(self) -> None:
+        if self.__thread is None:
+            os.makedirs(self.__output_dir, exist_ok=True)
+            self.__stop.clear()
+            self.__thread = threading.Thread(target=self.__run, name='sampling-profiler', daemon=True)
+            self.__thread.start()
+
+    def stop(self) -> None:
+        if self.__thread is not None:
+            self.__stop.set()
+            self.__thread.join()
+            self.__thread = None
+            self.dump()
+
+    def collapsed(self) -> typing.List[str]:
+        with self.__lock:
+            samples = list(self.__samples.items())
+        lines = []
+        for (page_type, stack), count in sorted(samples):
+            frames = [page_type or 'untyped'] + ['{} ({}:{})'.format(name, os.path.basename(filename), line)
+                                                 for filename, line, name in stack]
+            lines.append('{} {}'.format(';'.join(frame.replace(';', ':') for frame in frames), count))
+        return lines
+
+    def pstats(self, page_type: str) -> typing.Dict[CodeKey, typing.Any]:
+        # Builds the dict pstats.Stats loads: per function (calls, primitive calls, self time, cumulative time,
+        # callers), with sample counts standing in for calls and samples times interval for time.
+        with self.__lock:
+            samples = [(stack, count) for (sample_type, stack), count in self.__samples.items()
+                       if sample_type == page_type]
+        own = collections.Counter()  # type: typing.Counter[CodeKey]
+        inclusive = collections.Counter()  # type: typing.Counter[CodeKey]
+        callers = collections.defaultdict(collections.Counter)  # type: typing.Dict[CodeKey, typing.Counter[CodeKey]]
+        for stack, count in samples:
+            own[stack[-1]] += count
+            for key in set(stack):
+                inclusive[key] += count
+            for caller, callee in set(zip(stack, stack[1:])):
+                callers[callee][caller] += count
+
+        stats = {}
+        for key, count in inclusive.items():
+            key_callers = {caller: (calls, calls, 0.0, calls * self.__interval)
+                           for caller, calls in callers[key].items()}
+            stats[key] = (count, count, own[key] * self.__interval, count * self.__interval, key_callers)
+        return stats
+
+    def __write(self, path: str, data: bytes) -> None:
+        temp_path = path + '.tmp'
+        with open(temp_path, 'wb') as handle:
+            handle.write(data)
+        os.replace(temp_path, path)
+
+    def dump(self) -> None:
+        with self.__lock:
+            page_types = {page_type for page_type, _ in self.__samples}
+        prefix = os.path.join(self.__output_dir, 'gitlawca-{}'.format(os.getpid()))
+        self.__write(prefix + '.collapsed', '\n'.join(self.collapsed()).encode('utf-8'))
+        for page_type in page_types:
+            self.__write('{}-{}.pstats'.format(prefix, page_type or 'untyped'), marshal.dumps(self.pstats(page_type)))
+        LOG.info('Wrote profile for %s to %s.*', ', '.join(sorted(page_types)) or 'no samples', prefix)
@@ -0,0 +1,65 @@
+import collections
+import threading
+import time
+import typing
+from scraper import metrics
+from scraper import queues
+
+MAX_REQUEST_MESSAGES = 1000
+MAX_REQUEST_BYTES = 5 * 1024 * 1024
+
+
+class BatchPublisher:  # pylint: disable=too-many-instance-attributes
+    # Buffers messages across many processed pages and publishes them in one batch once `max_count` messages or
+    # `max_bytes` are pending, or the oldest has waited `max_latency` seconds. Callers must flush before acking the
+    # messages whose output is still buffered.
+
+    def __init__(self, queue: queues.Queue, max_count: int = MAX_REQUEST_MESSAGES,
+                 max_bytes: int = MAX_REQUEST_BYTES, max_latency: float = 1.0) -> None:
+        self.__queue = queue
+        self.__max_count = max_count
+        self.__max_bytes = max_bytes
+        self.__max_latency = max_latency
+
+        self.__lock = threading.RLock()
+        self.__pending = []  # type: typing.List[typing.Tuple[bytes, typing.Dict[str, str]]]
+        self.__pending_bytes = 0
+        self.__pending_since = 0.0
+        self.counters = collections.Counter()  # type: typing.Counter[str]
+
+    def publish(self, data: bytes, attrs: typing.Dict[str, str]) -> None:
+        size = len(data) + sum(len(key) + len(value) for key, value in attrs.items())
+        with self.__lock:
+            if self.__pending and self.__pending_bytes + size > self.__max_bytes:
+                self.flush()
+            if not self.__pending:
+                self.__pending_since = time.monotonic()
+            self.__pending.append((data, attrs))
+            self.__pending_bytes += size
+            if len(self.__pending) >= self.__max_count:
+                self.flush()
+            else:
+                self.flush_if_due()
+
+    def flush(self) -> None:
+        with self.__lock:
+            if not self.__pending:
+                return
+            with metrics.timer(metrics.STAGE_SECONDS, stage='publish', type=''):
+                self.__queue.publish_batch(self.__pending)
+            self.counters['publish_rpcs'] += 1
+            self.counters['published'] += len(self.__pending)
+            self.counters['published_bytes'] += self.__pending_bytes
+            self.__pending = []
+            self.__pending_bytes = 0
+
+    def flush_if_due(self) -> None:
+        with self.__lock:
+            if self.__pending and time.monotonic() - self.__pending_since >= self.__max_latency:
+                self.flush()
+
+    def stats(self) -> typing.Dict[str, int]:
+        with self.__lock:
+            stats = dict(self.counters)
+            stats['pending'] = len(self.__pending)
+            return stats
@@ -0,0 +1,317 @@
+import abc
+import collections
+import datetime
+import itertools
+import json
+import sqlite3
+import threading
+import time
+import typing
+import uuid
+from google.cloud import pubsub
+from scraper import wire
+
+WAIT_SECONDS = 10.0
+POLL_SECONDS = 0.1
+
+
+class Message(typing.NamedTuple):
+    ack_id: str
+    message_id: str
+    data: bytes
+    attributes: typing.Dict[str, str]
+    publish_time: float = 0.0
+
+
+OutgoingMessage = typing.Tuple[bytes, typing.Dict[str, str]]  # pylint: disable=invalid-name
+
+
+class Queue(metaclass=abc.ABCMeta):
+
+    @abc.abstractmethod
+    def publish_batch(self, messages: typing.Sequence[OutgoingMessage]) -> None:
+        pass
+
+    @abc.abstractmethod
+    def pull(self, max_messages: int = 1, wait: bool = True) -> typing.List[Message]:
+        pass
+
+    @abc.abstractmethod
+    def acknowledge(self, ack_ids: typing.Sequence[str]) -> None:
+        pass
+
+    @abc.abstractmethod
+    def modify_ack_deadline(self, ack_ids: typing.Sequence[str], ack_deadline: int) -> None:
+        pass
+
+    def publish(self, data: bytes, attrs: typing.Dict[str, str]) -> None:
+        self.publish_batch([(data, attrs)])
+
+
+def _rfc3339_seconds(stamp: typing.Optional[str]) -> float:
+    # Pub/Sub publish times look like 2017-05-01T12:30:15.123456789Z; datetime only parses microseconds.
+    if not stamp:
+        return 0.0
+    seconds, _, fraction = stamp.rstrip('Z').partition('.')
+    moment = datetime.datetime.strptime(seconds, '%Y-%m-%dT%H:%M:%S').replace(tzinfo=datetime.timezone.utc)
+    return moment.timestamp() + float('0.' + (fraction or '0'))
+
+
+class PubSubQueue(Queue):
+
+    def __init__(self, pubsub_client: pubsub.Client, topic_name: str = 'acts_requests',
+                 subscription_name: str = 'acts_scraper') -> None:
+        topic = pubsub_client.topic(topic_name)
+        if not topic.exists():
+            topic.create()
+        self.__topic = topic  # type: pubsub.Topic
+
+        sub = topic.subscription(subscription_name)
+        if not sub.exists():
+            sub.create()
+        self.__sub = sub
+
+    def publish_batch(self, messages: typing.Sequence[OutgoingMessage]) -> None:
+        with self.__topic.batch() as batch:
+            for data, attrs in messages:
+                batch.publish(data, **attrs)
+
+    def pull(self, max_messages: int = 1, wait: bool = True) -> typing.List[Message]:
+        pulled = self.__sub.pull(return_immediately=not wait, max_messages=max_messages)
+        return [Message(ack_id=ack_id, message_id=msg.message_id, data=msg.data, attributes=dict(msg.attributes),
+                        publish_time=_rfc3339_seconds(msg.service_timestamp))
+                for ack_id, msg in pulled]
+
+    def acknowledge(self, ack_ids: typing.Sequence[str]) -> None:
+        self.__sub.acknowledge(list(ack_ids))
+
+    def modify_ack_deadline(self, ack_ids: typing.Sequence[str], ack_deadline: int) -> None:
+        self.__sub.modify_ack_deadline(list(ack_ids), ack_deadline)
+
+
+class MemoryQueue(Queue):
+    # Single-process queue with Pub/Sub's delivery semantics: pulled messages are leased for `ack_deadline` seconds
+    # and handed out again if they are not acked in time.
+
+    def __init__(self, ack_deadline: int = 60) -> None:
+        self.__ack_deadline = ack_deadline
+        self.__ready = collections.deque()  # type: typing.Deque[Message]
+        self.__leased = {}  # type: typing.Dict[str, typing.Tuple[float, Message]]
+        self.__ids = itertools.count()
+        self.__condition = threading.Condition()
+
+    def publish_batch(self, messages: typing.Sequence[OutgoingMessage]) -> None:
+        with self.__condition:
+            for data, attrs in messages:
+                message_id = str(next(self.__ids))
+                self.__ready.append(Message(ack_id='', message_id=message_id, data=data, attributes=dict(attrs),
+                                            publish_time=time.time()))
+            self.__condition.notify_all()
+
+    def __expire_leases(self) -> None:
+        now = time.monotonic()
+        expired = [ack_id for ack_id, (deadline, _) in self.__leased.items() if deadline <= now]
+        for ack_id in expired:
+            _, msg = self.__leased.pop(ack_id)
+            self.__ready.append(msg)
+
+    def pull(self, max_messages: int = 1, wait: bool = True) -> typing.List[Message]:
+        give_up = time.monotonic() + (WAIT_SECONDS if wait else 0.0)
+        with self.__condition:
+            self.__expire_leases()
+            while not self.__ready and time.monotonic() < give_up:
+                self.__condition.wait(min(POLL_SECONDS, give_up - time.monotonic()))
+                self.__expire_leases()
+
+            pulled = []  # type: typing.List[Message]
+            deadline = time.monotonic() + self.__ack_deadline
+            while self.__ready and len(pulled) < max_messages:
+                msg = self.__ready.popleft()._replace(ack_id=uuid.uuid4().hex)
+                self.__leased[msg.ack_id] = (deadline, msg)
+                pulled.append(msg)
+            return pulled
+
+    def acknowledge(self, ack_ids: typing.Sequence[str]) -> None:
+        with self.__condition:
+            for ack_id in ack_ids:
+                self.__leased.pop(ack_id, None)
+
+    def modify_ack_deadline(self, ack_ids: typing.Sequence[str], ack_deadline: int) -> None:
+        with self.__condition:
+            deadline = time.monotonic() + ack_deadline
+            for ack_id in ack_ids:
+                if ack_id in self.__leased:
+                    self.__leased[ack_id] = (deadline, self.__leased[ack_id][1])
+            self.__expire_leases()
+            self.__condition.notify_all()
+
+    def __len__(self) -> int:
+        with self.__condition:
+            return len(self.__ready) + len(self.__leased)
+
+
+class SqliteQueue(Queue):
+    # Durable queue in a single SQLite file, safe to share between the processes of one machine. A message is
+    # leased by stamping it with a fresh ack id and a lease expiry; acking deletes the row.
+
+    def __init__(self, path: str, ack_deadline: int = 60, table: str = 'messages') -> None:
+        self.__ack_deadline = ack_deadline
+        self.__table = table
+        self.__lock = threading.Lock()
+        self.__db = sqlite3.connect(path, timeout=30.0, isolation_level=None, check_same_thread=False)
+        self.__db.execute('PRAGMA journal_mode=WAL')
+        self.__db.execute('''
+            CREATE TABLE IF NOT EXISTS "{}" (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                data BLOB NOT NULL,
+                attributes TEXT NOT NULL,
+                published REAL NOT NULL DEFAULT 0,
+                ack_id TEXT,
+                lease_until REAL NOT NULL DEFAULT 0
+            )'''.format(table))
+        self.__migrate()
+        self.__db.execute('CREATE INDEX IF NOT EXISTS "{0}_lease" ON "{0}" (lease_until, id)'.format(table))
+        self.__db.execute('CREATE INDEX IF NOT EXISTS "{0}_ack_id" ON "{0}" (ack_id)'.format(table))
+
+    def __migrate(self) -> None:
+        # Tables created before messages recorded their publish time lack the column; another process opening the
+        # same file may add it first, so it is checked again inside the write transaction.
+        self.__db.execute('BEGIN IMMEDIATE')
+        try:
+            columns = {row[1] for row in self.__db.execute(self.__sql('PRAGMA table_info({})'))}
+            if 'published' not in columns:
+                self.__db.execute(self.__sql('ALTER TABLE {} ADD COLUMN published REAL NOT NULL DEFAULT 0'))
+            self.__db.execute('COMMIT')
+        except sqlite3.Error:
+            self.__db.execute('ROLLBACK')
+            raise
+
+    def __sql(self, statement: str) -> str:
+        return statement.format('"{}"'.format(self.__table))
+
+    def publish_batch(self, messages: typing.Sequence[OutgoingMessage]) -> None:
+        now = time.time()
+        rows = [(data, json.dumps(attrs), now) for data, attrs in messages]
+        with self.__lock:
+            self.__db.execute('BEGIN IMMEDIATE')
+            self.__db.executemany(self.__sql('INSERT INTO {} (data, attributes, published) VALUES (?, ?, ?)'), rows)
+            self.__db.execute('COMMIT')
+
+    def __lease(self, max_messages: int) -> typing.List[Message]:
+        now = time.time()
+        with self.__lock:
+            self.__db.execute('BEGIN IMMEDIATE')
+            rows = self.__db.execute(self.__sql('SELECT id, data, attributes, published FROM {} WHERE lease_until <= ? '
+                                               'ORDER BY id LIMIT ?'), (now, max_messages)).fetchall()
+            pulled = []  # type: typing.List[Message]
+            for row_id, data, attributes, published in rows:
+                ack_id = uuid.uuid4().hex
+                self.__db.execute(self.__sql('UPDATE {} SET ack_id = ?, lease_until = ? WHERE id = ?'),
+                                  (ack_id, now + self.__ack_deadline, row_id))
+                pulled.append(Message(ack_id=ack_id, message_id=str(row_id), data=bytes(data),
+                                      attributes=json.loads(attributes), publish_time=published))
+            self.__db.execute('COMMIT')
+        return pulled
+
+    def pull(self, max_messages: int = 1, wait: bool = True) -> typing.List[Message]:
+        give_up = time.monotonic() + (WAIT_SECONDS if wait else 0.0)
+        pulled = self.__lease(max_messages)
+        while not pulled and time.monotonic() < give_up:
+            time.sleep(POLL_SECONDS)
+            pulled = self.__lease(max_messages)
+        return pulled
+
+    def acknowledge(self, ack_ids: typing.Sequence[str]) -> None:
+        with self.__lock:
+            self.__db.execute('BEGIN IMMEDIATE')
+            self.__db.executemany(self.__sql('DELETE FROM {} WHERE ack_id = ?'), [(ack_id,) for ack_id in ack_ids])
+            self.__db.execute('COMMIT')
+
+    def modify_ack_deadline(self, ack_ids: typing.Sequence[str], ack_deadline: int) -> None:
+        lease_until = time.time() + ack_deadline
+        with self.__lock:
+            self.__db.execute('BEGIN IMMEDIATE')
+            self.__db.executemany(self.__sql('UPDATE {} SET lease_until = ? WHERE ack_id = ?'),
+                                  [(lease_until, ack_id) for ack_id in ack_ids])
+            self.__db.execute('COMMIT')
+
+    def __len__(self) -> int:
+        with self.__lock:
+            return self.__db.execute(self.__sql('SELECT COUNT(*) FROM {}')).fetchone()[0]
+
+    def close(self) -> None:
+        with self.__lock:
+            self.__db.close()
+
+
+DEFAULT_LANE = ''
+
+
+class LanedQueue(Queue):
+    # Keeps one queue per breadcrumb type, plus the DEFAULT_LANE for every other type. Each pull gives one lane
+    # first pick, chosen by smooth weighted round-robin so a lane with weight 8 leads eight times as often as one
+    # with weight 1, and tops the batch up from the remaining lanes in order of weight. Ack ids and message ids are
+    # prefixed with their lane so acknowledgements reach the queue the message came from. A waiting pull polls
+    # every lane until one has messages, so a message on any lane ends the wait.
+
+    def __init__(self, lanes: typing.Mapping[str, Queue], weights: typing.Mapping[str, int]) -> None:
+        assert DEFAULT_LANE in lanes
+        self.__lanes = dict(lanes)
+        self.__weights = {lane: max(0, weights.get(lane, 1)) for lane in lanes}
+        self.__by_weight = sorted(lanes, key=lambda lane: -self.__weights[lane])
+        self.__credits = {lane: 0 for lane in lanes}
+        self.__lock = threading.Lock()
+
+    def __lane_for(self, attrs: typing.Mapping[str, str]) -> str:
+        lane = wire.message_type(attrs)
+        return lane if lane in self.__lanes else DEFAULT_LANE
+
+    def __lane_order(self) -> typing.List[str]:
+        with self.__lock:
+            total = sum(self.__weights.values())
+            for lane, weight in self.__weights.items():
+                self.__credits[lane] += weight
+            first = max(self.__by_weight, key=lambda lane: self.__credits[lane])
+            self.__credits[first] -= total
+        return [first] + [lane for lane in self.__by_weight if lane != first]
+
+    def publish_batch(self, messages: typing.Sequence[OutgoingMessage]) -> None:
+        by_lane = collections.defaultdict(list)  # type: typing.Dict[str, typing.List[OutgoingMessage]]
+        for data, attrs in messages:
+            by_lane[self.__lane_for(attrs)].append((data, attrs))
+        for lane, lane_messages in by_lane.items():
+            self.__lanes[lane].publish_batch(lane_messages)
+
+    @staticmethod
+    def __tag(lane: str, pulled: typing.List[Message]) -> typing.List[Message]:
+        return [msg._replace(ack_id='{}:{}'.format(lane, msg.ack_id), message_id='{}:{}'.format(lane, msg.message_id))
+                for msg in pulled]
+
+    def pull(self, max_messages: int = 1, wait: bool = True) -> typing.List[Message]:
+        give_up = time.monotonic() + (WAIT_SECONDS if wait else 0.0)
+        order = self.__lane_order()
+        while True:
+            pulled = []  # type: typing.List[Message]
+            for lane in order:
+                if len(pulled) >= max_messages:
+                    break
+                pulled.extend(self.__tag(lane, self.__lanes[lane].pull(max_messages - len(pulled), wait=False)))
+            if pulled or time.monotonic() >= give_up:
+                return pulled
+            time.sleep(POLL_SECONDS)
+
+    @staticmethod
+    def __by_lane(ack_ids: typing.Sequence[str]) -> typing.Dict[str, typing.List[str]]:
+        by_lane = collections.defaultdict(list)  # type: typing.Dict[str, typing.List[str]]
+        for tagged in ack_ids:
+            lane, ack_id = tagged.split(':', 1)
+            by_lane[lane].append(ack_id)
+        return by_lane
+
+    def acknowledge(self, ack_ids: typing.Sequence[str]) -> None:
+        for lane, lane_ack_ids in self.__by_lane(ack_ids).items():
+            self.__lanes[lane].acknowledge(lane_ack_ids)
+
+    def modify_ack_deadline(self, ack_ids: typing.Sequence[str], ack_deadline: int) -> None:
+        for lane, lane_ack_ids in self.__by_lane(ack_ids).items():
+            self.__lanes[lane].modify_ack_deadline(lane_ack_ids, ack_deadline)
@@ -0,0 +1,137 @@
+import fcntl
+import json
+import threading
+import time
+import typing
+
+THROTTLED_STATUSES = frozenset([429, 500, 502, 503, 504])
+MAX_PAUSE = 300.0
+
+
+class RatePolicy(typing.NamedTuple):
+    # Rates are requests per second per host. Every response under `target_latency` seconds adds `increase`
+    # requests/second spread over one second of traffic; a throttled or slow response multiplies the rate by
+    # `decrease`, at most once per `target_latency` so one overload is not punished for every request in flight.
+    initial_rate: float = 2.0
+    min_rate: float = 0.2
+    max_rate: float = 20.0
+    burst: float = 2.0
+    target_latency: float = 5.0
+    increase: float = 0.1
+    decrease: float = 0.5
+
+
+class HostState(typing.NamedTuple):
+    rate: float
+    tokens: float
+    updated: float
+    decreased: float
+    paused_until: float
+
+
+StateUpdate = typing.Callable[[typing.Optional[HostState]], typing.Tuple[HostState, float]]
+
+
+class MemoryStates:
+
+    def __init__(self) -> None:
+        self.__lock = threading.Lock()
+        self.__states = {}  # type: typing.Dict[str, HostState]
+
+    def update(self, host: str, update: StateUpdate) -> float:
+        with self.__lock:
+            self.__states[host], result = update(self.__states.get(host))
+            return result
+
+
+class FileStates:
+    # Keeps host states in one JSON file, read and rewritten under an exclusive flock so that every process on
+    # the machine draws from the same buckets.
+
+    def __init__(self, path: str) -> None:
+        self.__path = path
+        self.__lock = threading.Lock()
+
+    def update(self, host: str, update: StateUpdate) -> float:
+        with self.__lock, open(self.__path, 'a+') as handle:
+            fcntl.flock(handle, fcntl.LOCK_EX)
+            handle.seek(0)
+            raw = handle.read()
+            states = json.loads(raw) if raw else {}
+            state = HostState(*states[host]) if host in states else None
+            new_state, result = update(state)
+            states[host] = list(new_state)
+            handle.seek(0)
+            handle.truncate()
+            handle.write(json.dumps(states))
+            handle.flush()
+        return result
+
+
+def parse_retry_after(value: typing.Optional[str]) -> float:
+    if value is None or not value.strip().isdigit():
+        return 0.0
+    return min(MAX_PAUSE, float(value.strip()))
+
+
+class RateLimiter:
+    # Token bucket per host whose refill rate is tuned by additive increase / multiplicative decrease from the
+    # responses it is told about. With `state_path` the buckets are shared by every process using that file.
+
+    def __init__(self, policy: RatePolicy = RatePolicy(), state_path: typing.Optional[str] = None) -> None:
+        self.__policy = policy
+        self.__states = MemoryStates()  # type: typing.Union[FileStates, MemoryStates]
+        if state_path:
+            self.__states = FileStates(state_path)
+
+    def __initial(self, now: float) -> HostState:
+        return HostState(rate=self.__policy.initial_rate, tokens=self.__policy.burst, updated=now, decreased=0.0,
+                         paused_until=0.0)
+
+    def __refill(self, state: typing.Optional[HostState], now: float) -> HostState:
+        if state is None:
+            return self.__initial(now)
+        tokens = min(self.__policy.burst, state.tokens + max(0.0, now - state.updated) * state.rate)
+        return state._replace(tokens=tokens, updated=now)
+
+    def __take(self, state: typing.Optional[HostState]) -> typing.Tuple[HostState, float]:
+        now = time.time()
+        state = self.__refill(state, now)
+        if now < state.paused_until:
+            return state, state.paused_until - now
+        if state.tokens >= 1.0:
+            return state._replace(tokens=state.tokens - 1.0), 0.0
+        return state, (1.0 - state.tokens) / state.rate
+
+    def acquire(self, host: str) -> None:
+        while True:
+            wait = self.__states.update(host, self.__take)
+            if wait <= 0.0:
+                return
+            time.sleep(wait)
+
+    def record(self, host: str, latency: float, status: int, retry_after: typing.Optional[str] = None) -> None:
+        policy = self.__policy
+
+        def adjust(state: typing.Optional[HostState]) -> typing.Tuple[HostState, float]:
+            now = time.time()
+            state = self.__refill(state, now)
+            if status in THROTTLED_STATUSES or status == 0 or latency > policy.target_latency:
+                pause = parse_retry_after(retry_after)
+                if pause:
+                    state = state._replace(paused_until=max(state.paused_until, now + pause))
+                if now - state.decreased >= policy.target_latency:
+                    state = state._replace(rate=max(policy.min_rate, state.rate * policy.decrease), decreased=now)
+            else:
+                state = state._replace(rate=min(policy.max_rate, state.rate + policy.increase / state.rate))
+            return state, 0.0
+
+        self.__states.update(host, adjust)
+
+    def rate(self, host: str) -> float:
+
+        def current(state: typing.Optional[HostState]) -> typing.Tuple[HostState, float]:
+            state = self.__refill(state, time.time())
+            return state, state.rate
+
+        return self.__states.update(host, current)
@@ -0,0 +1,52 @@
+import collections
+import threading
+import typing
+
+# Attributes added to a message when it is dead-lettered, and removed again when it is replayed.
+ERROR_KEY = 'dead_letter_error'
+ATTEMPTS_KEY = 'dead_letter_attempts'
+DEAD_LETTER_KEYS = (ERROR_KEY, ATTEMPTS_KEY)
+MAX_ERROR_LENGTH = 1000
+MAX_ACK_DEADLINE = 600
+
+
+class RetryPolicy(typing.NamedTuple):
+    max_attempts: int = 5
+    base_delay: float = 10.0
+    max_delay: float = MAX_ACK_DEADLINE
+
+    def delay(self, attempts: int) -> int:
+        return int(min(self.max_delay, MAX_ACK_DEADLINE, self.base_delay * 2 ** max(0, attempts - 1)))
+
+
+class Attempts:
+    # Failed attempts per message id. Counts live in this process only, so with several workers a message may be
+    # tried up to max_attempts times by each worker it is redelivered to.
+
+    def __init__(self, size: int = 100000) -> None:
+        self.__size = size
+        self.__lock = threading.Lock()
+        self.__failures = collections.OrderedDict()  # type: typing.MutableMapping[str, int]
+
+    def failed(self, message_id: str) -> int:
+        with self.__lock:
+            attempts = self.__failures.pop(message_id, 0) + 1
+            self.__failures[message_id] = attempts
+            while len(self.__failures) > self.__size:
+                self.__failures.popitem(last=False)  # type: ignore
+            return attempts
+
+    def forget(self, message_id: str) -> None:
+        with self.__lock:
+            self.__failures.pop(message_id, None)
+
+
+def dead_letter_attrs(attrs: typing.Mapping[str, str], error: Exception, attempts: int) -> typing.Dict[str, str]:
+    dead_attrs = dict(attrs)
+    dead_attrs[ERROR_KEY] = '{}: {}'.format(type(error).__name__, error)[:MAX_ERROR_LENGTH]
+    dead_attrs[ATTEMPTS_KEY] = str(attempts)
+    return dead_attrs
+
+
+def replay_attrs(attrs: typing.Mapping[str, str]) -> typing.Dict[str, str]:
+    return {key: value for key, value in attrs.items() if key not in DEAD_LETTER_KEYS}
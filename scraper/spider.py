@@ -1,61 +1,295 @@
+import asyncio
+import collections
+import functools
+import signal
+import threading
+import time
 import typing
+from concurrent import futures
 
-from google.cloud import pubsub
-from google.cloud.pubsub import message  # pylint: disable=unused-import
-
+from scraper import acks
 from scraper import acts_scraper
 from scraper import acts_storage
+from scraper import admission
 from scraper import logger
+from scraper import metrics
+from scraper import polling
+from scraper import profiling
+from scraper import publisher
+from scraper import queues
+from scraper import retries
+from scraper import wire
 
 LOG = logger.LOG
 
 
-class ActsSpider:
-
-    def __init__(self, pubsub_client: pubsub.Client,
-                 scraper: acts_scraper.Scraper,
-                 storage: acts_storage.ActsStorage) -> None:
+class ActsSpider:  # pylint: disable=too-many-instance-attributes
 
-        self.__pubsub = pubsub_client
-        topic = pubsub_client.topic('acts_requests')
-        if not topic.exists():
-            topic.create()
-        self.__topic = topic  # type: pubsub.Topic
+    def __init__(self, queue: queues.Queue,  # pylint: disable=too-many-arguments
+                 scraper: typing.Union[acts_scraper.Scraper, acts_scraper.AsyncScraper],
+                 storage: acts_storage.ActsStorage,
+                 gate: typing.Optional[admission.Admission] = None,
+                 concurrency: int = 1,
+                 retry: retries.RetryPolicy = retries.RetryPolicy(),
+                 dead_letters: typing.Optional[queues.Queue] = None,
+                 profiler: typing.Optional[profiling.SamplingProfiler] = None) -> None:
 
-        sub = topic.subscription('acts_scraper')
-        if not sub.exists():
-            sub.create()
-        self.__sub = sub
+        self.__queue = queue
+        self.__publisher = publisher.BatchPublisher(queue)
+        self.__acks = acks.AckManager(queue, before_flush=self._flush_outputs)
         self.__scraper = scraper
         self.__storage = storage
+        self.__admission = gate
+        self.__retry = retry
+        self.__attempts = retries.Attempts()
+        self.__dead_letters = dead_letters
+        self.__profiler = profiler
+        self.__loop = None  # type: typing.Optional[asyncio.AbstractEventLoop]
+        self.__workers = None  # type: typing.Optional[futures.ThreadPoolExecutor]
+        if concurrency > 1:
+            self.__workers = futures.ThreadPoolExecutor(max_workers=concurrency)
+        self.__store_lock = threading.Lock()
+        self.__failed_writes = []  # type: typing.List[typing.Tuple[queues.Message, Exception]]
+        self.__stopping = threading.Event()
+
+    def _flush_outputs(self) -> None:
+        # Everything produced from a message must be durable before that message is acknowledged.
+        self.__publisher.flush()
+        with self.__store_lock:
+            try:
+                self.__storage.flush()
+            except Exception:  # pylint: disable=broad-except
+                LOG.exception('Writing buffered items failed')
+        self._settle_failed_writes()
 
     def _store_breadcrumbs(self, breadcrumbs: typing.Sequence[acts_scraper.Breadcrumb]) -> None:
-        with self.__topic.batch() as batch:
-            for breadcrumb in breadcrumbs:
-                batch.publish(breadcrumb.url.encode('utf-8'), **breadcrumb.attrs)
-
-    def _store_items(self, items: typing.Sequence[acts_scraper.ActItem]) -> None:
-        for item in items:
-            self.__storage.store(item)
-
-    def listen(self, wait: bool = True) -> bool:
-        message_received = False
-        for ack_id, msg in self.__sub.pull(return_immediately=not wait):  # type: str, message.Message
-            message_received = True
-            url = msg.data.decode('utf-8')
-            LOG.info('Following breadcrumb: %s', url)
-            input_breadcrumb = acts_scraper.Breadcrumb(url=url, attrs=dict(msg.attributes))
-            result = self.__scraper.scrape(input_breadcrumb)
+        for breadcrumb in breadcrumbs:
+            self.__publisher.publish(*wire.encode(breadcrumb))
+
+    def _store_items(self, msg: queues.Message, items: typing.Sequence[acts_scraper.ActItem]) -> bool:
+        # The datastore client's HTTP connection is not safe to use from several threads at once.
+        # Returns False if a write failed; the message is then failed by _settle_failed_writes.
+        with self.__store_lock:
+            for index, item in enumerate(items):
+                try:
+                    self.__storage.store(item, failed=functools.partial(self.__write_failed, msg))
+                except Exception:  # pylint: disable=broad-except
+                    for unstored in items[index + 1:]:
+                        acts_scraper.close_item(unstored)
+                    return False
+        return True
+
+    def __write_failed(self, msg: queues.Message, error: Exception) -> None:
+        # Called by the storage under __store_lock, so it only records the failure.
+        self.__failed_writes.append((msg, error))
+
+    def _settle_failed_writes(self) -> None:
+        # Withdraws the pending ack of every message whose items were in a dropped batch, and retries it instead.
+        with self.__store_lock:
+            failed_writes, self.__failed_writes = self.__failed_writes, []
+        failed = collections.OrderedDict()  # type: typing.MutableMapping[str, typing.Tuple[queues.Message, Exception]]
+        for msg, error in failed_writes:
+            failed.setdefault(msg.ack_id, (msg, error))
+        for msg, error in failed.values():
+            self.__acks.discard(msg.ack_id)
+            self._fail(msg, error)
 
+    def _dead_letter(self, msg: queues.Message, error: Exception, attempts: int) -> None:
+        # A message is only acknowledged once its dead letter is published; otherwise it stays on the queue.
+        if self.__dead_letters is None:
+            LOG.error('Message %s failed %s attempts and there is no dead-letter queue: %s', msg.message_id,
+                      attempts, error)
+            self.__nack(msg, self.__retry.delay(attempts))
+            return
+        LOG.error('Dead-lettering message %s after %s attempts: %s', msg.message_id, attempts, error)
+        try:
+            self.__dead_letters.publish(msg.data, retries.dead_letter_attrs(msg.attributes, error, attempts))
+        except Exception:  # pylint: disable=broad-except
+            LOG.exception('Publishing dead letter for message %s failed', msg.message_id)
+            self.__nack(msg, self.__retry.delay(attempts))
+            return
+        metrics.inc(metrics.DEAD_LETTERS, type=wire.message_type(msg.attributes))
+        self.__acks.ack(msg.ack_id)
+        self.__attempts.forget(msg.message_id)
+
+    def __nack(self, msg: queues.Message, delay: float) -> None:
+        try:
+            self.__acks.nack(msg.ack_id, delay)
+        except Exception:  # pylint: disable=broad-except
+            LOG.exception('Nacking message %s failed; it is redelivered when its lease expires', msg.message_id)
+
+    def _fail(self, msg: queues.Message, error: Exception) -> None:
+        attempts = self.__attempts.failed(msg.message_id)
+        if attempts >= self.__retry.max_attempts:
+            self._dead_letter(msg, error, attempts)
+            return
+        delay = self.__retry.delay(attempts)
+        metrics.inc(metrics.RETRIES, type=wire.message_type(msg.attributes))
+        LOG.warning('Attempt %s at message %s failed, retrying in %ss: %s', attempts, msg.message_id, delay, error)
+        self.__nack(msg, delay)
+
+    def _acknowledge(self, msg: queues.Message, input_breadcrumb: acts_scraper.Breadcrumb) -> None:
+        try:
+            self.__acks.ack(msg.ack_id)
+        except Exception:  # pylint: disable=broad-except
+            # The ack stays pending for the next flush, or the message is redelivered and processed again.
+            LOG.exception('Flushing acknowledgements failed')
+        self.__attempts.forget(msg.message_id)
+        if self.__admission is not None:
+            self.__admission.mark_done(input_breadcrumb.url, input_breadcrumb.attrs)
+
+    def _complete(self, msg: queues.Message, input_breadcrumb: acts_scraper.Breadcrumb,
+                  result: typing.Union[acts_scraper.ScraperResult, None, Exception]) -> None:
+        if isinstance(result, Exception):
+            self._fail(msg, result)
+            return
+        stored = True
+        try:
             if result:
                 breadcrumbs, items = result
-                self._store_breadcrumbs(breadcrumbs)
-                self._store_items(items)
+                with profiling.tagged(input_breadcrumb.attrs.get('type', '')):
+                    try:
+                        self._store_breadcrumbs(breadcrumbs)
+                    except Exception:
+                        for item in items:
+                            acts_scraper.close_item(item)
+                        raise
+                    stored = self._store_items(msg, items)
+        except Exception as error:  # pylint: disable=broad-except
+            self._fail(msg, error)
+            return
+
+        if not stored:
+            self._settle_failed_writes()
+            return
+        self._acknowledge(msg, input_breadcrumb)
+
+    def _process(self, msg: queues.Message, input_breadcrumb: acts_scraper.Breadcrumb) -> None:
+        assert isinstance(self.__scraper, acts_scraper.Scraper)
+        try:
+            result = self.__scraper.scrape(input_breadcrumb)
+        except Exception as error:  # pylint: disable=broad-except
+            self._fail(msg, error)
+            return
+        self._complete(msg, input_breadcrumb, result)
+
+    def _process_all(self, msgs: typing.Sequence[queues.Message],
+                     input_breadcrumbs: typing.Sequence[acts_scraper.Breadcrumb]) -> None:
+        if isinstance(self.__scraper, acts_scraper.AsyncScraper):
+            if self.__loop is None:
+                self.__loop = asyncio.new_event_loop()
+            results = self.__loop.run_until_complete(self.__scraper.scrape_many(input_breadcrumbs))
+            for msg, input_breadcrumb, result in zip(msgs, input_breadcrumbs, results):
+                self._complete(msg, input_breadcrumb, result)
+        elif self.__workers is not None:
+            jobs = [self.__workers.submit(self._process, msg, input_breadcrumb)
+                    for msg, input_breadcrumb in zip(msgs, input_breadcrumbs)]
+            for job in jobs:
+                job.result()
+        else:
+            for msg, input_breadcrumb in zip(msgs, input_breadcrumbs):
+                self._process(msg, input_breadcrumb)
+
+    def _admit(self, input_breadcrumb: acts_scraper.Breadcrumb) -> bool:
+        if self.__admission is None:
+            return True
+        reason = self.__admission.admit(input_breadcrumb.url, input_breadcrumb.attrs)
+        if reason:
+            LOG.info('Dropping %s breadcrumb: %s', reason, input_breadcrumb.url)
+        return reason is None
+
+    def listen(self, wait: bool = True, max_messages: int = 1) -> bool:
+        if self.__profiler is not None:
+            self.__profiler.start()
+        try:
+            return bool(self._listen_once(wait, max_messages))
+        finally:
+            if self.__profiler is not None:
+                self.__profiler.stop()
+
+    def _listen_once(self, wait: bool, max_messages: int) -> int:
+        pulled = self.__queue.pull(max_messages=max_messages, wait=wait)
+        dropped_ack_ids = []  # type: typing.List[str]
+        msgs = []  # type: typing.List[queues.Message]
+        input_breadcrumbs = []  # type: typing.List[acts_scraper.Breadcrumb]
+        now = time.time()
+        for msg in pulled:
+            self.__acks.track(msg.ack_id, msg.message_id)
+            if msg.publish_time:
+                metrics.observe(metrics.QUEUE_LAG_SECONDS, max(0.0, now - msg.publish_time),
+                                type=wire.message_type(msg.attributes))
+            try:
+                input_breadcrumb = wire.decode(msg.data, msg.attributes)
+            except (ValueError, IndexError) as error:
+                # A message that cannot be decoded will never succeed, so it skips the retries.
+                self._dead_letter(msg, error, 1)
+                continue
+            if not self._admit(input_breadcrumb):
+                dropped_ack_ids.append(msg.ack_id)
+                continue
+            LOG.info('Following breadcrumb: %s', input_breadcrumb.url)
+            msgs.append(msg)
+            input_breadcrumbs.append(input_breadcrumb)
+
+        if dropped_ack_ids:
+            for ack_id in dropped_ack_ids:
+                self.__acks.ack(ack_id)
+            assert self.__admission is not None
+            LOG.info('Admission drops so far: %s', dict(self.__admission.drops))
+
+        self._process_all(msgs, input_breadcrumbs)
+        if not self.__acks.running:
+            self.__acks.flush()
+        return len(pulled)
+
+    @property
+    def ack_stats(self) -> typing.Dict[str, int]:
+        return self.__acks.stats()
+
+    @property
+    def publish_stats(self) -> typing.Dict[str, int]:
+        return self.__publisher.stats()
+
+    @property
+    def stats(self) -> typing.Dict[str, int]:
+        stats = collections.Counter(self.ack_stats)  # type: typing.Counter[str]
+        stats.update(self.publish_stats)
+        return dict(stats)
+
+    def stop(self) -> None:
+        self.__stopping.set()
+
+    def __handle_sigterm(self, signum: int, _: typing.Any) -> None:
+        LOG.info('Received signal %s, draining in-flight messages', signum)
+        self.stop()
 
-            self.__sub.acknowledge([ack_id])
-        return message_received
+    def keep_listening(self, wait: bool = True, max_messages: int = 1, max_idle: float = 30.0) -> None:
+        LOG.info('Starting queue listener')
+        previous_handler = None
+        if threading.current_thread() is threading.main_thread():
+            previous_handler = signal.signal(signal.SIGTERM, self.__handle_sigterm)
 
-    def keep_listening(self, wait: bool = True) -> None:
-        LOG.info('Starting Pub/Sub Listener')
-        while True:
-            self.listen(wait)
+        poller = polling.AdaptivePoller(max_messages=max_messages, max_idle=max_idle)
+        self.__stopping.clear()
+        self.__acks.start()
+        if self.__profiler is not None:
+            self.__profiler.start()
+        try:
+            while not self.__stopping.is_set():
+                try:
+                    received = self._listen_once(wait, poller.batch_size)
+                except Exception:  # pylint: disable=broad-except
+                    # Messages already fail individually, so this is the queue itself; back off as if idle.
+                    LOG.exception('Pulling from the queue failed')
+                    self.__stopping.wait(poller.record(0))
+                    continue
+                delay = poller.record(received)
+                if delay and not wait:
+                    self.__stopping.wait(delay)
+        finally:
+            if self.__profiler is not None:
+                self.__profiler.stop()
+            self.__acks.stop()
+            if previous_handler is not None:
+                signal.signal(signal.SIGTERM, previous_handler)
+            LOG.info('Stopped queue listener. Ack stats: %s, publish stats: %s', self.ack_stats, self.publish_stats)
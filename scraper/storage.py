@@ -1,15 +1,122 @@
 import abc
+import contextlib
+import functools
+import gzip
+import io
+import json
+import mmap
 import random
 import os
+import queue
+import shutil
 import sys
+import tempfile
 import typing
+from concurrent import futures
+import requests
+from google.auth.transport import requests as google_requests  # pylint:disable=import-error
 from google.cloud import storage  # pylint:disable=import-error
+from scraper import logger
+
+LOG = logger.LOG
+
+GZIP = 'gzip'
+CONTENT_ENCODINGS = (GZIP,)
+CHUNK_SIZE = 1 << 16
+SPOOL_MAX_SIZE = 1 << 24
+METADATA_SUFFIX = '.metadata.json'
+DEFAULT_WORKERS = 16
+RANGE_SIZE = 1 << 20
+
+UploadData = typing.Union[str, typing.IO[bytes]]  # pylint: disable=invalid-name
+
+
+class Transfer(typing.NamedTuple):
+    # Outcome of one object in a bulk operation: downloaded text, or the error that object failed with.
+    name: str
+    data: typing.Optional[str] = None
+    error: typing.Optional[Exception] = None
+
+
+def _check_encoding(content_encoding: typing.Optional[str]) -> None:
+    if content_encoding is not None and content_encoding not in CONTENT_ENCODINGS:
+        raise ValueError('Unsupported content encoding: {}'.format(content_encoding))
+
+
+def _encode(file: typing.IO[bytes]) -> typing.IO[bytes]:
+    # Compresses `file` into a rewound temporary file. mtime is fixed so equal content compresses to equal bytes.
+    encoded = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+    with gzip.GzipFile(fileobj=encoded, mode='wb', mtime=0) as compressor:
+        shutil.copyfileobj(file, compressor, CHUNK_SIZE)
+    encoded.seek(0)
+    return encoded
+
+
+class _GzipReader(gzip.GzipFile):
+    # Unlike a GzipFile given a fileobj, closes the underlying file as well.
+
+    def __init__(self, file: typing.IO[bytes]) -> None:
+        super().__init__(fileobj=file, mode='rb')
+        self.__file = file
+
+    def close(self) -> None:
+        try:
+            super().close()
+        finally:
+            self.__file.close()
+
+
+def _decode(file: typing.IO[bytes], content_encoding: typing.Optional[str]) -> typing.IO[bytes]:
+    # Decompressing reader over `file` that takes ownership of it.
+    if content_encoding == GZIP:
+        return typing.cast(typing.IO[bytes], _GzipReader(file))
+    return file
+
+
+class RangeReader(io.RawIOBase):
+    # Seekable raw reader of a `size` byte object that fetches the bytes it is asked for with `fetch(start, end)`.
+    # Wrap it in io.BufferedReader so small reads are served from one larger range request.
+
+    def __init__(self, fetch: typing.Callable[[int, int], bytes], size: int) -> None:
+        super().__init__()
+        self.__fetch = fetch
+        self.__size = size
+        self.__position = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self.__position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self.__position, io.SEEK_END: self.__size}[whence]
+        self.__position = max(0, base + offset)
+        return self.__position
+
+    def readinto(self, buffer: typing.Any) -> int:
+        length = min(len(buffer), self.__size - self.__position)
+        if length <= 0:
+            return 0
+        data = self.__fetch(self.__position, self.__position + length)
+        buffer[:len(data)] = data
+        self.__position += len(data)
+        return len(data)
 
 
 class Blob(metaclass=abc.ABCMeta):
+    # Uploads are compressed with the blob's content encoding, recorded in the object's metadata, and downloads
+    # decompress whatever encoding the object was stored with as they stream.
+
     def name(self) -> str:
         pass
 
+    def content_encoding(self) -> typing.Optional[str]:
+        pass
+
     def exists(self) -> bool:
         pass
 
@@ -34,74 +141,193 @@ class Blob(metaclass=abc.ABCMeta):
     def download_to_string(self) -> str:
         pass
 
+    def open(self) -> typing.IO[bytes]:
+        # Seekable binary reader of the decoded content, for reading an object in sections or ranges. Only plain
+        # objects are read by range: gzip objects decompress from offset 0, so seeking in one re-reads from the start.
+        pass
+
+
+def _upload(blob: Blob, data: UploadData) -> None:
+    if isinstance(data, str):
+        blob.upload_from_string(data)
+    else:
+        blob.upload_from_file(data)
+
 
 class Storage(metaclass=abc.ABCMeta):
+    # Bulk operations run on up to `max_workers` threads. A failing object is logged and reported in its Transfer
+    # while the rest of the batch carries on; results are in the order the objects were given.
+    max_workers = DEFAULT_WORKERS
+
     def get_blob(self, blob_name: str) -> Blob:
         pass
 
+    @contextlib.contextmanager
+    def _bulk_blob(self, blob_name: str) -> typing.Iterator[Blob]:
+        # Blob for one object of a bulk operation, used by a single worker thread for the duration of the block.
+        yield self.get_blob(blob_name)
+
+    def __upload_one(self, blob_name: str, data: UploadData) -> None:
+        with self._bulk_blob(blob_name) as blob:
+            _upload(blob, data)
+
+    def __download_one(self, blob_name: str) -> str:
+        with self._bulk_blob(blob_name) as blob:
+            return blob.download_to_string()
+
+    def __transfer(self, jobs: typing.Sequence[typing.Tuple[str, typing.Callable[[], typing.Optional[str]]]]) \
+            -> typing.List[Transfer]:
+
+        def run(job: typing.Tuple[str, typing.Callable[[], typing.Optional[str]]]) -> Transfer:
+            name, call = job
+            try:
+                return Transfer(name, data=call())
+            except Exception as error:  # pylint: disable=broad-except
+                LOG.warning('Transfer of %s failed: %r', name, error)
+                return Transfer(name, error=error)
+
+        if self.max_workers <= 1 or len(jobs) <= 1:
+            return [run(job) for job in jobs]
+        with futures.ThreadPoolExecutor(max_workers=min(self.max_workers, len(jobs))) as executor:
+            return list(executor.map(run, jobs))
+
+    def upload_many(self, items: typing.Iterable[typing.Tuple[str, UploadData]]) -> typing.List[Transfer]:
+        return self.__transfer([(name, functools.partial(self.__upload_one, name, data)) for name, data in items])
+
+    def download_many(self, names: typing.Iterable[str]) -> typing.List[Transfer]:
+        return self.__transfer([(name, functools.partial(self.__download_one, name)) for name in names])
+
 
 class MockBlob(Blob):
-    def __init__(self, base_path: str, name: str) -> None:
+    # Metadata is kept next to the object in a JSON file, written only for encoded objects.
+
+    def __init__(self, base_path: str, name: str, content_encoding: typing.Optional[str] = None) -> None:
+        _check_encoding(content_encoding)
         self.__name = name
         self.__path = os.path.join(base_path, name)
+        self.__metadata_path = self.__path + METADATA_SUFFIX
+        self.__content_encoding = content_encoding
 
     def name(self) -> str:
         return self.__name
 
+    def content_encoding(self) -> typing.Optional[str]:
+        if not os.path.exists(self.__metadata_path):
+            return None
+        with open(self.__metadata_path) as f:
+            return json.load(f).get('content_encoding')
+
     def exists(self) -> bool:
         return os.path.exists(self.__path)
 
     def delete(self) -> None:
         assert os.path.exists(self.__path)
         os.remove(self.__path)
+        if os.path.exists(self.__metadata_path):
+            os.remove(self.__metadata_path)
+
+    def __write_metadata(self) -> None:
+        if self.__content_encoding:
+            with open(self.__metadata_path, 'w') as f:
+                json.dump({'content_encoding': self.__content_encoding}, f)
+        elif os.path.exists(self.__metadata_path):
+            os.remove(self.__metadata_path)
 
     def upload_from_file(self, file: typing.IO[typing.Any]) -> None:
         dirname = os.path.dirname(self.__path)
-        if not os.path.exists(dirname):
-            os.makedirs(dirname)
-        with open(self.__path, 'wb') as f:
-            f.write(file.read())
+        os.makedirs(dirname, exist_ok=True)
+        if self.__content_encoding:
+            with _encode(file) as encoded, open(self.__path, 'wb') as f:
+                shutil.copyfileobj(encoded, f)
+        else:
+            with open(self.__path, 'wb') as f:
+                shutil.copyfileobj(file, f)
+        self.__write_metadata()
 
     def upload_from_filename(self, filename: str) -> None:
         with open(filename, 'rb') as f:
             self.upload_from_file(f)
 
     def upload_from_string(self, data: str) -> None:
+        if self.__content_encoding:
+            self.upload_from_file(io.BytesIO(data.encode('utf-8')))
+            return
         dirname = os.path.dirname(self.__path)
-        if not os.path.exists(dirname):
-            os.makedirs(dirname)
+        os.makedirs(dirname, exist_ok=True)
         with open(self.__path, 'w') as f:
             f.write(data)
+        self.__write_metadata()
 
     def download_to_file(self, file: typing.IO[typing.Any]) -> None:
-        with open(self.__path, 'rb') as f:
-            file.write(f.read())
+        with open(self.__path, 'rb') as f, _decode(f, self.content_encoding()) as decoded:
+            shutil.copyfileobj(decoded, file, CHUNK_SIZE)
 
     def download_to_filename(self, filename: str) -> None:
         with open(filename, 'wb') as f:
             self.download_to_file(f)
 
     def download_to_string(self) -> str:
-        with open(self.__path) as f:
-            return f.read()
+        content_encoding = self.content_encoding()
+        if not content_encoding:
+            with open(self.__path) as f:
+                return f.read()
+        with open(self.__path, 'rb') as f, _decode(f, content_encoding) as decoded:
+            return io.TextIOWrapper(decoded, encoding='utf-8').read()
+
+    def open(self) -> typing.IO[bytes]:
+        return _decode(open(self.__path, 'rb'), self.content_encoding())
+
+    @contextlib.contextmanager
+    def mapped(self) -> typing.Iterator[memoryview]:
+        # Zero-copy view of a plain object's bytes, valid until the block exits.
+        if self.content_encoding():
+            raise ValueError('{} is compressed; read it with open()'.format(self.__name))
+        with open(self.__path, 'rb') as f:
+            if not os.fstat(f.fileno()).st_size:
+                yield memoryview(b'')
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapping:
+                view = memoryview(mapping)
+                try:
+                    yield view
+                finally:
+                    view.release()
 
 
 class MockStorage(Storage):
-    def __init__(self, path: str) -> None:
+    # Local file operations gain nothing from threads, so bulk operations run in the calling thread.
+    max_workers = 1
+
+    def __init__(self, path: str, content_encoding: typing.Optional[str] = None) -> None:
+        _check_encoding(content_encoding)
         self.__path = path
+        self.__content_encoding = content_encoding
 
     def get_blob(self, blob_name: str):
-        return MockBlob(self.__path, blob_name)
+        return MockBlob(self.__path, blob_name, self.__content_encoding)
 
 
 class GoogleBlob(Blob):
-    def __init__(self, blob_name: str, blob: storage.blob.Blob) -> None:
+    # Compressed objects have Content-Encoding set in their metadata. Downloads send Accept-Encoding: gzip so that
+    # Cloud Storage serves the stored bytes instead of transcoding them, and decode by the Content-Encoding the
+    # bytes are served with, which comes from that metadata. Whole objects are one streamed GET; only open() reads
+    # by range.
+
+    def __init__(self, blob_name: str, blob: storage.blob.Blob, content_encoding: typing.Optional[str] = None,
+                 session: typing.Optional[requests.Session] = None) -> None:
+        _check_encoding(content_encoding)
         self.__blob = blob
         self.__blob_name = blob_name
+        self.__content_encoding = content_encoding
+        self.__session = session
 
     def name(self) -> str:
         return self.__blob_name
 
+    def content_encoding(self) -> typing.Optional[str]:
+        self.__blob.reload()
+        return self.__blob.content_encoding
+
     def exists(self) -> bool:
         return self.__blob.exists()
 
@@ -109,36 +335,113 @@ class GoogleBlob(Blob):
         self.__blob.delete()
 
     def upload_from_file(self, file: typing.IO[typing.Any]) -> None:
-        self.__blob.upload_from_file(file)
+        if self.__content_encoding:
+            with _encode(file) as encoded:
+                self.__blob.upload_from_file(encoded)
+            # The upload request sends no metadata besides the content type, so the encoding is patched in after.
+            self.__blob.content_encoding = self.__content_encoding
+            self.__blob.patch()
+        else:
+            self.__blob.upload_from_file(file)
 
     def upload_from_filename(self, filename: str) -> None:
-        self.__blob.upload_from_filename(filename)
+        if self.__content_encoding:
+            with open(filename, 'rb') as f:
+                self.upload_from_file(f)
+        else:
+            self.__blob.upload_from_filename(filename)
 
     def upload_from_string(self, data: str) -> None:
-        self.__blob.upload_from_string(data)
+        if self.__content_encoding:
+            self.upload_from_file(io.BytesIO(data.encode('utf-8')))
+        else:
+            self.__blob.upload_from_string(data)
 
     def download_to_file(self, file: typing.IO[typing.Any]) -> None:
-        self.__blob.download_to_file(file)
+        response = self.__get({'Accept-Encoding': GZIP})
+        with contextlib.closing(response):
+            response.raise_for_status()
+            raw = typing.cast(typing.IO[bytes], response.raw)
+            with _decode(raw, response.headers.get('Content-Encoding')) as decoded:
+                shutil.copyfileobj(decoded, file, CHUNK_SIZE)
 
     def download_to_filename(self, filename: str) -> None:
-        return self.__blob.download_to_filename(filename)
+        with open(filename, 'wb') as f:
+            self.download_to_file(f)
 
     def download_to_string(self) -> str:
-        return self.__blob.download_as_string().decode('utf-8')
+        data = io.BytesIO()
+        self.download_to_file(data)
+        return data.getvalue().decode('utf-8')
+
+    def __get(self, headers: typing.Dict[str, str]) -> requests.Response:
+        # Downloads go through an authorized requests session, as the client library's own downloads do; the
+        # client's _http is an httplib2 object without a requests interface.
+        if self.__session is None:
+            self.__session = google_requests.AuthorizedSession(
+                self.__blob.client._credentials)  # pylint: disable=protected-access
+        return self.__session.get(self.__blob._get_download_url(),  # pylint: disable=protected-access
+                                  headers=headers, stream=True)
+
+    def __fetch_range(self, start: int, end: int) -> bytes:
+        # Accept-Encoding: gzip asks for the stored bytes, so ranges of compressed objects are not transcoded.
+        # A server that ignores Range answers 200 with the whole object, which is cut down to the range asked for.
+        response = self.__get({'Range': 'bytes={}-{}'.format(start, end - 1), 'Accept-Encoding': GZIP})
+        with contextlib.closing(response):
+            response.raise_for_status()
+            if response.status_code != 206:
+                return response.raw.read(decode_content=False)[start:end]
+            return response.raw.read(end - start, decode_content=False)
+
+    def open(self) -> typing.IO[bytes]:
+        self.__blob.reload()
+        raw = io.BufferedReader(RangeReader(self.__fetch_range, self.__blob.size), buffer_size=RANGE_SIZE)
+        return _decode(typing.cast(typing.IO[bytes], raw), self.__blob.content_encoding)
+
+
+BulkHandle = typing.Tuple[storage.Bucket, requests.Session]  # pylint: disable=invalid-name
 
 
 class GoogleStorage(Storage):
-    def __init__(self, bucket: storage.Bucket) -> None:
+    # API requests go through the client's httplib2 AuthorizedHttp and downloads through a requests session;
+    # neither is safe to share between threads. Bulk operations therefore check out a handle for each worker: a
+    # bucket on its own client, and so its own AuthorizedHttp, with its own AuthorizedSession. The handles are kept
+    # between calls, so their connections are reused from batch to batch.
+
+    def __init__(self, bucket: storage.Bucket, content_encoding: typing.Optional[str] = None,
+                 max_workers: int = DEFAULT_WORKERS) -> None:
+        _check_encoding(content_encoding)
         self.__bucket = bucket
+        self.__content_encoding = content_encoding
+        self.max_workers = max_workers
+        self.__idle_handles = queue.LifoQueue()  # type: queue.LifoQueue
 
     def get_blob(self, blob_name: str):
-        return GoogleBlob(blob_name, self.__bucket.blob(blob_name))
-
-
-def get_storage() -> Storage:
+        return GoogleBlob(blob_name, self.__bucket.blob(blob_name), self.__content_encoding)
+
+    def __new_handle(self) -> BulkHandle:
+        client = self.__bucket.client
+        credentials = client._credentials  # pylint: disable=protected-access
+        worker_client = storage.Client(project=client.project, credentials=credentials)
+        return worker_client.bucket(self.__bucket.name), google_requests.AuthorizedSession(credentials)
+
+    @contextlib.contextmanager
+    def _bulk_blob(self, blob_name: str) -> typing.Iterator[Blob]:
+        try:
+            bucket, session = self.__idle_handles.get_nowait()
+        except queue.Empty:
+            bucket, session = self.__new_handle()
+        try:
+            yield GoogleBlob(blob_name, bucket.blob(blob_name), self.__content_encoding, session)
+        finally:
+            self.__idle_handles.put((bucket, session))
+
+
+def get_storage(content_encoding: typing.Optional[str] = None) -> Storage:
+    # `content_encoding` compresses every upload through the returned storage; downloads decompress regardless.
     if os.environ.get('GITLAWCA') != 'test':
         stor = storage.Client('gitlawca')
-        return GoogleStorage(stor.get_bucket('gitlawca'))
+        return GoogleStorage(stor.get_bucket('gitlawca'), content_encoding)
     else:
         if 'MOCK_STORAGE' in os.environ:
             temp_path = os.environ['MOCK_STORAGE']
@@ -146,4 +449,4 @@ def get_storage() -> Storage:
             temp_path = os.path.join('/tmp/gitlawca', str(random.randint(1, sys.maxsize)))
         if not os.path.exists(temp_path):
             os.makedirs(temp_path)
-        return MockStorage(temp_path)
+        return MockStorage(temp_path, content_encoding)
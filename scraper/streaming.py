@@ -0,0 +1,67 @@
+import typing
+from lxml import etree  # type: ignore
+from lxml import html  # type: ignore
+
+
+class ElementExtractor:
+    # lxml parser target that builds only the subtree of the first element matching `tag` and `id`, and drops every
+    # other parse event. The subtree and its tail text are written to `sink` with html.tostring, so the bytes are the
+    # same as those of the element found in a fully parsed page.
+
+    def __init__(self, sink: typing.IO[bytes], tag: str, element_id: str) -> None:
+        self.__sink = sink
+        self.__tag = tag
+        self.__id = element_id
+        self.__depth = 0
+        self.__builder = etree.TreeBuilder()
+        self.__element = None  # type: typing.Optional[etree._Element]
+        self.__tail = []  # type: typing.List[str]
+        self.found = False
+
+    def __flush(self) -> None:
+        # The tail ends at the next tag or comment after the element.
+        if self.__element is not None:
+            self.__element.tail = ''.join(self.__tail) or None
+            self.__sink.write(html.tostring(self.__element))
+            self.__element = None
+
+    def start(self, tag: str, attrib: typing.Mapping[str, str]) -> None:
+        if not self.__depth:
+            self.__flush()
+            if self.found or tag != self.__tag or attrib.get('id') != self.__id:
+                return
+            self.found = True
+        self.__depth += 1
+        self.__builder.start(tag, dict(attrib))
+
+    def end(self, tag: str) -> None:
+        if not self.__depth:
+            self.__flush()
+            return
+        self.__depth -= 1
+        self.__builder.end(tag)
+        if not self.__depth:
+            self.__element = self.__builder.close()
+
+    def data(self, data: str) -> None:
+        if self.__depth:
+            self.__builder.data(data)
+        elif self.__element is not None:
+            self.__tail.append(data)
+
+    def comment(self, text: str) -> None:
+        if self.__depth:
+            self.__builder.comment(text)
+        else:
+            self.__flush()
+
+    def close(self) -> bool:
+        self.__flush()
+        return self.found
+
+
+def extract_element(chunks: typing.Iterable[bytes], sink: typing.IO[bytes], tag: str, element_id: str) -> bool:
+    parser = etree.HTMLParser(target=ElementExtractor(sink, tag, element_id))
+    for chunk in chunks:
+        parser.feed(chunk)
+    return parser.close()
@@ -0,0 +1,185 @@
+import collections
+import multiprocessing
+import os
+import queue
+import signal
+import threading
+import time
+import typing
+from scraper import logger
+from scraper import spider
+
+LOG = logger.LOG
+
+Stats = typing.Dict[str, int]  # pylint: disable=invalid-name
+SpiderFactory = typing.Callable[[], spider.ActsSpider]  # pylint: disable=invalid-name
+ListenArgs = typing.Tuple[bool, int, float]  # pylint: disable=invalid-name
+
+POLL_SECONDS = 0.5
+WORKER_PREFIX = 'spider-'
+MAX_RESTART_DELAY = 300.0
+
+# Workers are spawned rather than forked so no gRPC channel or lock held by the supervisor leaks into them.
+CONTEXT = multiprocessing.get_context('spawn')
+
+
+def worker_slot() -> int:
+    # Index of the current worker process, or 0 outside a supervisor.
+    name = multiprocessing.current_process().name
+    return int(name[len(WORKER_PREFIX):]) if name.startswith(WORKER_PREFIX) else 0
+
+
+def _report_until(done: threading.Event, spider_: spider.ActsSpider, stats_queue: multiprocessing.Queue,
+                  report_interval: float) -> None:
+    while not done.wait(report_interval):
+        stats_queue.put((os.getpid(), spider_.stats))
+
+
+def _worker_main(make_spider: SpiderFactory, listen_args: ListenArgs, stats_queue: multiprocessing.Queue,
+                 report_interval: float) -> None:
+    # The supervisor owns Ctrl-C and forwards SIGTERM; the spider installs its own SIGTERM handler to drain.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+    spider_ = make_spider()
+    done = threading.Event()
+    reporter = threading.Thread(target=_report_until, args=(done, spider_, stats_queue, report_interval),
+                                name='stats-reporter', daemon=True)
+    reporter.start()
+    try:
+        spider_.keep_listening(*listen_args)
+    finally:
+        done.set()
+        reporter.join()
+        stats_queue.put((os.getpid(), spider_.stats))
+
+
+class Supervisor:  # pylint: disable=too-many-instance-attributes
+    # Runs `workers` spider processes against the same queue. Workers that exit while the supervisor is running
+    # are restarted after `restart_delay` seconds, doubled for each exit in a row within `fast_failure` seconds of
+    # starting; a slot whose worker fails that way `max_fast_failures` times in a row is abandoned, and the
+    # supervisor stops once every slot is. SIGTERM or SIGINT is forwarded to every worker as SIGTERM so each
+    # drains its in-flight messages, and the latest stats of every worker are summed for reporting.
+
+    def __init__(self, make_spider: SpiderFactory, listen_args: ListenArgs,  # pylint: disable=too-many-arguments
+                 workers: int = 1,
+                 restart_delay: float = 1.0,
+                 report_interval: float = 60.0,
+                 max_fast_failures: int = 5,
+                 fast_failure: float = 30.0) -> None:
+        self.__make_spider = make_spider
+        self.__listen_args = listen_args
+        self.__workers = [None] * max(1, workers)  # type: typing.List[typing.Optional[multiprocessing.Process]]
+        self.__restart_delay = restart_delay
+        self.__report_interval = report_interval
+        self.__max_fast_failures = max_fast_failures
+        self.__fast_failure = fast_failure
+        self.__started_at = [0.0] * len(self.__workers)
+        self.__fast_failures = [0] * len(self.__workers)
+        self.__abandoned = set()  # type: typing.Set[int]
+
+        self.__stats_queue = CONTEXT.Queue()  # type: multiprocessing.Queue
+        self.__worker_stats = {}  # type: typing.Dict[int, Stats]
+        self.__stopping = threading.Event()
+        self.restarts = 0
+
+    def __start(self, slot: int) -> None:
+        process = CONTEXT.Process(
+            target=_worker_main,
+            args=(self.__make_spider, self.__listen_args, self.__stats_queue, self.__report_interval),
+            name='{}{}'.format(WORKER_PREFIX, slot))
+        process.start()
+        self.__workers[slot] = process
+        self.__started_at[slot] = time.monotonic()
+        LOG.info('Started worker %s as pid %s', slot, process.pid)
+
+    def __collect(self) -> None:
+        while True:
+            try:
+                pid, stats = self.__stats_queue.get_nowait()
+            except queue.Empty:
+                return
+            self.__worker_stats[pid] = stats
+
+    def stats(self) -> Stats:
+        self.__collect()
+        totals = collections.Counter()  # type: typing.Counter[str]
+        for stats in self.__worker_stats.values():
+            totals.update(stats)
+        totals['workers'] = sum(1 for process in self.__workers if process is not None and process.is_alive())
+        totals['restarts'] = self.restarts
+        return dict(totals)
+
+    def stop(self) -> None:
+        self.__stopping.set()
+
+    def __handle_signal(self, signum: int, _: typing.Any) -> None:
+        LOG.info('Received signal %s, stopping %s workers', signum, len(self.__workers))
+        self.stop()
+
+    def __restart_delay_for(self, slot: int) -> float:
+        failures = self.__fast_failures[slot]
+        return min(MAX_RESTART_DELAY, self.__restart_delay * 2 ** max(0, failures - 1))
+
+    def __restart_exited(self, exited_at: typing.Dict[int, float]) -> None:
+        now = time.monotonic()
+        for slot, process in enumerate(self.__workers):
+            if slot in self.__abandoned:
+                continue
+            if process is not None and not process.is_alive():
+                LOG.warning('Worker %s (pid %s) exited with code %s', slot, process.pid, process.exitcode)
+                self.__workers[slot] = None
+                exited_at[slot] = now
+                if now - self.__started_at[slot] < self.__fast_failure:
+                    self.__fast_failures[slot] += 1
+                else:
+                    self.__fast_failures[slot] = 0
+                if self.__fast_failures[slot] >= self.__max_fast_failures:
+                    LOG.error('Worker %s failed %s times in a row right after starting; not restarting it', slot,
+                              self.__fast_failures[slot])
+                    self.__abandoned.add(slot)
+                    continue
+            if self.__workers[slot] is None and now - exited_at.get(slot, 0.0) >= self.__restart_delay_for(slot):
+                self.restarts += 1
+                self.__start(slot)
+        if len(self.__abandoned) == len(self.__workers):
+            LOG.error('Every worker keeps failing at startup, stopping')
+            self.stop()
+
+    def __shutdown(self) -> None:
+        for process in self.__workers:
+            if process is not None and process.is_alive():
+                process.terminate()
+        for process in self.__workers:
+            if process is not None:
+                while process.is_alive():
+                    self.__collect()
+                    process.join(POLL_SECONDS)
+        self.__collect()
+
+    def run(self) -> Stats:
+        previous_handlers = {}  # type: typing.Dict[int, typing.Any]
+        if threading.current_thread() is threading.main_thread():
+            for signum in (signal.SIGTERM, signal.SIGINT):
+                previous_handlers[signum] = signal.signal(signum, self.__handle_signal)
+
+        self.__stopping.clear()
+        for slot in range(len(self.__workers)):
+            self.__start(slot)
+        exited_at = {}  # type: typing.Dict[int, float]
+        next_report = time.monotonic() + self.__report_interval
+        try:
+            while not self.__stopping.wait(POLL_SECONDS):
+                self.__collect()
+                self.__restart_exited(exited_at)
+                if time.monotonic() >= next_report:
+                    LOG.info('Worker stats: %s', self.stats())
+                    next_report = time.monotonic() + self.__report_interval
+        finally:
+            self.__shutdown()
+            for signum, handler in previous_handlers.items():
+                signal.signal(signum, handler)
+
+        stats = self.stats()
+        LOG.info('Stopped all workers. Totals: %s', stats)
+        return stats
@@ -0,0 +1,112 @@
+import datetime
+import typing
+from scraper import acts_scraper
+
+# Version 2 of the breadcrumb message format. Messages without a version attribute are version 1: the full URL as
+# data and the breadcrumb attrs copied verbatim into Pub/Sub attributes.
+VERSION = '2'
+VERSION_KEY = '_v'
+
+# Well-known attrs travel under short keys. Any other attr keeps its own name, with keys starting with '_' escaped
+# by an extra leading '_' so they cannot collide with the short ones.
+SHORT_KEYS = {
+    'type': '_t',
+    'code': '_c',
+    'title': '_n',
+    'start': '_s',
+    'end': '_e',
+}
+LONG_KEYS = {short: long for long, short in SHORT_KEYS.items()}
+
+# The crawl timestamp is sent as base-36 microseconds since the epoch; anything else is sent as-is.
+GENERATION_KEY = '_g'
+TIMESTAMP_KEY = '_T'
+EPOCH = datetime.datetime(1970, 1, 1)
+TIMESTAMP_FORMATS = ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S')
+
+# URLs under a known prefix are sent relative to it, with the prefix's index in this tuple. Only append to it.
+BASE_URL_KEY = '_u'
+BASE_URLS = (
+    'http://laws-lois.justice.gc.ca/eng/acts/',
+    'https://laws-lois.justice.gc.ca/eng/acts/',
+)
+
+DIGITS = '0123456789abcdefghijklmnopqrstuvwxyz'
+
+
+def _to_base36(value: int) -> str:
+    digits = []
+    while True:
+        value, digit = divmod(value, 36)
+        digits.append(DIGITS[digit])
+        if not value:
+            return ''.join(reversed(digits))
+
+
+def encode_timestamp(timestamp: str) -> typing.Optional[str]:
+    for timestamp_format in TIMESTAMP_FORMATS:
+        try:
+            moment = datetime.datetime.strptime(timestamp, timestamp_format)
+        except ValueError:
+            continue
+        if moment.isoformat() != timestamp or moment < EPOCH:
+            return None
+        return _to_base36((moment - EPOCH) // datetime.timedelta(microseconds=1))
+    return None
+
+
+def decode_timestamp(generation: str) -> str:
+    return (EPOCH + datetime.timedelta(microseconds=int(generation, 36))).isoformat()
+
+
+def encode(breadcrumb: acts_scraper.Breadcrumb) -> typing.Tuple[bytes, typing.Dict[str, str]]:
+    attrs = {VERSION_KEY: VERSION}
+    for key, value in breadcrumb.attrs.items():
+        if key in SHORT_KEYS:
+            attrs[SHORT_KEYS[key]] = value
+        elif key == 'timestamp':
+            generation = encode_timestamp(value)
+            if generation is None:
+                attrs[TIMESTAMP_KEY] = value
+            else:
+                attrs[GENERATION_KEY] = generation
+        elif key.startswith('_'):
+            attrs['_' + key] = value
+        else:
+            attrs[key] = value
+
+    url = breadcrumb.url
+    for i, base_url in enumerate(BASE_URLS):
+        if url.startswith(base_url):
+            url = url[len(base_url):]
+            attrs[BASE_URL_KEY] = str(i)
+            break
+    return url.encode('utf-8'), attrs
+
+
+def message_type(message_attrs: typing.Mapping[str, str]) -> str:
+    if message_attrs.get(VERSION_KEY) == VERSION:
+        return message_attrs.get(SHORT_KEYS['type'], '')
+    return message_attrs.get('type', '')
+
+
+def decode(data: bytes, message_attrs: typing.Mapping[str, str]) -> acts_scraper.Breadcrumb:
+    url = data.decode('utf-8')
+    if message_attrs.get(VERSION_KEY) != VERSION:
+        return acts_scraper.Breadcrumb(url=url, attrs=dict(message_attrs))
+
+    attrs = {}  # type: typing.Dict[str, str]
+    for key, value in message_attrs.items():
+        if key in LONG_KEYS:
+            attrs[LONG_KEYS[key]] = value
+        elif key == GENERATION_KEY:
+            attrs['timestamp'] = decode_timestamp(value)
+        elif key == TIMESTAMP_KEY:
+            attrs['timestamp'] = value
+        elif key == BASE_URL_KEY:
+            url = BASE_URLS[int(value)] + url
+        elif key.startswith('__'):
+            attrs[key[1:]] = value
+        elif key != VERSION_KEY:
+            attrs[key] = value
+    return acts_scraper.Breadcrumb(url=url, attrs=attrs)
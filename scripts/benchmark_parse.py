@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# Parsing throughput on the fixture corpus, in-process and on process pools.
+import argparse
+import glob
+import os
+import sys
+import time
+import typing
+from concurrent import futures
+
+sys.path.insert(0, os.path.normpath(os.path.join(os.path.dirname(__file__), '..')))
+
+from scraper import acts_scraper  # pylint: disable=wrong-import-position
+
+FIXTURES = os.path.normpath(os.path.join(os.path.dirname(__file__), '..', 'tests', 'scraper', 'fixtures'))
+ITEM_ATTRS = {'code': 'A-1', 'title': 'Access to Information Act', 'start': '2015-07-09', 'end': '2015-07-29'}
+
+Page = typing.Tuple[acts_scraper.Breadcrumb, str, bytes]  # pylint: disable=invalid-name
+
+
+def load_corpus() -> typing.List[Page]:
+    patterns = [
+        ('acts_home.html', 'main_page'),
+        ('[A-Z].html', 'letter_page'),
+        (os.path.join('*', 'index.html'), 'act_main'),
+        (os.path.join('*', 'PITIndex.html'), 'act_versions'),
+        (os.path.join('*', '*', 'P1TT3xt3.html'), 'act_item'),
+    ]
+    pages = []
+    for pattern, page_type in patterns:
+        for filename in sorted(glob.glob(os.path.join(FIXTURES, pattern))):
+            attrs = dict(ITEM_ATTRS, type=page_type)
+            url = 'file://' + filename
+            with open(filename, 'rb') as f:
+                pages.append((acts_scraper.Breadcrumb(url=url, attrs=attrs), url, f.read()))
+    return pages
+
+
+def run_serial(pages: typing.Sequence[Page]) -> float:
+    start = time.perf_counter()
+    for page in pages:
+        acts_scraper.ActsScraper.parse_content(*page)
+    return time.perf_counter() - start
+
+
+def run_pool(pages: typing.Sequence[Page], workers: int) -> float:
+    with futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        list(pool.map(acts_scraper.ActsScraper.parse_content, *zip(*pages[:workers])))  # warm up workers
+        start = time.perf_counter()
+        list(pool.map(acts_scraper.ActsScraper.parse_content, *zip(*pages), chunksize=4))
+        return time.perf_counter() - start
+
+
+def main() -> None:
+    arg_parser = argparse.ArgumentParser(description='Parsing throughput on the fixture corpus.')
+    arg_parser.add_argument('--repeat', type=int, default=50, help='Copies of the fixture corpus to parse.')
+    args = arg_parser.parse_args()
+
+    pages = load_corpus() * args.repeat
+    print('{} pages, {} cores'.format(len(pages), os.cpu_count()))
+
+    baseline = run_serial(pages)
+    print('{:>12} {:>10.1f} pages/s'.format('in-process', len(pages) / baseline))
+
+    workers = 1
+    while workers <= (os.cpu_count() or 1):
+        elapsed = run_pool(pages, workers)
+        print('{:>12} {:>10.1f} pages/s  x{:.2f}'.format(
+            '{} procs'.format(workers), len(pages) / elapsed, baseline / elapsed))
+        workers *= 2
+
+
+if __name__ == '__main__':
+    main()
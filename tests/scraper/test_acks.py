@@ -0,0 +1,90 @@
+import time
+import typing
+from scraper import acks
+
+
+class RecordingSubscription:
+
+    def __init__(self) -> None:
+        self.acknowledged = []  # type: typing.List[typing.List[str]]
+        self.extended = []  # type: typing.List[typing.Tuple[typing.List[str], int]]
+
+    def acknowledge(self, ack_ids: typing.List[str]) -> None:
+        self.acknowledged.append(list(ack_ids))
+
+    def modify_ack_deadline(self, ack_ids: typing.List[str], ack_deadline: int) -> None:
+        self.extended.append((list(ack_ids), ack_deadline))
+
+
+def test_acks_are_coalesced_by_size() -> None:
+    sub = RecordingSubscription()
+    manager = acks.AckManager(sub, max_batch=3, max_latency=60)
+    for i in range(7):
+        manager.track('ack-{}'.format(i), 'msg-{}'.format(i))
+        manager.ack('ack-{}'.format(i))
+
+    assert sub.acknowledged == [['ack-0', 'ack-1', 'ack-2'], ['ack-3', 'ack-4', 'ack-5']]
+    manager.flush()
+    assert sub.acknowledged[-1] == ['ack-6']
+    assert manager.stats()['ack_rpcs'] == 3
+    assert manager.stats()['acked'] == 7
+
+
+def test_acks_are_flushed_by_latency() -> None:
+    sub = RecordingSubscription()
+    manager = acks.AckManager(sub, max_batch=100, max_latency=0.01)
+    manager.ack('ack-0')
+    manager.flush_if_due()
+    assert sub.acknowledged == []
+    time.sleep(0.02)
+    manager.flush_if_due()
+    assert sub.acknowledged == [['ack-0']]
+
+
+def test_leases_are_extended_until_acked() -> None:
+    sub = RecordingSubscription()
+    manager = acks.AckManager(sub, lease_seconds=30)
+    manager.track('ack-0', 'msg-0')
+    manager.track('ack-1', 'msg-1')
+    manager.extend_leases()
+    manager.ack('ack-0')
+    manager.extend_leases()
+
+    assert sub.extended == [(['ack-0', 'ack-1'], 30), (['ack-1'], 30)]
+    assert manager.stats()['lease_rpcs'] == 2
+    assert manager.stats()['leased'] == 1
+
+
+def test_background_thread_flushes_and_extends() -> None:
+    sub = RecordingSubscription()
+    manager = acks.AckManager(sub, max_latency=0.01, lease_interval=0.01)
+    manager.start()
+    manager.track('ack-0', 'msg-0')
+    manager.track('ack-1', 'msg-1')
+    manager.ack('ack-0')
+    time.sleep(0.1)
+    manager.stop()
+
+    assert ['ack-0'] in sub.acknowledged
+    assert (['ack-1'], 60) in sub.extended
+    assert not manager.running
+
+
+def test_redeliveries_are_counted() -> None:
+    manager = acks.AckManager(RecordingSubscription())
+    manager.track('ack-0', 'msg-0')
+    manager.ack('ack-0')
+    manager.track('ack-1', 'msg-0')
+    manager.track('ack-2', 'msg-2')
+    assert manager.stats()['redeliveries'] == 1
+
+
+def test_before_flush_runs_ahead_of_acknowledge() -> None:
+    sub = RecordingSubscription()
+    calls = []  # type: typing.List[int]
+    manager = acks.AckManager(sub, before_flush=lambda: calls.append(len(sub.acknowledged)))
+    manager.flush()
+    manager.ack('ack-0')
+    manager.flush()
+    assert calls == [0]
+    assert sub.acknowledged == [['ack-0']]
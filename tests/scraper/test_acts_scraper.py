@@ -1,5 +1,6 @@
 import datetime
 import os
+from lxml import etree  # type: ignore
 
 from scraper import acts_scraper
 
@@ -203,3 +204,44 @@ def test_parse_act_item_skip_old() -> None:
 
     assert breadcrumbs == []
     assert items == []
+
+
+def test_parse_in_process_pool() -> None:
+    fixture_filename = get_fixture('A-1', 'PITIndex.html')
+    attrs = {'code': 'A-1', 'title': 'Access to Information Act', 'type': 'act_versions'}
+    input_breadcrumb = acts_scraper.Breadcrumb(url='file://' + fixture_filename, attrs=attrs)
+
+    scraper = acts_scraper.ActsScraper(parse_processes=2)
+    result = scraper.scrape(input_breadcrumb)
+    scraper.close()
+
+    expected = acts_scraper.ActsScraper().scrape(input_breadcrumb)
+    assert result
+    assert expected
+    assert [crumb.url for crumb in result[0]] == [crumb.url for crumb in expected[0]]
+    assert [crumb.attrs['start'] for crumb in result[0]] == [crumb.attrs['start'] for crumb in expected[0]]
+
+
+def test_registered_page_type_is_scraped() -> None:
+    page_type = acts_scraper.register_page_type(acts_scraper.PageType(
+        name='test_letter_index',
+        links=etree.XPath('//div[@class="contentBlock"]/ul/li/span[@class="objTitle"]/a'),
+        child_type='test_act',
+        link_attrs=lambda link, _: {'title': link.text.strip()},
+    ))
+    try:
+        input_breadcrumb = acts_scraper.Breadcrumb(url='file://' + get_fixture('A.html'),
+                                                   attrs={'type': page_type.name})
+        scraper = acts_scraper.ActsScraper()
+        assert page_type.name in scraper.page_types
+        result = scraper.scrape(input_breadcrumb)
+    finally:
+        del acts_scraper.PAGE_TYPES[page_type.name]
+
+    assert result
+    breadcrumbs, items = result
+    assert items == []
+    assert {crumb.attrs['type'] for crumb in breadcrumbs} == {'test_act'}
+    assert sorted(crumb.attrs['title'] for crumb in breadcrumbs) == [
+        'Access to Information Act', 'Administrative Tribunals Support Service of Canada Act'
+    ]
@@ -1,7 +1,13 @@
+import collections
+import hashlib
+import io
+import typing
+import pytest
 from google.cloud import datastore
 
 from scraper import acts_scraper
 from scraper import acts_storage
+from scraper import metrics
 from scraper import storage
 
 
@@ -62,5 +68,161 @@ def test_store_item(datastore_client: datastore.Client, stor: storage.Storage) -
 
     act_version_key = datastore_client.key('ActVersion', item.start, parent=act_key)
     act_version = datastore_client.get(act_version_key)
-    assert dict(act_version) == {'start': '2016-01-01', 'end': '2016-02-01', 'raw_blob': 'acts/raw/A-1/2016-01-01'}
+    digest = hashlib.sha256(b'Text of Act').hexdigest()
+    assert dict(act_version) == {'start': '2016-01-01', 'end': '2016-02-01',
+                                 'raw_blob': 'acts/raw/sha256/{}'.format(digest), 'raw_hash': digest}
     assert stor.get_blob(act_version['raw_blob']).download_to_string() == 'Text of Act'
+
+
+def test_store_streamed_item(datastore_client: datastore.Client, stor: storage.Storage) -> None:
+    item = acts_scraper.ActItem(
+        code='A-1',
+        title='Access to Information Act',
+        body=io.BytesIO('Text of Act'.encode('utf-8')),
+        start='2016-01-01',
+        end='2016-02-01',
+    )
+
+    acts_storage.ActsStorage(datastore_client, stor).store(item)
+
+    act_key = datastore_client.key('Act', item.code)
+    act_version = datastore_client.get(datastore_client.key('ActVersion', item.start, parent=act_key))
+    assert stor.get_blob(act_version['raw_blob']).download_to_string() == 'Text of Act'
+
+
+class CountingDatastore:
+
+    def __init__(self, client: datastore.Client) -> None:
+        self.__client = client
+        self.rpcs = collections.Counter()  # type: typing.Counter[str]
+
+    def __getattr__(self, name: str) -> typing.Any:
+        if name in ('get', 'get_multi', 'put', 'put_multi'):
+            self.rpcs[name] += 1
+        return getattr(self.__client, name)
+
+
+def test_store_items_in_batches(datastore_client: datastore.Client, stor: storage.Storage) -> None:
+    existing = acts_scraper.ActItem(code='A-1', title='Old Title', body='Old text', start='2015-01-01',
+                                    end='2016-01-01')
+    acts_storage.ActsStorage(datastore_client, stor).store(existing)
+
+    counting_client = CountingDatastore(datastore_client)
+    acts_stor = acts_storage.ActsStorage(counting_client, stor, batch_size=10, max_latency=60)
+    items = [existing._replace(body='Changed text')] + [
+        acts_scraper.ActItem(code=code, title='Title', body='Text of {} {}'.format(code, start), start=start,
+                             end='2017-01-01')
+        for code in ('A-1', 'B-2') for start in ('2016-01-01', '2016-06-01')
+    ]
+    for item in items:
+        acts_stor.store(item)
+    assert sum(counting_client.rpcs.values()) == 0
+
+    acts_stor.flush()
+    assert counting_client.rpcs == {'get_multi': 1, 'put_multi': 1}
+
+    act = datastore_client.get(datastore_client.key('Act', 'A-1'))
+    assert act['title'] == 'Old Title'
+    assert stor.get_blob(acts_storage.raw_path(acts_storage.raw_hash('Old text'))).download_to_string() == 'Old text'
+    for code in ('A-1', 'B-2'):
+        act_key = datastore_client.key('Act', code)
+        version = datastore_client.get(datastore_client.key('ActVersion', '2016-06-01', parent=act_key))
+        digest = acts_storage.raw_hash('Text of {} 2016-06-01'.format(code))
+        assert dict(version) == {'start': '2016-06-01', 'end': '2017-01-01', 'raw_blob': acts_storage.raw_path(digest),
+                                 'raw_hash': digest}
+
+
+def test_known_versions_are_skipped_without_rpcs(datastore_client: datastore.Client, stor: storage.Storage) -> None:
+    counting_client = CountingDatastore(datastore_client)
+    acts_stor = acts_storage.ActsStorage(counting_client, stor)
+    item = acts_scraper.ActItem(code='A-1', title='Title', body='Text', start='2016-01-01', end='2017-01-01')
+    acts_stor.store(item)
+    assert sum(counting_client.rpcs.values()) == 2
+
+    acts_stor.store(item._replace(body='Changed text'))
+    assert sum(counting_client.rpcs.values()) == 2
+    assert stor.get_blob(acts_storage.raw_path(acts_storage.raw_hash('Text'))).download_to_string() == 'Text'
+
+    # A new version of a known Act with a known body only looks up the version.
+    acts_stor.store(item._replace(start='2017-01-01', end='2018-01-01'))
+    assert counting_client.rpcs == {'get_multi': 2, 'put_multi': 2}
+
+
+def test_warm_cache(datastore_client: datastore.Client, stor: storage.Storage) -> None:
+    item = acts_scraper.ActItem(code='A-1', title='Title', body='Text', start='2016-01-01', end='2017-01-01')
+    acts_storage.ActsStorage(datastore_client, stor).store(item)
+    act_key = datastore_client.key('Act', 'A-1')
+    unblobbed = datastore.Entity(datastore_client.key('ActVersion', '2017-01-01', parent=act_key))
+    unblobbed.update({'start': '2017-01-01', 'end': '2018-01-01'})
+    datastore_client.put(unblobbed)
+
+    counting_client = CountingDatastore(datastore_client)
+    cache = acts_storage.KeyCache()
+    acts_stor = acts_storage.ActsStorage(counting_client, stor, cache=cache)
+    assert acts_stor.warm() == 3
+    assert cache.get(act_key) is False
+    assert cache.get(datastore_client.key('ActVersion', '2016-01-01', parent=act_key)) is True
+    assert cache.get(unblobbed.key) is None
+
+    acts_stor.store(item)
+    assert sum(counting_client.rpcs.values()) == 0
+
+
+def test_key_cache_bounds(datastore_client: datastore.Client) -> None:
+    keys = [datastore_client.key('Act', str(number)) for number in range(3)]
+    cache = acts_storage.KeyCache(size=2)
+    for key in keys:
+        cache.set(key, True)
+    assert len(cache) == 2
+    assert cache.get(keys[0]) is None
+    assert cache.get(keys[2]) is True
+    cache.invalidate(keys[2])
+    assert cache.get(keys[2]) is None
+
+    expired = acts_storage.KeyCache(ttl=0.0)
+    expired.set(keys[0], True)
+    assert expired.get(keys[0]) is None
+
+
+def test_identical_bodies_are_uploaded_once(datastore_client: datastore.Client, stor: storage.Storage) -> None:
+    deduplicated = metrics.REGISTRY.counter(metrics.DEDUPLICATED_BLOBS)
+    acts_stor = acts_storage.ActsStorage(datastore_client, stor, batch_size=3)
+    bodies = [io.BytesIO(b'Same text') for _ in range(3)]
+    for body, (code, start) in zip(bodies, (('A-1', '2016-01-01'), ('A-1', '2017-01-01'), ('B-2', '2016-01-01'))):
+        acts_stor.store(acts_scraper.ActItem(code=code, title='Title', body=body, start=start, end=''))
+    assert all(body.closed for body in bodies)
+    # A separate process sees the index entry and skips the upload too.
+    acts_storage.ActsStorage(datastore_client, stor).store(
+        acts_scraper.ActItem(code='C-3', title='Title', body='Same text', start='2016-01-01', end=''))
+
+    digest = acts_storage.raw_hash('Same text')
+    assert [blob.key.name for blob in datastore_client.query(kind='RawBlob').fetch()] == [digest]
+    assert metrics.REGISTRY.counter(metrics.DEDUPLICATED_BLOBS) - deduplicated == 3
+    versions = list(datastore_client.query(kind='ActVersion').fetch())
+    assert len(versions) == 4
+    assert {version['raw_hash'] for version in versions} == {digest}
+    assert stor.get_blob(acts_storage.raw_path(digest)).download_to_string() == 'Same text'
+
+
+def test_failed_batch_is_dropped(datastore_client: datastore.Client, stor: storage.Storage) -> None:
+    failing_client = CountingDatastore(datastore_client)
+    acts_stor = acts_storage.ActsStorage(failing_client, stor, batch_size=2, max_latency=60)
+    item = acts_scraper.ActItem(code='A-1', title='Title', body='Text', start='2016-01-01', end='2017-01-01')
+    errors = []  # type: typing.List[Exception]
+
+    acts_stor.store(item, failed=errors.append)
+    failing_client.put_multi = _raise_io_error
+    with pytest.raises(IOError):
+        acts_stor.store(item._replace(code='A-2'), failed=errors.append)
+    assert len(errors) == 2
+
+    # The dropped items are not written again by later batches.
+    del failing_client.put_multi
+    acts_stor.store(item._replace(code='A-3'))
+    acts_stor.flush()
+    assert datastore_client.get(datastore_client.key('Act', 'A-1')) is None
+    assert datastore_client.get(datastore_client.key('Act', 'A-3'))
+
+
+def _raise_io_error(*_: typing.Any) -> None:
+    raise IOError('datastore unavailable')
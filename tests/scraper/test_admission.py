@@ -0,0 +1,66 @@
+import datetime
+from scraper import acts_scraper
+from scraper import admission
+from scraper import fetcher
+
+
+def test_admits_fresh_breadcrumbs() -> None:
+    gate = admission.Admission()
+    attrs = {'type': 'act_main', 'timestamp': datetime.datetime.now().isoformat()}
+    assert gate.admit('http://laws-lois.justice.gc.ca/eng/acts/A-1/', attrs) is None
+    assert gate.admit('http://laws-lois.justice.gc.ca/eng/acts/', {'type': 'main_page'}) is None
+
+
+def test_rejects_stale_breadcrumbs() -> None:
+    gate = admission.Admission()
+    attrs = {'type': 'act_main', 'timestamp': datetime.datetime(2016, 1, 1).isoformat()}
+    assert gate.admit('http://laws-lois.justice.gc.ca/eng/acts/A-1/', attrs) == admission.STALE
+    assert gate.drops == {admission.STALE: 1}
+
+
+def test_rejects_disallowed_breadcrumbs() -> None:
+    gate = admission.Admission(allowed_types=['act_main'], allowed_hosts=['laws-lois.justice.gc.ca'])
+    assert gate.admit('http://laws-lois.justice.gc.ca/eng/acts/A-1/', {'type': 'act_main'}) is None
+    assert gate.admit('http://example.com/eng/acts/A-1/', {'type': 'act_main'}) == admission.DISALLOWED
+    assert gate.admit('http://laws-lois.justice.gc.ca/eng/acts/A-1/', {'type': 'foo'}) == admission.DISALLOWED
+    assert gate.drops == {admission.DISALLOWED: 2}
+
+
+def test_rejects_local_files_unless_allowed() -> None:
+    gate = admission.Admission(allowed_hosts=['laws-lois.justice.gc.ca'], allowed_schemes=['http', 'https'])
+    assert gate.admit('file:///etc/passwd', {'type': 'act_main'}) == admission.DISALLOWED
+    assert admission.Admission(allowed_hosts=['laws-lois.justice.gc.ca']).admit(
+        'file:///etc/passwd', {'type': 'act_main'}) == admission.DISALLOWED
+
+    gate = admission.Admission(allowed_schemes=['file'])
+    assert gate.admit('file:///tmp/fixture.html', {'type': 'act_main'}) is None
+    assert gate.admit('http://laws-lois.justice.gc.ca/eng/acts/A-1/', {'type': 'act_main'}) == admission.DISALLOWED
+
+
+def test_rejects_duplicates_within_a_crawl() -> None:
+    gate = admission.Admission(dedup_size=2)
+    url = 'http://laws-lois.justice.gc.ca/eng/acts/A-1/'
+    attrs = {'type': 'act_main', 'timestamp': datetime.datetime.now().isoformat()}
+
+    assert gate.admit(url, attrs) is None
+    gate.mark_done(url, attrs)
+    assert gate.admit(url, attrs) == admission.DUPLICATE
+
+    next_crawl = dict(attrs, timestamp=(datetime.datetime.now() + datetime.timedelta(seconds=1)).isoformat())
+    assert gate.admit(url, next_crawl) is None
+
+    gate.mark_done(url + 'a', attrs)
+    gate.mark_done(url + 'b', attrs)
+    assert gate.admit(url, attrs) is None
+
+
+class FailingFetcher(fetcher.Fetcher):
+
+    def get(self, url, headers=None, stream=False):
+        raise AssertionError('Stale breadcrumbs must not be fetched')
+
+
+def test_scraper_does_not_fetch_stale_breadcrumbs() -> None:
+    attrs = {'type': 'act_main', 'timestamp': datetime.datetime(2016, 1, 1).isoformat()}
+    input_breadcrumb = acts_scraper.Breadcrumb(url='http://laws-lois.justice.gc.ca/eng/acts/A-1/', attrs=attrs)
+    assert acts_scraper.ActsScraper(FailingFetcher()).scrape(input_breadcrumb) == ([], [])
@@ -0,0 +1,44 @@
+import asyncio
+import os
+from scraper import acts_scraper
+from scraper import async_scraper
+
+
+def get_fixture(*rel_path: str) -> str:
+    return os.path.join(os.path.dirname(__file__), 'fixtures', *rel_path)
+
+
+def test_async_scrape_matches_sync_scrape() -> None:
+    input_breadcrumb = acts_scraper.Breadcrumb(url='file://' + get_fixture('A.html'), attrs={'type': 'letter_page'})
+    scraper = async_scraper.AsyncActsScraper(concurrency=2)
+
+    loop = asyncio.new_event_loop()
+    result = loop.run_until_complete(scraper.scrape(input_breadcrumb))
+    expected = acts_scraper.ActsScraper().scrape(input_breadcrumb)
+    scraper.close()
+    loop.close()
+
+    assert result
+    assert expected
+    assert [crumb.url for crumb in result[0]] == [crumb.url for crumb in expected[0]]
+
+
+def test_async_scrape_many_keeps_order() -> None:
+    input_breadcrumbs = [
+        acts_scraper.Breadcrumb(url='file://' + get_fixture('acts_home.html'), attrs={'type': 'main_page'}),
+        acts_scraper.Breadcrumb(url='file://' + get_fixture('A.html'), attrs={'type': 'letter_page'}),
+        acts_scraper.Breadcrumb(url='file://' + get_fixture('A.html'), attrs={}),
+        acts_scraper.Breadcrumb(url='file://' + get_fixture('A-1', 'PITIndex.html'),
+                                attrs={'type': 'act_versions', 'code': 'A-1', 'title': 'Access to Information Act'}),
+    ]
+    scraper = async_scraper.AsyncActsScraper(concurrency=3)
+
+    loop = asyncio.new_event_loop()
+    results = loop.run_until_complete(scraper.scrape_many(input_breadcrumbs))
+    scraper.close()
+    loop.close()
+
+    assert len(results) == 4
+    assert results[2] is None
+    types = [{crumb.attrs['type'] for crumb in result[0]} for result in results if result]
+    assert types == [{'letter_page'}, {'act_main'}, {'act_item'}]
@@ -0,0 +1,40 @@
+import os
+import typing
+import requests
+from scraper import acts_scraper
+from scraper import fetcher
+
+
+def get_fixture(*rel_path: str) -> str:
+    return os.path.join(os.path.dirname(__file__), 'fixtures', *rel_path)
+
+
+class CountingFetcher(fetcher.Fetcher):
+
+    def __init__(self) -> None:
+        self.urls = []  # type: typing.List[str]
+        self.__fetcher = fetcher.HttpFetcher()
+
+    def get(self, url: str, headers: typing.Optional[typing.Dict[str, str]] = None,
+            stream: bool = False) -> requests.Response:
+        self.urls.append(url)
+        return self.__fetcher.get(url, headers=headers, stream=stream)
+
+
+def test_http_fetcher_reads_file_urls() -> None:
+    http_fetcher = fetcher.HttpFetcher(pool_maxsize=2, timeout=5.0)
+    response = http_fetcher.get('file://' + get_fixture('acts_home.html'))
+    assert response.status_code == 200
+    assert b'alphaList' in response.content
+    http_fetcher.close()
+
+
+def test_scraper_reuses_injected_fetcher() -> None:
+    http_fetcher = CountingFetcher()
+    scraper = acts_scraper.ActsScraper(http_fetcher)
+
+    urls = ['file://' + get_fixture('acts_home.html'), 'file://' + get_fixture('A.html')]
+    scraper.scrape(acts_scraper.Breadcrumb(url=urls[0], attrs={'type': 'main_page'}))
+    scraper.scrape(acts_scraper.Breadcrumb(url=urls[1], attrs={'type': 'letter_page'}))
+
+    assert http_fetcher.urls == urls
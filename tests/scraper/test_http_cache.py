@@ -0,0 +1,149 @@
+import io
+import os
+import typing
+import py  # pylint:disable=unused-import
+import pytest
+import requests
+from scraper import acts_scraper
+from scraper import fetcher
+from scraper import http_cache
+
+
+def get_fixture(*rel_path: str) -> str:
+    return os.path.join(os.path.dirname(__file__), 'fixtures', *rel_path)
+
+
+class ConditionalFetcher(fetcher.Fetcher):
+
+    def __init__(self) -> None:
+        self.requests = []  # type: typing.List[typing.Dict[str, str]]
+
+    def get(self, url: str, headers: typing.Optional[typing.Dict[str, str]] = None,
+            stream: bool = False) -> requests.Response:
+        headers = headers or {}
+        self.requests.append(headers)
+
+        response = requests.Response()
+        response.url = url
+        response.headers['ETag'] = '"v1"'
+        if headers.get('If-None-Match') == '"v1"':
+            response.status_code = 304
+            response._content = b''  # pylint: disable=protected-access
+        else:
+            response.status_code = 200
+            with open(url[len('file://'):], 'rb') as f:
+                body = f.read()
+            if stream:
+                response.raw = io.BytesIO(body)
+            else:
+                response._content = body  # pylint: disable=protected-access
+        return response
+
+
+@pytest.fixture
+def cache(tmpdir: 'py.path.local') -> http_cache.HttpCache:
+    return http_cache.HttpCache(str(tmpdir.join('http_cache')))
+
+
+def test_conditional_get_replays_cached_body(cache: http_cache.HttpCache) -> None:
+    inner = ConditionalFetcher()
+    caching_fetcher = http_cache.CachingFetcher(inner, cache)
+    url = 'file://' + get_fixture('A.html')
+
+    first = caching_fetcher.get(url)
+    second = caching_fetcher.get(url)
+
+    assert inner.requests == [{}, {'If-None-Match': '"v1"'}]
+    assert not http_cache.is_cached(first)
+    assert http_cache.is_cached(second)
+    assert second.status_code == 200
+    assert second.content == first.content
+    assert cache.stats()['hits'] == 1
+    assert cache.stats()['misses'] == 1
+
+
+def test_streamed_bodies_are_cached_as_they_are_read(tmpdir: 'py.path.local') -> None:
+    path = str(tmpdir.join('http_cache'))
+    cache = http_cache.HttpCache(path)
+    caching_fetcher = http_cache.CachingFetcher(ConditionalFetcher(), cache)
+    url = 'file://' + get_fixture('A.html')
+    with open(get_fixture('A.html'), 'rb') as f:
+        body = f.read()
+
+    abandoned = caching_fetcher.get(url, stream=True).iter_content(chunk_size=1024)
+    next(abandoned)
+    abandoned.close()
+    assert cache.lookup(url) is None
+    assert os.listdir(path) == []
+
+    first = caching_fetcher.get(url, stream=True)
+    assert b''.join(first.iter_content(chunk_size=1024)) == body
+    second = caching_fetcher.get(url, stream=True)
+    assert http_cache.is_cached(second)
+    assert b''.join(second.iter_content(chunk_size=1024)) == body
+    assert cache.stats()['bytes'] == len(body)
+
+
+def test_cache_evicts_least_recently_used(tmpdir: 'py.path.local') -> None:
+    fixture_size = os.path.getsize(get_fixture('A.html'))
+    cache = http_cache.HttpCache(str(tmpdir.join('http_cache')), max_bytes=fixture_size * 2)
+    urls = ['file://' + get_fixture('A.html') + '?' + str(i) for i in range(3)]
+    for url in urls:
+        response = requests.Response()
+        response.status_code = 200
+        response.headers['ETag'] = '"v1"'
+        response._content = b'x' * fixture_size  # pylint: disable=protected-access
+        cache.store(url, response)
+
+    assert cache.lookup(urls[0]) is None
+    assert cache.lookup(urls[1]) is not None
+    assert cache.lookup(urls[2]) is not None
+    assert cache.stats()['entries'] == 2
+
+
+def test_cache_survives_restart(tmpdir: 'py.path.local') -> None:
+    path = str(tmpdir.join('http_cache'))
+    url = 'file://' + get_fixture('A.html')
+    http_cache.CachingFetcher(ConditionalFetcher(), http_cache.HttpCache(path)).get(url)
+
+    reloaded = http_cache.HttpCache(path)
+    assert reloaded.validators(url) == {'If-None-Match': '"v1"'}
+
+
+def test_scraper_prunes_unchanged_pages(cache: http_cache.HttpCache) -> None:
+    caching_fetcher = http_cache.CachingFetcher(ConditionalFetcher(), cache)
+    scraper = acts_scraper.ActsScraper(caching_fetcher, prune_unchanged=['letter_page'])
+    input_breadcrumb = acts_scraper.Breadcrumb(url='file://' + get_fixture('A.html'), attrs={'type': 'letter_page'})
+
+    first = scraper.scrape(input_breadcrumb)
+    second = scraper.scrape(input_breadcrumb)
+    assert first and len(first[0]) == 2
+    assert second == ([], [])
+
+
+def test_scraper_replays_unchanged_pages_by_default(cache: http_cache.HttpCache) -> None:
+    caching_fetcher = http_cache.CachingFetcher(ConditionalFetcher(), cache)
+    scraper = acts_scraper.ActsScraper(caching_fetcher)
+    input_breadcrumb = acts_scraper.Breadcrumb(url='file://' + get_fixture('A.html'), attrs={'type': 'letter_page'})
+
+    scraper.scrape(input_breadcrumb)
+    result = scraper.scrape(input_breadcrumb)
+    assert result and len(result[0]) == 2
+
+
+def test_files_removed_by_another_process_are_misses(tmpdir: 'py.path.local', cache: http_cache.HttpCache) -> None:
+    inner = ConditionalFetcher()
+    caching_fetcher = http_cache.CachingFetcher(inner, cache)
+    url = 'file://' + get_fixture('A.html')
+    first = caching_fetcher.get(url)
+
+    for filename in os.listdir(str(tmpdir.join('http_cache'))):
+        if filename.endswith('.body'):
+            os.remove(str(tmpdir.join('http_cache', filename)))
+
+    second = caching_fetcher.get(url)
+    assert second.status_code == 200
+    assert second.content == first.content
+    assert not http_cache.is_cached(second)
+    assert cache.stats()['hits'] == 0
+    assert caching_fetcher.get(url).headers[http_cache.CACHE_HEADER] == 'HIT'
@@ -5,6 +5,7 @@ from google.cloud import pubsub
 import pytest
 from scraper import acts_scraper
 from scraper import acts_storage
+from scraper import queues
 from scraper import spider
 from scraper import storage
 
@@ -15,7 +16,7 @@ def acts_spider(pubsub_client: pubsub.Client,
                 stor: storage.Storage) -> spider.ActsSpider:
     scraper = acts_scraper.ActsScraper()
     acts_stor = acts_storage.ActsStorage(datastore_client, stor)
-    return spider.ActsSpider(pubsub_client, scraper, acts_stor)
+    return spider.ActsSpider(queues.PubSubQueue(pubsub_client), scraper, acts_stor)
 
 
 def test_integration(pubsub_client: pubsub.Client,
@@ -37,16 +38,18 @@ def test_integration(pubsub_client: pubsub.Client,
     assert [act['code'] for act in acts] == ['A-1', 'A-1.5', 'B-1.01']
 
     query = datastore_client.query(kind='ActVersion')
-    act_versions = sorted(list(query.fetch()), key=lambda ver: ver['raw_blob'])
+    act_versions = sorted(list(query.fetch()), key=lambda ver: ver.key.flat_path)
     assert len(act_versions) == 6
-    assert [act_version['raw_blob'] for act_version in act_versions] == [
-        'acts/raw/A-1.5/2014-06-19',
-        'acts/raw/A-1.5/2014-11-01',
-        'acts/raw/A-1/2015-07-09',
-        'acts/raw/A-1/2015-07-30',
-        'acts/raw/A-1/2016-04-05',
-        'acts/raw/B-1.01/2017-04-01',
+    assert [act_version.key.flat_path[1::2] for act_version in act_versions] == [
+        ('A-1', '2015-07-09'),
+        ('A-1', '2015-07-30'),
+        ('A-1', '2016-04-05'),
+        ('A-1.5', '2014-06-19'),
+        ('A-1.5', '2014-11-01'),
+        ('B-1.01', '2017-04-01'),
     ]
+    assert all(act_version['raw_blob'] == acts_storage.raw_path(act_version['raw_hash'])
+               for act_version in act_versions)
 
     acts_texts = [stor.get_blob(act_version['raw_blob']).download_to_string() for act_version in act_versions]
     assert all([len(act_text) > 1000 for act_text in acts_texts])
@@ -0,0 +1,49 @@
+import os
+import requests
+from scraper import acts_scraper
+from scraper import metrics
+
+
+def test_render_counters_and_histograms() -> None:
+    registry = metrics.Registry()
+    registry.inc('gitlawca_things_total', 2, type='act_item')
+    registry.inc('gitlawca_things_total', type='act_item')
+    registry.observe('gitlawca_stage_seconds', 0.02, stage='fetch', type='act_item')
+    registry.observe('gitlawca_stage_seconds', 7.0, stage='fetch', type='act_item')
+
+    lines = registry.render().splitlines()
+    assert '# TYPE gitlawca_things_total counter' in lines
+    assert 'gitlawca_things_total{type="act_item"} 3.0' in lines
+    assert '# TYPE gitlawca_stage_seconds histogram' in lines
+    assert 'gitlawca_stage_seconds_bucket{stage="fetch",type="act_item",le="0.01"} 0' in lines
+    assert 'gitlawca_stage_seconds_bucket{stage="fetch",type="act_item",le="0.025"} 1' in lines
+    assert 'gitlawca_stage_seconds_bucket{stage="fetch",type="act_item",le="+Inf"} 2' in lines
+    assert 'gitlawca_stage_seconds_count{stage="fetch",type="act_item"} 2' in lines
+
+    assert registry.summary() == ('gitlawca_stage_seconds{stage="fetch",type="act_item"} n=2 avg=3.510; '
+                                  'gitlawca_things_total{type="act_item"}=3')
+
+
+def test_scraper_records_fetch_and_parse() -> None:
+    before_bytes = metrics.REGISTRY.counter(metrics.FETCHED_BYTES, type='main_page')
+    before_parses, _ = metrics.REGISTRY.histogram(metrics.STAGE_SECONDS, stage='parse', type='main_page')
+
+    fixture = os.path.join(os.path.dirname(__file__), 'fixtures', 'acts_home.html')
+    acts_scraper.ActsScraper().scrape(acts_scraper.Breadcrumb(url='file://' + fixture, attrs={'type': 'main_page'}))
+
+    assert metrics.REGISTRY.counter(metrics.FETCHED_BYTES, type='main_page') - before_bytes == os.path.getsize(fixture)
+    assert metrics.REGISTRY.histogram(metrics.STAGE_SECONDS, stage='parse', type='main_page')[0] == before_parses + 1
+
+
+def test_serve_metrics() -> None:
+    metrics.inc(metrics.ITEMS_STORED, 0)
+    server = metrics.serve(0)
+    try:
+        url = 'http://127.0.0.1:{}'.format(server.server_address[1])
+        response = requests.get(url + '/metrics')
+        assert response.status_code == 200
+        assert metrics.ITEMS_STORED in response.text
+        assert requests.get(url + '/other').status_code == 404
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,31 @@
+from scraper import polling
+
+
+def test_batch_size_ramps_up_under_backlog() -> None:
+    poller = polling.AdaptivePoller(max_messages=10)
+    sizes = []
+    for _ in range(5):
+        assert poller.record(poller.batch_size) == 0.0
+        sizes.append(poller.batch_size)
+    assert sizes == [2, 4, 8, 10, 10]
+
+
+def test_batch_size_shrinks_when_backlog_drains() -> None:
+    poller = polling.AdaptivePoller(max_messages=16)
+    for _ in range(4):
+        poller.record(poller.batch_size)
+    assert poller.batch_size == 16
+    poller.record(3)
+    assert poller.batch_size == 8
+    poller.record(6)
+    assert poller.batch_size == 8
+
+
+def test_idle_delay_backs_off_exponentially() -> None:
+    poller = polling.AdaptivePoller(min_idle=0.5, max_idle=3.0)
+    delays = [poller.record(0) for _ in range(5)]
+    assert delays == [0.5, 1.0, 2.0, 3.0, 3.0]
+    assert poller.batch_size == 1
+
+    assert poller.record(1) == 0.0
+    assert poller.record(0) == 0.5
@@ -0,0 +1,51 @@
+import io
+import os
+import pstats
+import threading
+from scraper import profiling
+
+
+def busy_page(started: threading.Event, stop: threading.Event) -> None:
+    with profiling.tagged('act_item'):
+        started.set()
+        while not stop.is_set():
+            sum(range(1000))
+
+
+def test_samples_are_split_by_type(tmpdir) -> None:
+    profiler = profiling.SamplingProfiler(str(tmpdir), interval=0.001)
+    started = threading.Event()
+    stop = threading.Event()
+    worker = threading.Thread(target=busy_page, args=(started, stop))
+    worker.start()
+    try:
+        started.wait()
+        for _ in range(20):
+            profiler.sample()
+    finally:
+        stop.set()
+        worker.join()
+
+    lines = profiler.collapsed()
+    assert lines
+    assert all(line.startswith('act_item;') for line in lines)
+    assert sum(int(line.rsplit(' ', 1)[1]) for line in lines) == 20
+    assert any('busy_page (test_profiling.py:' in line for line in lines)
+
+    profiler.dump()
+    prefix = os.path.join(str(tmpdir), 'gitlawca-{}'.format(os.getpid()))
+    assert os.path.exists(prefix + '.collapsed')
+    output = io.StringIO()
+    pstats.Stats(prefix + '-act_item.pstats', stream=output).sort_stats('cumulative').print_stats()
+    assert 'busy_page' in output.getvalue()
+
+
+def test_untagged_threads_are_not_sampled(tmpdir) -> None:
+    profiler = profiling.SamplingProfiler(str(tmpdir))
+    profiler.sample()
+    assert profiler.collapsed() == []
+    with profiling.tagged('main_page'):
+        with profiling.tagged('act_item'):
+            pass
+        assert profiling._ACTIVE[threading.get_ident()] == 'main_page'  # pylint: disable=protected-access
+    assert threading.get_ident() not in profiling._ACTIVE  # pylint: disable=protected-access
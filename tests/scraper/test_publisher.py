@@ -0,0 +1,54 @@
+import time
+import typing
+from scraper import publisher
+from scraper import queues
+
+
+class RecordingQueue(queues.MemoryQueue):
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.batches = []  # type: typing.List[typing.List[queues.OutgoingMessage]]
+
+    def publish_batch(self, messages: typing.Sequence[queues.OutgoingMessage]) -> None:
+        self.batches.append(list(messages))
+        super().publish_batch(messages)
+
+
+def test_publishes_are_coalesced_by_count() -> None:
+    topic = RecordingQueue()
+    batch_publisher = publisher.BatchPublisher(topic, max_count=3, max_latency=60)
+    for i in range(7):
+        batch_publisher.publish('url-{}'.format(i).encode('utf-8'), {'type': 'act_item'})
+
+    assert [len(batch) for batch in topic.batches] == [3, 3]
+    batch_publisher.flush()
+    assert [len(batch) for batch in topic.batches] == [3, 3, 1]
+    assert topic.batches[2] == [(b'url-6', {'type': 'act_item'})]
+    assert batch_publisher.stats()['publish_rpcs'] == 3
+    assert batch_publisher.stats()['published'] == 7
+
+
+def test_publishes_are_coalesced_by_bytes() -> None:
+    topic = RecordingQueue()
+    batch_publisher = publisher.BatchPublisher(topic, max_bytes=25, max_latency=60)
+    for _ in range(3):
+        batch_publisher.publish(b'0123456789', {'k': 'v'})
+
+    assert [len(batch) for batch in topic.batches] == [2]
+
+
+def test_publishes_are_flushed_by_latency() -> None:
+    topic = RecordingQueue()
+    batch_publisher = publisher.BatchPublisher(topic, max_latency=0.01)
+    batch_publisher.publish(b'url-0', {})
+    assert topic.batches == []
+    time.sleep(0.02)
+    batch_publisher.flush_if_due()
+    assert topic.batches == [[(b'url-0', {})]]
+
+
+def test_empty_flush_does_not_publish() -> None:
+    topic = RecordingQueue()
+    publisher.BatchPublisher(topic).flush()
+    assert topic.batches == []
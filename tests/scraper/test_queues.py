@@ -0,0 +1,129 @@
+import sqlite3
+import threading
+import time
+import typing
+import pytest
+from scraper import acts_scraper
+from scraper import queues
+from scraper import wire
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def queue(request, tmpdir) -> typing.Iterator[queues.Queue]:
+    if request.param == 'memory':
+        yield queues.MemoryQueue(ack_deadline=60)
+    else:
+        sqlite_queue = queues.SqliteQueue(str(tmpdir.join('queue.db')), ack_deadline=60)
+        yield sqlite_queue
+        sqlite_queue.close()
+
+
+def test_pull_returns_published_messages_in_order(queue: queues.Queue) -> None:
+    queue.publish_batch([(b'url-0', {'type': 'a'}), (b'url-1', {'type': 'b'})])
+    queue.publish(b'url-2', {})
+
+    pulled = queue.pull(max_messages=2, wait=False)
+    assert [(msg.data, msg.attributes) for msg in pulled] == [(b'url-0', {'type': 'a'}), (b'url-1', {'type': 'b'})]
+    assert len({msg.ack_id for msg in pulled}) == 2
+    assert [msg.data for msg in queue.pull(max_messages=2, wait=False)] == [b'url-2']
+    assert queue.pull(max_messages=2, wait=False) == []
+
+
+def test_acknowledged_messages_are_not_redelivered(queue: queues.Queue) -> None:
+    queue.publish(b'url-0', {})
+    msg, = queue.pull(wait=False)
+    queue.acknowledge([msg.ack_id])
+    queue.modify_ack_deadline([msg.ack_id], 0)
+    assert queue.pull(wait=False) == []
+
+
+def test_expired_leases_are_redelivered(queue: queues.Queue) -> None:
+    queue.publish(b'url-0', {})
+    first, = queue.pull(wait=False)
+    assert queue.pull(wait=False) == []
+
+    queue.modify_ack_deadline([first.ack_id], 0)
+    second, = queue.pull(wait=False)
+    assert second.message_id == first.message_id
+    assert second.ack_id != first.ack_id
+
+    queue.acknowledge([first.ack_id])
+    queue.modify_ack_deadline([second.ack_id], 0)
+    assert [msg.data for msg in queue.pull(wait=False)] == [b'url-0']
+
+
+def test_sqlite_queue_is_durable(tmpdir) -> None:
+    path = str(tmpdir.join('queue.db'))
+    first = queues.SqliteQueue(path)
+    first.publish(b'url-0', {'type': 'main_page'})
+    first.close()
+
+    second = queues.SqliteQueue(path)
+    msg, = second.pull(wait=False)
+    assert (msg.data, msg.attributes) == (b'url-0', {'type': 'main_page'})
+    second.close()
+
+
+def test_sqlite_queue_adds_published_to_existing_tables(tmpdir) -> None:
+    path = str(tmpdir.join('queue.db'))
+    db = sqlite3.connect(path)
+    db.execute('CREATE TABLE messages (id INTEGER PRIMARY KEY AUTOINCREMENT, data BLOB NOT NULL, '
+               'attributes TEXT NOT NULL, ack_id TEXT, lease_until REAL NOT NULL DEFAULT 0)')
+    db.execute("INSERT INTO messages (data, attributes) VALUES (?, '{}')", (b'url-0',))
+    db.commit()
+    db.close()
+
+    queue = queues.SqliteQueue(path)
+    queue.publish(b'url-1', {})
+    pulled = queue.pull(2, wait=False)
+    assert [(msg.data, msg.publish_time > 0) for msg in pulled] == [(b'url-0', False), (b'url-1', True)]
+    queue.close()
+
+
+def _laned_queue() -> queues.LanedQueue:
+    lanes = {lane: queues.MemoryQueue() for lane in ('act_item', 'letter_page', queues.DEFAULT_LANE)}
+    return queues.LanedQueue(lanes, {'act_item': 3, 'letter_page': 1})
+
+
+def _publish(queue: queues.Queue, page_type: str, count: int) -> None:
+    for i in range(count):
+        breadcrumb = acts_scraper.Breadcrumb(url='http://foo.bar/{}/{}'.format(page_type, i), attrs={'type': page_type})
+        queue.publish(*wire.encode(breadcrumb))
+
+
+def test_laned_queue_gives_heavier_lanes_more_pulls() -> None:
+    queue = _laned_queue()
+    _publish(queue, 'act_item', 10)
+    _publish(queue, 'letter_page', 10)
+    _publish(queue, 'main_page', 10)
+
+    leading = [wire.message_type(queue.pull(wait=False)[0].attributes) for _ in range(10)]
+    assert leading.count('act_item') == 6
+    assert leading.count('letter_page') == 2
+    assert leading.count('main_page') == 2
+
+
+def test_laned_queue_tops_up_from_other_lanes_and_routes_acks() -> None:
+    queue = _laned_queue()
+    _publish(queue, 'act_item', 1)
+    _publish(queue, 'main_page', 2)
+
+    pulled = queue.pull(max_messages=5, wait=False)
+    assert [wire.message_type(msg.attributes) for msg in pulled] == ['act_item', 'main_page', 'main_page']
+    queue.acknowledge([msg.ack_id for msg in pulled[:2]])
+    queue.modify_ack_deadline([msg.ack_id for msg in pulled], 0)
+
+    redelivered, = queue.pull(max_messages=5, wait=False)
+    assert redelivered.message_id == pulled[2].message_id
+
+
+def test_laned_queue_wait_ends_on_any_lane() -> None:
+    queue = _laned_queue()
+    publisher = threading.Timer(0.3, _publish, (queue, 'letter_page', 1))
+    publisher.start()
+    started = time.monotonic()
+    pulled = queue.pull(max_messages=5, wait=True)
+    publisher.join()
+
+    assert [wire.message_type(msg.attributes) for msg in pulled] == ['letter_page']
+    assert time.monotonic() - started < queues.WAIT_SECONDS / 2
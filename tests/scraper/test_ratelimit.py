@@ -0,0 +1,80 @@
+import http.server
+import threading
+import time
+import typing
+import pytest
+import requests
+from scraper import fetcher
+from scraper import ratelimit
+
+
+def test_acquire_waits_for_tokens() -> None:
+    limiter = ratelimit.RateLimiter(ratelimit.RatePolicy(initial_rate=20.0, burst=1.0))
+    started = time.monotonic()
+    for _ in range(5):
+        limiter.acquire('foo.bar')
+    assert time.monotonic() - started >= 0.19
+
+
+def test_throttling_decreases_rate_once_per_target_latency() -> None:
+    limiter = ratelimit.RateLimiter(ratelimit.RatePolicy(initial_rate=4.0, target_latency=60.0))
+    limiter.record('foo.bar', 0.1, 429)
+    limiter.record('foo.bar', 0.1, 503)
+    assert limiter.rate('foo.bar') == 2.0
+    assert limiter.rate('other.host') == 4.0
+
+
+def test_fast_responses_increase_rate_up_to_max() -> None:
+    limiter = ratelimit.RateLimiter(ratelimit.RatePolicy(initial_rate=1.0, max_rate=1.5, increase=0.1))
+    limiter.record('foo.bar', 0.1, 200)
+    assert limiter.rate('foo.bar') == 1.1
+    for _ in range(20):
+        limiter.record('foo.bar', 0.1, 200)
+    assert limiter.rate('foo.bar') == 1.5
+
+    limiter.record('foo.bar', 10.0, 200)
+    assert limiter.rate('foo.bar') == 0.75
+
+
+def test_retry_after_pauses_host() -> None:
+    limiter = ratelimit.RateLimiter()
+    limiter.record('foo.bar', 0.1, 429, retry_after='1')
+    started = time.monotonic()
+    limiter.acquire('foo.bar')
+    assert time.monotonic() - started >= 0.9
+
+
+def test_state_file_is_shared(tmpdir) -> None:
+    path = str(tmpdir.join('rate.json'))
+    first = ratelimit.RateLimiter(ratelimit.RatePolicy(initial_rate=4.0), state_path=path)
+    second = ratelimit.RateLimiter(ratelimit.RatePolicy(initial_rate=4.0), state_path=path)
+    first.record('foo.bar', 0.1, 500)
+    assert second.rate('foo.bar') == 2.0
+
+
+class ThrottlingHandler(http.server.BaseHTTPRequestHandler):
+
+    def do_GET(self) -> None:  # pylint: disable=invalid-name
+        self.send_response(503)
+        self.end_headers()
+
+    def log_message(self, *_: typing.Any) -> None:
+        pass
+
+
+def test_http_fetcher_reports_responses_to_limiter() -> None:
+    server = http.server.HTTPServer(('127.0.0.1', 0), ThrottlingHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    host = '127.0.0.1:{}'.format(server.server_address[1])
+
+    limiter = ratelimit.RateLimiter(ratelimit.RatePolicy(initial_rate=8.0))
+    http_fetcher = fetcher.HttpFetcher(max_retries=0, limiter=limiter)
+    with pytest.raises(requests.HTTPError) as error:
+        http_fetcher.get('http://{}/eng/acts/'.format(host))
+    assert error.value.response.status_code == 503
+    assert limiter.rate(host) == 4.0
+
+    http_fetcher.close()
+    server.shutdown()
+    server.server_close()
@@ -0,0 +1,26 @@
+from scraper import retries
+
+
+def test_delay_doubles_up_to_max() -> None:
+    policy = retries.RetryPolicy(base_delay=10, max_delay=60)
+    assert [policy.delay(attempts) for attempts in range(1, 6)] == [10, 20, 40, 60, 60]
+    assert retries.RetryPolicy(base_delay=100, max_delay=10000).delay(5) == retries.MAX_ACK_DEADLINE
+
+
+def test_attempts_are_counted_per_message() -> None:
+    attempts = retries.Attempts(size=2)
+    assert attempts.failed('a') == 1
+    assert attempts.failed('a') == 2
+    assert attempts.failed('b') == 1
+    attempts.forget('a')
+    assert attempts.failed('a') == 1
+    attempts.failed('c')
+    assert attempts.failed('b') == 1
+
+
+def test_dead_letter_attrs_round_trip() -> None:
+    attrs = {'_t': 'act_item'}
+    dead_attrs = retries.dead_letter_attrs(attrs, ValueError('x' * 2000), 3)
+    assert dead_attrs[retries.ATTEMPTS_KEY] == '3'
+    assert len(dead_attrs[retries.ERROR_KEY]) == retries.MAX_ERROR_LENGTH
+    assert retries.replay_attrs(dead_attrs) == attrs
@@ -1,4 +1,7 @@
 import datetime
+import http.server
+import os
+import threading
 import typing  # pylint: disable=unused-import
 
 from google.cloud import datastore
@@ -7,8 +10,15 @@ from google.cloud.pubsub import message  # pylint: disable=unused-import
 
 from scraper import acts_scraper
 from scraper import acts_storage
+from scraper import admission
+from scraper import fetcher
+from scraper import profiling
+from scraper import queues
+from scraper import ratelimit
+from scraper import retries
 from scraper import spider
 from scraper import storage
+from scraper import wire
 
 
 class MockScraper(acts_scraper.Scraper):
@@ -41,7 +51,7 @@ def test_listen_publishes_to_pubsub(pubsub_client: pubsub.Client,
                                     datastore_client: datastore.Client,
                                     stor: storage.Storage) -> None:
     acts_stor = acts_storage.ActsStorage(datastore_client, stor)
-    spider_ = spider.ActsSpider(pubsub_client, MockScraper(), acts_stor)
+    spider_ = spider.ActsSpider(queues.PubSubQueue(pubsub_client), MockScraper(), acts_stor)
 
     input_attrs = {
         'code': 'A-1',
@@ -77,7 +87,7 @@ def test_listen_stores_results(pubsub_client: pubsub.Client,
                                datastore_client: datastore.Client,
                                stor: storage.Storage) -> None:
     acts_stor = acts_storage.ActsStorage(datastore_client, stor)
-    spider_ = spider.ActsSpider(pubsub_client, MockScraper(), acts_stor)
+    spider_ = spider.ActsSpider(queues.PubSubQueue(pubsub_client), MockScraper(), acts_stor)
 
     input_attrs = {
         'code': 'A-1',
@@ -105,3 +115,381 @@ def test_listen_stores_results(pubsub_client: pubsub.Client,
 
     act_text = stor.get_blob(act_version['raw_blob']).download_to_string()
     assert act_text == 'Act Body'
+
+
+class ItemOnlyScraper(acts_scraper.Scraper):
+
+    def __init__(self) -> None:
+        self.threads = set()  # type: typing.Set[int]
+
+    def scrape(self, input_breadcrumb: acts_scraper.Breadcrumb) -> acts_scraper.ScraperResult:
+        self.threads.add(threading.get_ident())
+        _, items = MockScraper().scrape(input_breadcrumb)
+        return [], items
+
+
+class MockAsyncScraper(acts_scraper.AsyncScraper):
+
+    def __init__(self) -> None:
+        self.batches = []  # type: typing.List[int]
+
+    async def scrape(self, input_breadcrumb: acts_scraper.Breadcrumb) -> acts_scraper.ScraperResult:
+        return ItemOnlyScraper().scrape(input_breadcrumb)
+
+    async def scrape_many(self, input_breadcrumbs: typing.Sequence[acts_scraper.Breadcrumb]) \
+            -> typing.List[typing.Union[acts_scraper.ScraperResult, None, Exception]]:
+        self.batches.append(len(input_breadcrumbs))
+        return await super().scrape_many(input_breadcrumbs)
+
+
+def test_listen_feeds_async_scraper_in_batches(pubsub_client: pubsub.Client,
+                                               datastore_client: datastore.Client,
+                                               stor: storage.Storage) -> None:
+    acts_stor = acts_storage.ActsStorage(datastore_client, stor)
+    scraper = MockAsyncScraper()
+    spider_ = spider.ActsSpider(queues.PubSubQueue(pubsub_client), scraper, acts_stor)
+
+    topic = pubsub_client.topic('acts_requests')
+    for code in ('A-1', 'A-2', 'A-3'):
+        input_attrs = {
+            'code': code,
+            'title': 'Act Title',
+            'start': '2016-01-01',
+            'end': '2017-01-01',
+            'body': 'Act Body',
+            'type': 'foo',
+        }
+        topic.publish('http://foo.bar'.encode('utf-8'), **input_attrs)
+
+    while spider_.listen(wait=False, max_messages=10):
+        pass
+
+    assert sum(scraper.batches) >= 3
+    for code in ('A-1', 'A-2', 'A-3'):
+        assert datastore_client.get(datastore_client.key('Act', code))
+
+
+def test_listen_drops_stale_messages_before_scraping(pubsub_client: pubsub.Client,
+                                                     datastore_client: datastore.Client,
+                                                     stor: storage.Storage) -> None:
+    acts_stor = acts_storage.ActsStorage(datastore_client, stor)
+    gate = admission.Admission()
+    spider_ = spider.ActsSpider(queues.PubSubQueue(pubsub_client), MockScraper(), acts_stor, gate)
+
+    input_attrs = {
+        'code': 'A-1',
+        'title': 'Act Title',
+        'start': '2016-01-01',
+        'end': '2017-01-01',
+        'body': 'Act Body',
+        'type': 'foo',
+        'timestamp': datetime.datetime(2016, 1, 1).isoformat(),
+    }
+    topic = pubsub_client.topic('acts_requests')
+    topic.publish('http://foo.bar'.encode('utf-8'), **input_attrs)
+
+    assert spider_.listen()
+    assert gate.drops == {admission.STALE: 1}
+    assert datastore_client.get(datastore_client.key('Act', 'A-1')) is None
+    assert topic.subscription('acts_scraper').pull(return_immediately=True) == []
+
+
+def test_listen_processes_messages_concurrently(pubsub_client: pubsub.Client,
+                                                datastore_client: datastore.Client,
+                                                stor: storage.Storage) -> None:
+    acts_stor = acts_storage.ActsStorage(datastore_client, stor)
+    scraper = ItemOnlyScraper()
+    spider_ = spider.ActsSpider(queues.PubSubQueue(pubsub_client), scraper, acts_stor, concurrency=4)
+
+    topic = pubsub_client.topic('acts_requests')
+    codes = ['A-{}'.format(i) for i in range(8)]
+    for code in codes:
+        input_attrs = {
+            'code': code,
+            'title': 'Act Title',
+            'start': '2016-01-01',
+            'end': '2017-01-01',
+            'body': 'Act Body',
+            'type': 'foo',
+        }
+        topic.publish('http://foo.bar'.encode('utf-8'), **input_attrs)
+
+    while spider_.listen(wait=False, max_messages=8):
+        pass
+
+    assert threading.get_ident() not in scraper.threads
+    for code in codes:
+        assert datastore_client.get(datastore_client.key('Act', code))
+    assert topic.subscription('acts_scraper').pull(return_immediately=True) == []
+
+
+def test_keep_listening_drains_and_stops(pubsub_client: pubsub.Client,
+                                         datastore_client: datastore.Client,
+                                         stor: storage.Storage) -> None:
+    acts_stor = acts_storage.ActsStorage(datastore_client, stor)
+    spider_ = spider.ActsSpider(queues.PubSubQueue(pubsub_client), ItemOnlyScraper(), acts_stor)
+
+    topic = pubsub_client.topic('acts_requests')
+    codes = ['A-{}'.format(i) for i in range(3)]
+    for code in codes:
+        input_attrs = {
+            'code': code,
+            'title': 'Act Title',
+            'start': '2016-01-01',
+            'end': '2017-01-01',
+            'body': 'Act Body',
+            'type': 'foo',
+        }
+        topic.publish('http://foo.bar'.encode('utf-8'), **input_attrs)
+
+    timer = threading.Timer(1.0, spider_.stop)
+    timer.start()
+    spider_.keep_listening(wait=False, max_messages=4, max_idle=0.1)
+    timer.join()
+
+    for code in codes:
+        assert datastore_client.get(datastore_client.key('Act', code))
+    assert spider_.ack_stats['acked'] == 3
+    assert spider_.ack_stats['pending'] == 0
+
+
+def test_breadcrumbs_are_published_across_messages(pubsub_client: pubsub.Client,
+                                                   datastore_client: datastore.Client,
+                                                   stor: storage.Storage) -> None:
+    acts_stor = acts_storage.ActsStorage(datastore_client, stor)
+    spider_ = spider.ActsSpider(queues.PubSubQueue(pubsub_client), MockScraper(), acts_stor)
+
+    topic = pubsub_client.topic('acts_requests')
+    for code in ('A-1', 'A-2', 'A-3'):
+        input_attrs = {
+            'code': code,
+            'title': 'Act Title',
+            'start': '2016-01-01',
+            'end': '2017-01-01',
+            'body': 'Act Body',
+            'type': 'foo',
+        }
+        topic.publish('http://foo.bar'.encode('utf-8'), **input_attrs)
+
+    spider_.listen(wait=True, max_messages=3)
+
+    stats = spider_.publish_stats
+    assert stats['published'] == 2 * spider_.ack_stats['acked']
+    assert stats['publish_rpcs'] == spider_.ack_stats['ack_rpcs'] == 1
+    assert stats['pending'] == 0
+
+
+def test_listen_runs_on_a_local_queue(datastore_client: datastore.Client, stor: storage.Storage) -> None:
+    acts_stor = acts_storage.ActsStorage(datastore_client, stor)
+    queue = queues.MemoryQueue()
+    spider_ = spider.ActsSpider(queue, MockScraper(), acts_stor)
+
+    input_attrs = {
+        'code': 'A-1',
+        'title': 'Act Title',
+        'start': '2016-01-01',
+        'end': '2017-01-01',
+        'body': 'Act Body',
+        'type': 'foo',
+    }
+    queue.publish(b'http://foo.bar', input_attrs)
+
+    assert spider_.listen(wait=False)
+    assert datastore_client.get(datastore_client.key('Act', 'A-1'))
+
+    results = queue.pull(max_messages=10, wait=False)
+    assert len(results) == 2
+    assert [msg.attributes.get('foo') for msg in results] == ['bar', None]
+
+
+class FlakyScraper(acts_scraper.Scraper):
+
+    def __init__(self, failures: int) -> None:
+        self.failures = failures
+        self.calls = 0
+
+    def scrape(self, input_breadcrumb: acts_scraper.Breadcrumb) -> acts_scraper.ScraperResult:
+        self.calls += 1
+        if self.calls <= self.failures:
+            raise RuntimeError('page {} is broken'.format(input_breadcrumb.url))
+        return ItemOnlyScraper().scrape(input_breadcrumb)
+
+
+def _publish_item(queue: queues.Queue, code: str) -> None:
+    input_attrs = {
+        'code': code,
+        'title': 'Act Title',
+        'start': '2016-01-01',
+        'end': '2017-01-01',
+        'body': 'Act Body',
+        'type': 'foo',
+    }
+    queue.publish(*wire.encode(acts_scraper.Breadcrumb(url='http://foo.bar', attrs=input_attrs)))
+
+
+def test_failed_messages_are_retried(datastore_client: datastore.Client, stor: storage.Storage) -> None:
+    acts_stor = acts_storage.ActsStorage(datastore_client, stor)
+    queue = queues.MemoryQueue()
+    scraper = FlakyScraper(failures=2)
+    spider_ = spider.ActsSpider(queue, scraper, acts_stor, retry=retries.RetryPolicy(max_attempts=3, base_delay=0))
+    _publish_item(queue, 'A-1')
+
+    while spider_.listen(wait=False):
+        pass
+
+    assert scraper.calls == 3
+    assert datastore_client.get(datastore_client.key('Act', 'A-1'))
+    assert spider_.ack_stats['nacked'] == 2
+    assert spider_.ack_stats['acked'] == 1
+
+
+def test_exhausted_messages_are_dead_lettered(datastore_client: datastore.Client, stor: storage.Storage) -> None:
+    acts_stor = acts_storage.ActsStorage(datastore_client, stor)
+    queue = queues.MemoryQueue()
+    dead_letters = queues.MemoryQueue()
+    spider_ = spider.ActsSpider(queue, FlakyScraper(failures=100), acts_stor,
+                                retry=retries.RetryPolicy(max_attempts=2, base_delay=0), dead_letters=dead_letters)
+    _publish_item(queue, 'A-1')
+    _publish_item(queue, 'A-2')
+    queue.publish(b'\xff', {wire.VERSION_KEY: wire.VERSION})
+
+    while spider_.listen(wait=False, max_messages=3):
+        pass
+
+    assert len(queue) == 0
+    dead = dead_letters.pull(max_messages=10, wait=False)
+    assert len(dead) == 3
+    assert [msg.attributes[retries.ATTEMPTS_KEY] for msg in dead] == ['1', '2', '2']
+    assert dead[1].attributes[retries.ERROR_KEY] == 'RuntimeError: page http://foo.bar is broken'
+    assert wire.decode(dead[1].data, retries.replay_attrs(dead[1].attributes)).attrs['code'] == 'A-1'
+
+
+class FailingQueue(queues.MemoryQueue):
+
+    def publish(self, data: bytes, attrs: typing.Dict[str, str]) -> None:
+        raise IOError('dead-letter queue is down')
+
+
+def test_messages_are_kept_when_they_cannot_be_dead_lettered(datastore_client: datastore.Client,
+                                                             stor: storage.Storage) -> None:
+    for dead_letters in (None, FailingQueue()):
+        queue = queues.MemoryQueue()
+        spider_ = spider.ActsSpider(queue, FlakyScraper(failures=100), acts_storage.ActsStorage(datastore_client, stor),
+                                    retry=retries.RetryPolicy(max_attempts=1, base_delay=0), dead_letters=dead_letters)
+        _publish_item(queue, 'A-1')
+
+        spider_.listen(wait=False)
+
+        assert 'acked' not in spider_.ack_stats
+        msg, = queue.pull(wait=False)
+        assert wire.decode(msg.data, msg.attributes).attrs['code'] == 'A-1'
+
+
+def test_batched_items_are_stored_before_ack(datastore_client: datastore.Client, stor: storage.Storage) -> None:
+    acts_stor = acts_storage.ActsStorage(datastore_client, stor, batch_size=100, max_latency=60)
+    queue = queues.MemoryQueue()
+    spider_ = spider.ActsSpider(queue, ItemOnlyScraper(), acts_stor)
+    _publish_item(queue, 'A-1')
+    _publish_item(queue, 'A-2')
+
+    assert spider_.listen(wait=False, max_messages=2)
+    assert spider_.ack_stats['acked'] == 2
+    assert datastore_client.get(datastore_client.key('Act', 'A-1'))
+    assert datastore_client.get(datastore_client.key('Act', 'A-2'))
+
+
+class FailingDatastore:
+
+    def __init__(self, client: datastore.Client, failures: int) -> None:
+        self.__client = client
+        self.failures = failures
+
+    def __getattr__(self, name: str) -> typing.Any:
+        return getattr(self.__client, name)
+
+    def put_multi(self, entities: typing.Sequence[datastore.Entity]) -> None:
+        if self.failures:
+            self.failures -= 1
+            raise IOError('datastore unavailable')
+        self.__client.put_multi(entities)
+
+
+def test_failed_batch_write_retries_its_messages(datastore_client: datastore.Client, stor: storage.Storage) -> None:
+    acts_stor = acts_storage.ActsStorage(FailingDatastore(datastore_client, failures=1), stor, batch_size=100,
+                                         max_latency=60)
+    queue = queues.MemoryQueue()
+    spider_ = spider.ActsSpider(queue, ItemOnlyScraper(), acts_stor, retry=retries.RetryPolicy(base_delay=0))
+    _publish_item(queue, 'A-1')
+    _publish_item(queue, 'A-2')
+
+    assert spider_.listen(wait=False, max_messages=2)
+    assert spider_.ack_stats['nacked'] == 2
+    assert 'acked' not in spider_.ack_stats
+    assert datastore_client.get(datastore_client.key('Act', 'A-1')) is None
+
+    assert spider_.listen(wait=False, max_messages=2)
+    assert spider_.ack_stats['acked'] == 2
+    assert datastore_client.get(datastore_client.key('Act', 'A-1'))
+    assert datastore_client.get(datastore_client.key('Act', 'A-2'))
+    assert not spider_.listen(wait=False, max_messages=2)
+
+
+def test_failed_write_through_fails_only_its_message(datastore_client: datastore.Client,
+                                                     stor: storage.Storage) -> None:
+    acts_stor = acts_storage.ActsStorage(FailingDatastore(datastore_client, failures=1), stor)
+    queue = queues.MemoryQueue()
+    spider_ = spider.ActsSpider(queue, ItemOnlyScraper(), acts_stor, retry=retries.RetryPolicy(base_delay=0))
+    _publish_item(queue, 'A-1')
+    _publish_item(queue, 'A-2')
+
+    assert spider_.listen(wait=False, max_messages=2)
+    assert spider_.ack_stats['nacked'] == 1
+    assert spider_.ack_stats['acked'] == 1
+    assert datastore_client.get(datastore_client.key('Act', 'A-2'))
+
+
+def test_listen_writes_a_profile(datastore_client: datastore.Client, stor: storage.Storage, tmpdir) -> None:
+    queue = queues.MemoryQueue()
+    spider_ = spider.ActsSpider(queue, ItemOnlyScraper(), acts_storage.ActsStorage(datastore_client, stor),
+                                profiler=profiling.SamplingProfiler(str(tmpdir)))
+    _publish_item(queue, 'A-1')
+
+    assert spider_.listen(wait=False)
+    assert os.path.exists(os.path.join(str(tmpdir), 'gitlawca-{}.collapsed'.format(os.getpid())))
+
+
+class TooManyRequestsHandler(http.server.BaseHTTPRequestHandler):
+
+    def do_GET(self) -> None:  # pylint: disable=invalid-name
+        body = b'<html><body><p>Too many requests</p></body></html>'
+        self.send_response(429)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *_: typing.Any) -> None:
+        pass
+
+
+def test_throttled_pages_are_retried(datastore_client: datastore.Client, stor: storage.Storage) -> None:
+    server = http.server.HTTPServer(('127.0.0.1', 0), TooManyRequestsHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    url = 'http://127.0.0.1:{}/eng/acts/'.format(server.server_address[1])
+
+    http_fetcher = fetcher.HttpFetcher(limiter=ratelimit.RateLimiter(ratelimit.RatePolicy(initial_rate=8.0)))
+    queue = queues.MemoryQueue()
+    spider_ = spider.ActsSpider(queue, acts_scraper.ActsScraper(http_fetcher),
+                                acts_storage.ActsStorage(datastore_client, stor),
+                                retry=retries.RetryPolicy(max_attempts=3, base_delay=0))
+    queue.publish(*wire.encode(acts_scraper.Breadcrumb(url=url, attrs={'type': 'main_page'})))
+    try:
+        assert spider_.listen(wait=False)
+    finally:
+        http_fetcher.close()
+        server.shutdown()
+        server.server_close()
+
+    assert spider_.ack_stats['nacked'] == 1
+    assert 'acked' not in spider_.ack_stats
+    assert len(queue) == 1
@@ -1,5 +1,9 @@
+import gzip
 import io
 import os
+import threading
+import time
+import typing
 import py  # pylint:disable=unused-import
 import pytest
 from scraper import storage
@@ -83,3 +87,260 @@ def test_get_storage_not_production():
     mock_blob = mock_storage.get_blob('foo/bar/baz')
     mock_blob.upload_from_string('testing')
     assert mock_blob.download_to_string() == 'testing'
+
+
+@pytest.fixture
+def gzip_storage(tmpdir: 'py.path.local') -> storage.Storage:
+    return storage.MockStorage(os.path.join(tmpdir, 'storage'), content_encoding=storage.GZIP)
+
+
+def test_compressed_upload_download(tmpdir: 'py.path.local', gzip_storage: storage.Storage):
+    data = '<div>{}</div>\n'.format('testing 123 ' * 1000)
+    blob = gzip_storage.get_blob('foo/bar')
+    blob.upload_from_string(data)
+    assert blob.content_encoding() == storage.GZIP
+    assert blob.download_to_string() == data
+
+    stored_path = os.path.join(tmpdir, 'storage', 'foo', 'bar')
+    assert os.path.getsize(stored_path) < len(data) / 10
+    with open(stored_path, 'rb') as f:
+        assert gzip.decompress(f.read()).decode('utf-8') == data
+
+    output = io.BytesIO()
+    blob.download_to_file(output)
+    assert output.getvalue().decode('utf-8') == data
+
+    # Plain storage reads compressed objects, and overwriting them drops the encoding.
+    plain_blob = storage.MockStorage(os.path.join(tmpdir, 'storage')).get_blob('foo/bar')
+    assert plain_blob.download_to_string() == data
+    plain_blob.upload_from_file(io.BytesIO(b'plain'))
+    assert plain_blob.content_encoding() is None
+    assert blob.download_to_string() == 'plain'
+
+
+def test_compressed_upload_from_filename(tmpdir: 'py.path.local', gzip_storage: storage.Storage):
+    filename = os.path.join(tmpdir, 'testing.txt')
+    with open(filename, 'wb') as f:
+        f.write(b'testing')
+    blob = gzip_storage.get_blob('foo/bar')
+    blob.upload_from_filename(filename)
+    blob.download_to_filename(filename)
+    with open(filename, 'rb') as f:
+        assert f.read() == b'testing'
+
+    blob.delete()
+    assert not blob.exists()
+    assert blob.content_encoding() is None
+
+
+def test_unsupported_content_encoding(tmpdir: 'py.path.local'):
+    with pytest.raises(ValueError):
+        storage.MockStorage(str(tmpdir), content_encoding='br')
+
+
+@pytest.mark.parametrize('max_workers', [1, 4])
+def test_upload_download_many(mock_storage: storage.MockStorage, max_workers: int):
+    mock_storage.max_workers = max_workers
+    uploads = [('foo/{}'.format(number), 'testing {}'.format(number)) for number in range(10)]
+    uploads.append(('foo/file', io.BytesIO(b'from file')))
+    results = mock_storage.upload_many(uploads)
+    assert [result.name for result in results] == [name for name, _ in uploads]
+    assert all(result.error is None for result in results)
+
+    results = mock_storage.download_many(['foo/3', 'foo/missing', 'foo/file'])
+    assert [(result.name, result.data) for result in results] == [
+        ('foo/3', 'testing 3'), ('foo/missing', None), ('foo/file', 'from file')]
+    assert isinstance(results[1].error, FileNotFoundError)
+
+
+@pytest.mark.parametrize('content_encoding', [None, storage.GZIP])
+def test_open_reads_ranges(tmpdir: 'py.path.local', content_encoding: str):
+    data = b''.join('<section>{}</section>'.format(number).encode('utf-8') for number in range(1000))
+    blob = storage.MockStorage(str(tmpdir), content_encoding=content_encoding).get_blob('foo/bar')
+    blob.upload_from_file(io.BytesIO(data))
+    with blob.open() as reader:
+        reader.seek(data.index(b'<section>500<'))
+        assert reader.read(22) == b'<section>500</section>'
+        reader.seek(0)
+        assert reader.read() == data
+
+
+def test_mapped(mock_storage: storage.MockStorage, gzip_storage: storage.MockStorage):
+    blob = mock_storage.get_blob('foo/bar')
+    blob.upload_from_string('testing 123')
+    with blob.mapped() as view:
+        assert bytes(view[8:]) == b'123'
+
+    blob.upload_from_string('')
+    with blob.mapped() as view:
+        assert len(view) == 0
+
+    compressed = gzip_storage.get_blob('foo/baz')
+    compressed.upload_from_string('testing')
+    with pytest.raises(ValueError):
+        with compressed.mapped():
+            pass
+
+
+def test_range_reader():
+    data = bytes(range(256)) * 100
+    fetches = []
+
+    def fetch(start: int, end: int) -> bytes:
+        fetches.append((start, end))
+        return data[start:end]
+
+    reader = io.BufferedReader(storage.RangeReader(fetch, len(data)), buffer_size=1024)
+    reader.seek(1000)
+    assert reader.read(10) == data[1000:1010]
+    assert reader.read(10) == data[1010:1020]
+    assert fetches == [(1000, 2024)]
+
+    reader.seek(-5, io.SEEK_END)
+    assert reader.read() == data[-5:]
+    assert reader.read() == b''
+
+
+class FakeRaw(io.BytesIO):
+
+    def read(self, amt: typing.Optional[int] = None, decode_content: bool = False) -> bytes:
+        assert not decode_content
+        return super().read(amt)
+
+
+class FakeResponse:
+
+    def __init__(self, status_code: int, body: bytes, headers: typing.Dict[str, str]) -> None:
+        self.status_code = status_code
+        self.headers = headers
+        self.raw = FakeRaw(body)
+        self.closed = False
+
+    def raise_for_status(self) -> None:
+        assert self.status_code < 400
+
+    def close(self) -> None:
+        self.closed = True
+
+
+class FakeCloudBlob:
+    # Stands in for google.cloud.storage.blob.Blob: the stored bytes and metadata, as the API would report them.
+
+    def __init__(self, data: bytes = b'', content_encoding: typing.Optional[str] = None) -> None:
+        self.client = None
+        self.data = data
+        self.content_encoding = content_encoding
+        self.size = None  # type: typing.Optional[int]
+        self.patched = []  # type: typing.List[typing.Optional[str]]
+
+    def reload(self) -> None:
+        self.size = len(self.data)
+
+    def _get_download_url(self) -> str:
+        return 'https://www.googleapis.com/download/storage/v1/b/gitlawca/o/foo'
+
+    def upload_from_file(self, file: typing.IO[bytes]) -> None:
+        # Like storage 1.1.0, the upload stores only the bytes; other metadata needs a patch.
+        self.data = file.read()
+        self.content_encoding = None
+
+    def patch(self) -> None:
+        self.patched.append(self.content_encoding)
+
+
+class FakeSession:
+
+    def __init__(self, blob: FakeCloudBlob, honors_range: bool = True) -> None:
+        self.__blob = blob
+        self.__honors_range = honors_range
+        self.requests = []  # type: typing.List[typing.Dict[str, str]]
+        self.responses = []  # type: typing.List[FakeResponse]
+
+    def get(self, url: str, headers: typing.Dict[str, str], stream: bool) -> FakeResponse:
+        assert url == self.__blob._get_download_url() and stream  # pylint: disable=protected-access
+        self.requests.append(headers)
+        response_headers = {'Content-Encoding': self.__blob.content_encoding} if self.__blob.content_encoding else {}
+        if 'Range' in headers and self.__honors_range:
+            start, end = (int(bound) for bound in headers['Range'][len('bytes='):].split('-'))
+            response = FakeResponse(206, self.__blob.data[start:end + 1], response_headers)
+        else:
+            response = FakeResponse(200, self.__blob.data, response_headers)
+        self.responses.append(response)
+        return response
+
+
+@pytest.mark.parametrize('honors_range', [True, False])
+def test_google_blob_reads_ranges(honors_range: bool):
+    data = b''.join('<section>{}</section>'.format(number).encode('utf-8') for number in range(1000))
+    cloud_blob = FakeCloudBlob(data)
+    session = FakeSession(cloud_blob, honors_range)
+    blob = storage.GoogleBlob('foo', cloud_blob, session=session)
+
+    start = data.index(b'<section>500<')
+    with blob.open() as reader:
+        reader.seek(start)
+        assert reader.read(22) == b'<section>500</section>'
+    assert session.requests == [{'Range': 'bytes={}-{}'.format(start, len(data) - 1), 'Accept-Encoding': 'gzip'}]
+    assert all(response.closed for response in session.responses)
+
+
+class FakeClient:
+    # Fails any upload made while another thread is using the same client.
+
+    def __init__(self, project: str = 'gitlawca', credentials: typing.Any = None) -> None:
+        self.project = project
+        self._credentials = credentials
+        self.busy = threading.Lock()
+
+    def bucket(self, name: str) -> 'FakeBucket':
+        return FakeBucket(name, self)
+
+
+class FakeBucket:
+
+    def __init__(self, name: str, client: FakeClient) -> None:
+        self.name = name
+        self.client = client
+
+    def blob(self, _: str) -> FakeCloudBlob:
+        blob = ClientCheckingBlob()
+        blob.client = self.client
+        return blob
+
+
+class ClientCheckingBlob(FakeCloudBlob):
+
+    def upload_from_file(self, file: typing.IO[bytes]) -> None:
+        assert self.client.busy.acquire(blocking=False)
+        try:
+            time.sleep(0.01)
+            super().upload_from_file(file)
+        finally:
+            self.client.busy.release()
+
+
+def test_google_bulk_transfers_use_a_client_per_worker(monkeypatch):
+    monkeypatch.setattr(storage.storage, 'Client', FakeClient, raising=False)
+    monkeypatch.setattr(storage.google_requests, 'AuthorizedSession', lambda credentials: object(), raising=False)
+    google_storage = storage.GoogleStorage(FakeClient().bucket('gitlawca'), max_workers=4)
+
+    for _ in range(2):
+        uploads = [('foo/{}'.format(number), io.BytesIO(b'testing')) for number in range(16)]
+        results = google_storage.upload_many(uploads)
+        assert all(result.error is None for result in results)
+
+
+@pytest.mark.parametrize('content_encoding', [None, storage.GZIP])
+def test_google_blob_round_trip(content_encoding: str):
+    cloud_blob = FakeCloudBlob()
+    session = FakeSession(cloud_blob)
+    blob = storage.GoogleBlob('foo', cloud_blob, content_encoding, session)
+
+    blob.upload_from_file(io.BytesIO(b'testing 123'))
+    assert cloud_blob.content_encoding == content_encoding
+    assert cloud_blob.patched == ([storage.GZIP] if content_encoding else [])
+    assert cloud_blob.data.startswith(b'\x1f\x8b') == bool(content_encoding)
+
+    assert blob.download_to_string() == 'testing 123'
+    assert session.requests == [{'Accept-Encoding': 'gzip'}]
+    assert session.responses[0].closed
@@ -0,0 +1,99 @@
+import io
+import os
+import typing
+import pytest
+from lxml import html  # type: ignore
+from scraper import acts_scraper
+from scraper import acts_storage
+from scraper import streaming
+
+
+def get_fixture(*rel_path: str) -> str:
+    return os.path.join(os.path.dirname(__file__), 'fixtures', *rel_path)
+
+
+def read_chunks(filename: str, chunk_size: int = 512):
+    with open(filename, 'rb') as f:
+        chunk = f.read(chunk_size)
+        while chunk:
+            yield chunk
+            chunk = f.read(chunk_size)
+
+
+def test_extract_element_matches_tree_serialisation() -> None:
+    fixture_filename = get_fixture('A-1', '20150709', 'P1TT3xt3.html')
+    sink = io.BytesIO()
+    assert streaming.extract_element(read_chunks(fixture_filename), sink, 'div', 'wb-cont')
+
+    with open(fixture_filename, 'rb') as f:
+        expected = html.fromstring(f.read()).xpath('//div[@id="wb-cont"]')[0]
+    assert sink.getvalue() == html.tostring(expected)
+
+
+def test_extract_element_serialises_entities_and_comments_like_the_tree() -> None:
+    page = '<html><body><p>before</p><div id="wb-cont"><!-- note --><p title="a &amp; b">caf\u00e9 &nbsp;&lt;' \
+           '<br>x</p></div>tail<p>after</p></body></html>'.encode('utf-8')
+    sink = io.BytesIO()
+    assert streaming.extract_element([page[:40], page[40:]], sink, 'div', 'wb-cont')
+    assert sink.getvalue() == html.tostring(html.fromstring(page).xpath('//div[@id="wb-cont"]')[0])
+
+
+def test_extract_element_reports_missing_element() -> None:
+    sink = io.BytesIO()
+    assert not streaming.extract_element(read_chunks(get_fixture('A.html')), sink, 'div', 'wb-cont')
+    assert sink.getvalue() == b''
+
+
+def test_scraper_streams_act_items() -> None:
+    attrs = {
+        'code': 'A-1',
+        'title': 'Access to Information Act',
+        'type': 'act_item',
+        'start': '2015-07-09',
+        'end': '2015-07-29'
+    }
+    input_breadcrumb = acts_scraper.Breadcrumb(url='file://' + get_fixture('A-1', '20150709', 'P1TT3xt3.html'),
+                                               attrs=attrs)
+    result = acts_scraper.ActsScraper(stream_items=True).scrape(input_breadcrumb)
+    assert result
+    breadcrumbs, items = result
+    assert breadcrumbs == []
+    assert len(items) == 1
+    item = items[0]
+    assert item.code == 'A-1'
+    assert not isinstance(item.body, str)
+    body = item.body.read().decode('utf-8')
+    assert body.startswith('<div id="wb-cont"')
+    assert 'Access to Information Act' in body
+
+
+def test_streamed_and_parsed_items_have_the_same_body() -> None:
+    attrs = {'code': 'A-1', 'title': 'Access to Information Act', 'type': 'act_item', 'start': '2015-07-09',
+             'end': '2015-07-29'}
+    input_breadcrumb = acts_scraper.Breadcrumb(url='file://' + get_fixture('A-1', '20150709', 'P1TT3xt3.html'),
+                                               attrs=attrs)
+    (_, (streamed,)) = acts_scraper.ActsScraper(stream_items=True).scrape(input_breadcrumb)
+    (_, (parsed,)) = acts_scraper.ActsScraper().scrape(input_breadcrumb)
+    with streamed.body:
+        assert acts_storage.raw_hash(streamed.body) == acts_storage.raw_hash(parsed.body)
+
+
+class BrokenResponse:
+
+    def __init__(self) -> None:
+        self.closed = False
+
+    def iter_content(self, chunk_size: int) -> typing.Iterator[bytes]:
+        yield b'<html><body><div id="wb-cont">'
+        raise ConnectionError('reset after {} bytes'.format(chunk_size))
+
+    def close(self) -> None:
+        self.closed = True
+
+
+def test_streamed_response_is_closed_when_reading_fails() -> None:
+    response = BrokenResponse()
+    input_breadcrumb = acts_scraper.Breadcrumb(url='http://foo.bar', attrs={'type': 'act_item'})
+    with pytest.raises(ConnectionError):
+        acts_scraper.ActsScraper.parse_act_item_stream(input_breadcrumb, response)
+    assert response.closed
@@ -0,0 +1,74 @@
+import functools
+import os
+import signal
+import threading
+import time
+import typing
+from scraper import supervisor
+
+
+class WaitingSpider:
+    # Stands in for ActsSpider in worker processes: listens until SIGTERM, and the first worker to start crashes.
+
+    def __init__(self, marker_dir: str) -> None:
+        self.__marker_dir = marker_dir
+        self.stats = {'acked': 2}
+
+    def keep_listening(self, *_: typing.Any) -> None:
+        stopping = threading.Event()
+        signal.signal(signal.SIGTERM, lambda *_: stopping.set())
+        try:
+            os.close(os.open(os.path.join(self.__marker_dir, 'crashed'), os.O_CREAT | os.O_EXCL))
+            os._exit(3)  # pylint: disable=protected-access
+        except FileExistsError:
+            pass
+        open(os.path.join(self.__marker_dir, str(os.getpid())), 'w').close()
+        stopping.wait()
+
+
+def make_spider(marker_dir: str) -> WaitingSpider:
+    return WaitingSpider(marker_dir)
+
+
+def test_supervisor_restarts_crashed_workers_and_sums_stats(tmpdir) -> None:
+    marker_dir = str(tmpdir)
+    supervisor_ = supervisor.Supervisor(functools.partial(make_spider, marker_dir), (False, 1, 0.1),
+                                        workers=2, restart_delay=0.0, report_interval=0.1)
+
+    def stop_when_listening() -> None:
+        give_up = time.monotonic() + 60
+        while len(os.listdir(marker_dir)) < 3 and time.monotonic() < give_up:
+            time.sleep(0.1)
+        supervisor_.stop()
+
+    stopper = threading.Thread(target=stop_when_listening)
+    stopper.start()
+    stats = supervisor_.run()
+    stopper.join()
+
+    assert len(os.listdir(marker_dir)) == 3
+    assert stats['restarts'] == 1
+    assert stats['acked'] == 4
+    assert stats['workers'] == 0
+
+
+class CrashingSpider:
+    # Every worker exits as soon as it starts, as one would when its metrics port is taken.
+
+    stats = {}  # type: typing.Dict[str, int]
+
+    def keep_listening(self, *_: typing.Any) -> None:
+        os._exit(3)  # pylint: disable=protected-access
+
+
+def make_crashing_spider() -> CrashingSpider:
+    return CrashingSpider()
+
+
+def test_supervisor_gives_up_on_workers_that_keep_crashing() -> None:
+    supervisor_ = supervisor.Supervisor(make_crashing_spider, (False, 1, 0.1), workers=2, restart_delay=0.01,
+                                        report_interval=0.1, max_fast_failures=3)
+    stats = supervisor_.run()
+
+    assert stats['restarts'] == 4
+    assert stats['workers'] == 0
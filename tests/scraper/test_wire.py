@@ -0,0 +1,75 @@
+import datetime
+from scraper import acts_scraper
+from scraper import wire
+
+
+def test_round_trip() -> None:
+    breadcrumb = acts_scraper.Breadcrumb(
+        url='http://laws-lois.justice.gc.ca/eng/acts/A-1/20150709/P1TT3xt3.html',
+        attrs={
+            'type': 'act_item',
+            'code': 'A-1',
+            'title': 'Access to Information Act',
+            'start': '2015-07-09',
+            'end': '',
+            'timestamp': datetime.datetime(2017, 5, 1, 12, 30, 15, 123456).isoformat(),
+        })
+
+    data, attrs = wire.encode(breadcrumb)
+    assert data == b'A-1/20150709/P1TT3xt3.html'
+    assert attrs[wire.VERSION_KEY] == wire.VERSION
+    assert 'timestamp' not in attrs
+    assert 'title' not in attrs
+    assert wire.decode(data, attrs) == breadcrumb
+
+
+def test_encoding_is_smaller() -> None:
+    attrs = {
+        'type': 'act_item',
+        'code': 'A-1',
+        'title': 'Access to Information Act',
+        'start': '2015-07-09',
+        'end': '2015-07-29',
+        'timestamp': datetime.datetime.now().isoformat(),
+    }
+    breadcrumb = acts_scraper.Breadcrumb(url='http://laws-lois.justice.gc.ca/eng/acts/A-1/20150709/P1TT3xt3.html',
+                                         attrs=attrs)
+    data, encoded_attrs = wire.encode(breadcrumb)
+
+    def size(url: bytes, message_attrs: dict) -> int:
+        return len(url) + sum(len(key) + len(value) for key, value in message_attrs.items())
+
+    assert size(data, encoded_attrs) < 0.7 * size(breadcrumb.url.encode('utf-8'), attrs)
+
+
+def test_round_trip_whole_second_timestamp() -> None:
+    breadcrumb = acts_scraper.Breadcrumb(url='file:///tmp/acts_home.html',
+                                         attrs={'timestamp': datetime.datetime(2016, 1, 1).isoformat()})
+    data, attrs = wire.encode(breadcrumb)
+    assert wire.GENERATION_KEY in attrs
+    assert wire.decode(data, attrs) == breadcrumb
+
+
+def test_round_trip_unusual_attrs() -> None:
+    breadcrumb = acts_scraper.Breadcrumb(url='http://foo.bar', attrs={
+        'timestamp': '2017-05-01T12:30:15+00:00',
+        '_t': 'not a type',
+        'foo': 'bar',
+    })
+    data, attrs = wire.encode(breadcrumb)
+    assert attrs['foo'] == 'bar'
+    assert attrs['__t'] == 'not a type'
+    assert wire.decode(data, attrs) == breadcrumb
+
+
+def test_decodes_unversioned_messages() -> None:
+    attrs = {'type': 'main_page', 'timestamp': '2017-05-01T12:30:15.123456'}
+    breadcrumb = wire.decode(b'http://laws-lois.justice.gc.ca/eng/acts/', attrs)
+    assert breadcrumb == acts_scraper.Breadcrumb(url='http://laws-lois.justice.gc.ca/eng/acts/', attrs=attrs)
+
+
+def test_message_type() -> None:
+    breadcrumb = acts_scraper.Breadcrumb(url='http://foo.bar', attrs={'type': 'act_item', 'code': 'A-1'})
+    assert wire.message_type(wire.encode(breadcrumb)[1]) == 'act_item'
+    assert wire.message_type({'type': 'main_page'}) == 'main_page'
+    assert wire.message_type({}) == ''